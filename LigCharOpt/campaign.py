@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+from contextlib import contextmanager
+from .schedule import split_devices, get_devices
+import multiprocessing as mp
+import traceback
+import queue
+import time
+import json
+import csv
+import sys
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+#CONSTANTS
+# seconds between checks that the campaign workers are still alive
+WORKER_POLL = 30.0
+
+
+def read_campaign(path):
+    '''
+    Ligands of a campaign, one per line as the name of its mol2 file in input/ with an optional net charge.
+    Blank lines and lines starting with # are skipped.
+    :return: list of [name, net charge or None]
+    '''
+    ligands = []
+    with open(path, 'r') as f:
+        for line in f:
+            data = line.split()
+            if len(data) == 0 or data[0].startswith('#'):
+                continue
+            ligands.append([data[0], int(data[1]) if len(data) > 1 else None])
+    if len(set(x[0] for x in ligands)) != len(ligands):
+        raise ValueError('Ligands listed more than once in {}'.format(path))
+    return ligands
+
+
+@contextmanager
+def redirect_output(path):
+    '''
+    Send stdout and stderr to path at the file descriptor level, so processes started inside, which inherit
+    the descriptors, write there too.
+    '''
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    log = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.dup2(log, 1)
+        os.dup2(log, 2)
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved + [log]:
+            os.close(fd)
+
+
+def read_results(output_folder):
+    '''
+    Result of a ligand from its output folder, the mean ddG of the FEP replicas of an optimisation or the
+    best mutant of a scan
+    :return: ddG, best mutant or None
+    '''
+    replicas = os.path.join(output_folder, 'fep_replicas.json')
+    if os.path.isfile(replicas):
+        with open(replicas, 'r') as f:
+            return json.load(f).get('mean'), None
+    scan = os.path.join(output_folder, 'scan_results.json')
+    if os.path.isfile(scan):
+        with open(scan, 'r') as f:
+            best = json.load(f).get('best')
+        if best is not None:
+            return best['ddG'], ' '.join(best['mutant'])
+    return None, None
+
+
+def campaign_worker(run, tasks, results, devices, index):
+    '''
+    Take ligands off the task queue until None is taken. Every ligand runs in its own folder with its output
+    in campaign.log there, on this worker's share of the GPUs. The start of each ligand is reported with the
+    worker index so the ligand can be recorded as failed if the worker dies.
+    '''
+    os.environ['CUDA_VISIBLE_DEVICES'] = ','.join(devices)
+    cwd = os.getcwd()
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        name, folder, args = task
+        results.put({'ligand': name, 'status': 'running', 'worker': index})
+        args = dict(args, **{'--num_gpu': str(max(len(devices), 1))})
+        t0 = time.time()
+        row = {'ligand': name, 'status': 'done', 'ddG': None, 'best_mutant': None, 'output_folder': None,
+               'error': None}
+        try:
+            os.chdir(folder)
+            with redirect_output('campaign.log'):
+                output_folder = run(args, prepared=True)
+            row['output_folder'] = os.path.abspath(output_folder)
+            row['ddG'], row['best_mutant'] = read_results(output_folder)
+        except Exception as err:
+            row['status'] = 'failed'
+            row['error'] = '{}: {}'.format(type(err).__name__, err)
+            logger.debug(traceback.format_exc())
+        finally:
+            os.chdir(cwd)
+        row['seconds'] = round(time.time() - t0, 1)
+        results.put(row)
+
+
+def run_campaign(run, tasks, num_workers, num_gpu, table):
+    '''
+    Run every ligand of a campaign over a pool of long lived workers fed from a queue, so imports and worker
+    start up are paid once per worker rather than once per ligand. The GPUs are split between the workers.
+    :param run: function running one ligand from its parsed command line arguments
+    :param tasks: list of [ligand name, folder, arguments]
+    :param num_workers: number of ligands run at the same time
+    :param table: csv file the results of all ligands are written to
+    :return: list of result rows
+    '''
+    num_workers = max(1, min(num_workers, len(tasks)))
+    split = split_devices(get_devices(num_gpu), [1] * num_workers) if num_gpu > 0 else [[] for x in range(num_workers)]
+    print('Running {} ligands over {} workers with devices {}'.format(len(tasks), num_workers, split))
+    # ligands start their own processes so the workers are plain, non daemonic, processes
+    context = mp.get_context('spawn')
+    task_queue = context.Queue()
+    result_queue = context.Queue()
+    for task in tasks:
+        task_queue.put(task)
+    workers = []
+    for index, devices in enumerate(split):
+        task_queue.put(None)
+        worker = context.Process(target=campaign_worker, args=(run, task_queue, result_queue, devices, index))
+        worker.start()
+        workers.append(worker)
+
+    rows = []
+    # ligand each worker is running and when it started
+    running = [None for x in workers]
+    try:
+        while len(rows) < len(tasks):
+            try:
+                row = result_queue.get(timeout=WORKER_POLL)
+            except queue.Empty:
+                row = None
+            if row is not None and row['status'] == 'running':
+                running[row['worker']] = [row['ligand'], time.time()]
+                continue
+            if row is not None:
+                running = [None if x is not None and x[0] == row['ligand'] else x for x in running]
+                rows.append(row)
+                print('Ligand {} {} in {} seconds'.format(row['ligand'], row['status'], row['seconds']))
+                write_table(table, rows)
+                continue
+            # a worker killed by a crash or the OOM killer never reports its ligand
+            for index, worker in enumerate(workers):
+                if not worker.is_alive() and running[index] is not None:
+                    name, t0 = running[index]
+                    running[index] = None
+                    rows.append({'ligand': name, 'status': 'failed', 'seconds': round(time.time() - t0, 1),
+                                 'error': 'Worker exited with code {}'.format(worker.exitcode)})
+                    print('Ligand {} failed, worker exited with code {}'.format(name, worker.exitcode))
+                    write_table(table, rows)
+            if not any(worker.is_alive() for worker in workers):
+                # ligands taken by a worker which died before reporting them, or never taken
+                done = set(x['ligand'] for x in rows)
+                for task in tasks:
+                    if task[0] not in done:
+                        rows.append({'ligand': task[0], 'status': 'failed', 'error': 'Not run, all workers exited'})
+                break
+    finally:
+        write_table(table, rows)
+    for worker in workers:
+        worker.join()
+    return rows
+
+
+def write_table(table, rows):
+    columns = ['ligand', 'status', 'seconds', 'ddG', 'best_mutant', 'output_folder', 'error']
+    with open(table + '.tmp', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for row in sorted(rows, key=lambda x: x['ligand']):
+            row = {x: row.get(x) for x in columns}
+            writer.writerow(row)
+    os.replace(table + '.tmp', table)
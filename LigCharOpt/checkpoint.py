@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpoint(object):
+    def __init__(self, path):
+        '''
+        Optimiser state written after every optimisation step so a stopped run can be resumed.
+        The state is json with the loop variables of the optimiser, the parameter vector and the
+        trajectories of the current step along with their size and modification time.
+        :param path: checkpoint file
+        '''
+        self.path = path
+
+    def save(self, state):
+        # write under a temporary name then move in place so a run killed mid write keeps the last checkpoint
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(state, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+    def load(self):
+        '''
+        :return: saved state or None if there is no checkpoint
+        '''
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+
+def file_stamps(files):
+    '''
+    Absolute path, size and modification time of files, None for missing files
+    '''
+    stamps = []
+    for file in files:
+        if os.path.isfile(file):
+            stamps.append([os.path.abspath(file), os.path.getsize(file), os.path.getmtime(file)])
+        else:
+            stamps.append(None)
+    return stamps
@@ -1,7 +1,9 @@
 #!/usr/local/bin/env python
 
 import os
+import json
 import shutil
+import hashlib
 
 from Fluorify.fluorify import SysBuilder
 
@@ -20,12 +22,68 @@ Usage:
   LigCharOpt [--output_folder=STRING] [--mol_name=STRING] [--ligand_name=STRING] [--complex_name=STRING] [--solvent_name=STRING]
             [--yaml_path=STRING] [--setup_path=STRING] [--o_atom_list=LIST] [--c_atom_list=LIST] [--h_atom_list=LIST] [--num_frames=INT] [--net_charge=INT]
             [--gaff_ver=INT] [--equi=INT] [--num_fep=INT] [--auto_select=STRING] [--param=STRING] [--optimize=BOOL] [--lock_atoms=LIST]
-            [--num_gpu=INT] [--opt_name=STRING] [--rmsd=FLOAT] [--exclude_dualtopo=BOOL] [--opt_steps=INT] [--central_diff=BOOL] [--job_type=STRING]...
+            [--num_gpu=INT] [--num_workers=INT] [--opt_name=STRING] [--rmsd=FLOAT] [--exclude_dualtopo=BOOL] [--opt_steps=INT] [--central_diff=BOOL] [--grad_chunk=INT] [--analytic_sigma=BOOL]
+            [--ligand_energy=BOOL] [--potential_cache=BOOL] [--ligand_cache=STRING] [--resume=BOOL] [--re_equi=INT]
+            [--target_error=FLOAT] [--max_frames=INT] [--decorrelate=BOOL] [--line_search=STRING]
+            [--min_ess=FLOAT] [--spsa_samples=INT] [--symmetry=BOOL]
+            [--active_top=INT] [--min_contacts=FLOAT] [--evaluations=STRING] [--surrogate_error=FLOAT]
+            [--prescreen_top=INT] [--prescreen_cutoff=FLOAT] [--batch_fep=BOOL] [--setup_cache=BOOL]
+            [--campaign=STRING] [--campaign_workers=INT]
+            [--job_type=STRING]...
 """
 
 
-def run_automatic_pipeline(yaml_file_path, complex_name, solvent_name):
-    """Run YANK's automatic pipeline."""
+def setup_key(yaml_file_path, complex_name, solvent_name, destinations=None):
+    """Hash of the YAML file, the contents of every existing file it references, the phase names and
+    the folders each system is copied to."""
+    import yaml
+    with open(yaml_file_path, 'rb') as f:
+        contents = f.read()
+
+    def referenced_files(node):
+        if isinstance(node, dict):
+            node = list(node.values())
+        if isinstance(node, list):
+            return [path for x in node for path in referenced_files(x)]
+        if isinstance(node, str):
+            # paths may be relative to the working directory or the YAML file
+            for path in [node, os.path.join(os.path.dirname(yaml_file_path), node)]:
+                if os.path.isfile(path):
+                    return [path]
+        return []
+
+    key = hashlib.sha1(contents)
+    key.update(json.dumps([complex_name, solvent_name]).encode())
+    if destinations is not None:
+        key.update(json.dumps(sorted(destinations.items())).encode())
+    for path in sorted(set(referenced_files(yaml.safe_load(contents)))):
+        key.update(os.path.normpath(path).encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                key.update(chunk)
+    return key.hexdigest()
+
+
+def run_automatic_pipeline(yaml_file_path, complex_name, solvent_name, setup_cache=True, destinations=None):
+    """Run YANK's automatic pipeline.
+    With setup_cache the prepared systems are reused if the YAML, the files it references and the phase names
+    are unchanged since the last setup, any change triggers a rebuild.
+    destinations maps the name of each system in the YAML to the input folder it is copied to, so several
+    ligands against one receptor are prepared in a single pass. By default the YAML holds one system which
+    is copied to 'input'."""
+    folders = ['input'] if destinations is None else sorted(set(destinations.values()))
+    cache_file = os.path.join('input', 'setup_cache.json')
+    setup_files = [os.path.join(folder, name, name + extension) for folder in folders
+                   for name in [complex_name, solvent_name] for extension in ['.prmtop', '.pdb']]
+    if setup_cache:
+        key = setup_key(yaml_file_path, complex_name, solvent_name, destinations)
+        if os.path.isfile(cache_file) and all(os.path.isfile(x) for x in setup_files):
+            with open(cache_file, 'r') as f:
+                if json.load(f)['key'] == key:
+                    print('Reusing systems prepared from unchanged {}'.format(yaml_file_path))
+                    return
+        print('Setup inputs changed or not cached, preparing systems...')
+
     from yank.experiment import ExperimentBuilder
     exp_builder = ExperimentBuilder(yaml_file_path)
 
@@ -38,23 +96,99 @@ def run_automatic_pipeline(yaml_file_path, complex_name, solvent_name):
 
     # Run the automatic pipeline.
     exp_builder.setup_experiments()
-    assert len(exp_builder._db.systems) == 1, 'Setting up multiple systems is not currently supported'
-    system_name = next(iter(list(exp_builder._db.systems.keys())))
+    system_names = list(exp_builder._db.systems.keys())
+    if destinations is None:
+        assert len(system_names) == 1, 'Setting up multiple systems is not currently supported'
+        destinations = {system_names[0]: 'input'}
+    missing = [x for x in destinations if x not in system_names]
+    if len(missing) > 0:
+        raise ValueError('Systems {} not found in {}, found {}'.format(missing, yaml_file_path, system_names))
 
     # Copy YANK setup files to match the Fluorify folder structure.
-    for phase_name, user_phase_name in zip(['complex', 'solvent'], [complex_name, solvent_name]):
-        # Create Fluorify directory structure.
-        fluorify_phase_dir = os.path.join('input', user_phase_name)
-        os.makedirs(fluorify_phase_dir, exist_ok=True)
-        for extension in ['.prmtop', '.pdb']:
-            yank_file_path = os.path.join(exp_builder.setup_dir, 'systems', system_name, phase_name + extension)
-            fluorify_file_path = os.path.join(fluorify_phase_dir, user_phase_name + extension)
-            shutil.copyfile(yank_file_path, fluorify_file_path)
+    for system_name, folder in destinations.items():
+        for phase_name, user_phase_name in zip(['complex', 'solvent'], [complex_name, solvent_name]):
+            # Create Fluorify directory structure.
+            fluorify_phase_dir = os.path.join(folder, user_phase_name)
+            os.makedirs(fluorify_phase_dir, exist_ok=True)
+            for extension in ['.prmtop', '.pdb']:
+                yank_file_path = os.path.join(exp_builder.setup_dir, 'systems', system_name, phase_name + extension)
+                fluorify_file_path = os.path.join(fluorify_phase_dir, user_phase_name + extension)
+                shutil.copyfile(yank_file_path, fluorify_file_path)
+
+    if setup_cache:
+        with open(cache_file, 'w') as f:
+            json.dump({'key': key, 'yaml': yaml_file_path}, f)
 
 
 def main(argv=None):
     args = docopt(usage, argv=argv, options_first=True)
+    if args['--campaign']:
+        campaign(args)
+    else:
+        run(args)
+
+
+def campaign(args):
+    """Optimize every ligand listed in the campaign file against one receptor.
+    All systems are prepared in one pass of YANK's pipeline, the YAML must name each system after its ligand.
+    Each ligand then runs in campaign/<ligand>/ with the options given here, ligands are taken off a queue
+    by a pool of workers sharing the GPUs and a table of results is written to campaign/results.csv."""
+    from .campaign import read_campaign, run_campaign
 
+    msg = 'No {0} specified using default {1}'
+    if not args['--yaml_path']:
+        raise ValueError('Campaigns are prepared with YANK, set yaml_path')
+    if args['--mol_name'] or args['--output_folder']:
+        raise ValueError('mol_name and output_folder are set per ligand in a campaign')
+    complex_name = args['--complex_name'] if args['--complex_name'] else 'complex'
+    solvent_name = args['--solvent_name'] if args['--solvent_name'] else 'solvent'
+
+    ligands = read_campaign(args['--campaign'])
+    folders = {name: os.path.join('campaign', name) for name, charge in ligands}
+    for name, folder in folders.items():
+        os.makedirs(os.path.join(folder, 'input'), exist_ok=True)
+        shutil.copyfile(os.path.join('input', name + '.mol2'), os.path.join(folder, 'input', name + '.mol2'))
+
+    if args['--setup_cache']:
+        setup_cache = int(args['--setup_cache'])
+    else:
+        setup_cache = True
+    run_automatic_pipeline(args['--yaml_path'], complex_name, solvent_name, setup_cache,
+                           destinations={name: os.path.join(folder, 'input') for name, folder in folders.items()})
+
+    if args['--num_gpu']:
+        num_gpu = int(args['--num_gpu'])
+    else:
+        num_gpu = 1
+        print(msg.format('number of GPUs per node', num_gpu))
+
+    if args['--campaign_workers']:
+        campaign_workers = int(args['--campaign_workers'])
+    else:
+        campaign_workers = max(num_gpu, 1)
+        print(msg.format('number of campaign workers', campaign_workers))
+
+    # ligands share one cache of parameterised molecules
+    if args['--ligand_cache']:
+        ligand_cache = os.path.abspath(args['--ligand_cache'])
+    else:
+        ligand_cache = os.path.abspath(os.path.join('input', 'ligand_cache'))
+
+    tasks = []
+    for name, charge in ligands:
+        ligand_args = dict(args)
+        ligand_args.update({'--campaign': None, '--mol_name': name, '--ligand_cache': ligand_cache,
+                            '--yaml_path': os.path.abspath(args['--yaml_path'])})
+        if charge is not None:
+            ligand_args['--net_charge'] = str(charge)
+        tasks.append([name, os.path.abspath(folders[name]), ligand_args])
+    run_campaign(run, tasks, campaign_workers, num_gpu, os.path.join('campaign', 'results.csv'))
+
+
+def run(args, prepared=False):
+    """Run one ligand from parsed command line arguments.
+    With prepared the YANK systems are already in input/ and the setup pipeline is skipped.
+    :return: output folder of the run"""
     msg = 'No {0} specified using default {1}'
 
     if args['--complex_name']:
@@ -86,7 +220,12 @@ def main(argv=None):
     # Run the setup pipeline.
     if args['--yaml_path']:
         # Use yank system builder
-        run_automatic_pipeline(args['--yaml_path'], complex_name, solvent_name)
+        if args['--setup_cache']:
+            setup_cache = int(args['--setup_cache'])
+        else:
+            setup_cache = True
+        if not prepared:
+            run_automatic_pipeline(args['--yaml_path'], complex_name, solvent_name, setup_cache)
         #All these variables passed are dummies we are using yank to prep system.
         systems = SysBuilder('./input/', './receptor.pdb', './ligand.mol2', 'amber14/protein.ff14SB.xml',
                              'amber14/spce.xml', './gaff.xml', 1.0 * unit.nanometers, 0.15 * unit.molar, using_yank=True)
@@ -162,12 +301,21 @@ def main(argv=None):
         o_atom_list = None
         auto_select = None
         job_type = 'optimize'
+        if args['--prescreen_top'] or args['--prescreen_cutoff']:
+            raise ValueError('Prescreen options only compatible with a scan')
+        else:
+            prescreen_top = None
+            prescreen_cutoff = None
+        if args['--batch_fep']:
+            raise ValueError('Batch FEP option only compatible with a scan')
+        else:
+            batch_fep = False
         if args['--central_diff']:
             central_diff = int(args['--central_diff'])
         else:
             central_diff = False
             print(msg.format('finite difference method', 'forward difference'))
-        optimizer_names = ['scipy', 'FEP_only', 'grad_decent_ssp', 'grad_decent_fep', 'grad_convg']
+        optimizer_names = ['scipy', 'FEP_only', 'grad_decent_ssp', 'grad_decent_fep', 'grad_convg', 'lbfgs']
         if args['--opt_name']:
             opt_name = args['--opt_name']
             if opt_name not in optimizer_names:
@@ -185,6 +333,88 @@ def main(argv=None):
         else:
             rmsd = 0.03
             print(msg.format('optimization rmsd', rmsd))
+        if args['--grad_chunk']:
+            grad_chunk = int(args['--grad_chunk'])
+            if grad_chunk < 1:
+                raise ValueError('Gradient chunk size must be at least 1')
+        else:
+            grad_chunk = None
+        if args['--analytic_sigma']:
+            analytic_sigma = int(args['--analytic_sigma'])
+        else:
+            analytic_sigma = True
+            if 'sigma' in param:
+                print(msg.format('sigma gradient method', 'analytic'))
+        if args['--ligand_energy']:
+            ligand_energy = int(args['--ligand_energy'])
+        else:
+            ligand_energy = True
+            if 'sigma' in param:
+                print(msg.format('perturbed energy evaluation', 'ligand terms only'))
+        if args['--potential_cache']:
+            potential_cache = int(args['--potential_cache'])
+        else:
+            potential_cache = True
+            if 'sigma' not in param:
+                print(msg.format('perturbed charge evaluation', 'cached electrostatic potentials'))
+        if args['--resume']:
+            resume = int(args['--resume'])
+        else:
+            resume = False
+        if args['--re_equi']:
+            re_equi = int(args['--re_equi'])
+            if re_equi < 0:
+                re_equi = None
+        else:
+            re_equi = None
+        if args['--target_error']:
+            target_error = float(args['--target_error'])
+        else:
+            target_error = None
+        if args['--max_frames']:
+            if target_error is None:
+                raise ValueError('Maximum number of frames option only compatible with a target error')
+            max_frames = int(args['--max_frames'])
+        else:
+            max_frames = None
+        if args['--decorrelate']:
+            decorrelate = int(args['--decorrelate'])
+        else:
+            decorrelate = False
+        if args['--line_search']:
+            line_search = args['--line_search']
+        else:
+            line_search = 'fep'
+            print(msg.format('line search', line_search))
+        if args['--min_ess']:
+            min_ess = float(args['--min_ess'])
+        else:
+            min_ess = 0.1
+            print(msg.format('minimum effective sample size of reweighted line search', min_ess))
+        if args['--spsa_samples']:
+            spsa_samples = int(args['--spsa_samples'])
+        else:
+            spsa_samples = None
+        if args['--symmetry']:
+            symmetry = int(args['--symmetry'])
+        else:
+            symmetry = False
+        if args['--active_top']:
+            active_top = int(args['--active_top'])
+        else:
+            active_top = None
+        if args['--min_contacts']:
+            min_contacts = float(args['--min_contacts'])
+        else:
+            min_contacts = None
+        if args['--evaluations']:
+            evaluations = args['--evaluations']
+        else:
+            evaluations = None
+        if args['--surrogate_error']:
+            surrogate_error = float(args['--surrogate_error'])
+        else:
+            surrogate_error = None
     else:
         print('Scanning ligand...')
         if args['--central_diff']:
@@ -203,6 +433,74 @@ def main(argv=None):
             raise ValueError('Optimization rmsd option only compatible with an optimization')
         else:
             rmsd = None
+        if args['--grad_chunk']:
+            raise ValueError('Gradient chunk size option only compatible with an optimization')
+        else:
+            grad_chunk = None
+        if args['--analytic_sigma']:
+            raise ValueError('Sigma gradient method option only compatible with an optimization')
+        else:
+            analytic_sigma = None
+        if args['--ligand_energy']:
+            raise ValueError('Ligand energy option only compatible with an optimization')
+        else:
+            ligand_energy = None
+        if args['--potential_cache']:
+            raise ValueError('Potential cache option only compatible with an optimization')
+        else:
+            potential_cache = None
+        if args['--resume']:
+            raise ValueError('Resume option only compatible with an optimization')
+        else:
+            resume = None
+        if args['--re_equi']:
+            raise ValueError('Re-equilibration option only compatible with an optimization')
+        else:
+            re_equi = None
+        if args['--target_error'] or args['--max_frames']:
+            raise ValueError('Adaptive sampling options only compatible with an optimization')
+        else:
+            target_error = None
+            max_frames = None
+        if args['--decorrelate']:
+            raise ValueError('Decorrelate option only compatible with an optimization')
+        else:
+            decorrelate = None
+        if args['--line_search'] or args['--min_ess']:
+            raise ValueError('Line search options only compatible with an optimization')
+        else:
+            line_search = None
+            min_ess = None
+        if args['--spsa_samples']:
+            raise ValueError('SPSA samples option only compatible with an optimization')
+        else:
+            spsa_samples = None
+        if args['--symmetry']:
+            raise ValueError('Symmetry option only compatible with an optimization')
+        else:
+            symmetry = None
+        if args['--active_top'] or args['--min_contacts']:
+            raise ValueError('Active atom selection options only compatible with an optimization')
+        else:
+            active_top = None
+            min_contacts = None
+        if args['--evaluations'] or args['--surrogate_error']:
+            raise ValueError('Evaluation store options only compatible with an optimization')
+        else:
+            evaluations = None
+            surrogate_error = None
+        if args['--prescreen_top']:
+            prescreen_top = int(args['--prescreen_top'])
+        else:
+            prescreen_top = None
+        if args['--prescreen_cutoff']:
+            prescreen_cutoff = float(args['--prescreen_cutoff'])
+        else:
+            prescreen_cutoff = None
+        if args['--batch_fep']:
+            batch_fep = int(args['--batch_fep'])
+        else:
+            batch_fep = False
         if args['--c_atom_list']:
             c_atom_list = []
             pairs = args['--c_atom_list']
@@ -291,6 +589,16 @@ def main(argv=None):
         num_gpu = 1
         print(msg.format('number of GPUs per node', num_gpu))
 
+    if args['--num_workers']:
+        num_workers = int(args['--num_workers'])
+    else:
+        num_workers = None
+
+    if args['--ligand_cache']:
+        ligand_cache = args['--ligand_cache']
+    else:
+        ligand_cache = None
+
     if args['--num_fep']:
         num_fep = args['--num_fep']
     else:
@@ -308,5 +616,12 @@ def main(argv=None):
 
     LigCharOpt(output_folder, mol_name, ligand_name, net_charge, complex_name, solvent_name,
          job_type, auto_select, c_atom_list, h_atom_list, o_atom_list, num_frames, param, gaff_ver,
-             opt, num_gpu, num_fep, equi, central_diff, opt_name, opt_steps, rmsd, exclude_dualtopo, lock_atoms, systems)
-
+             opt, num_gpu, num_fep, equi, central_diff, opt_name, opt_steps, rmsd, exclude_dualtopo, lock_atoms, systems,
+               grad_chunk=grad_chunk, num_workers=num_workers, analytic_sigma=analytic_sigma,
+               ligand_energy=ligand_energy, potential_cache=potential_cache, ligand_cache=ligand_cache,
+               resume=resume, re_equi=re_equi, target_error=target_error, max_frames=max_frames,
+               decorrelate=decorrelate, line_search=line_search, min_ess=min_ess,
+               spsa_samples=spsa_samples, symmetry=symmetry, active_top=active_top, min_contacts=min_contacts,
+               evaluations=evaluations, surrogate_error=surrogate_error, prescreen_top=prescreen_top,
+               prescreen_cutoff=prescreen_cutoff, batch_fep=batch_fep)
+    return output_folder
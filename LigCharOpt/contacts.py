@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+from simtk.openmm import app
+from .potential import minimum_image
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+#CONSTANTS
+# heavy atom distance counted as a contact in nm
+CONTACT_CUTOFF = 0.45
+
+
+def receptor_atoms(topology, ligand_atoms):
+    '''
+    Heavy atoms of the receptor, taken as every residue with more than one heavy atom other than the ligand
+    so water and ions are left out
+    :param topology: pdb file of the complex
+    :return: list of atom indices
+    '''
+    ligand_atoms = set(ligand_atoms)
+    atoms = []
+    for residue in app.PDBFile(topology).topology.residues():
+        heavy = [x.index for x in residue.atoms() if x.element is not None and x.element.symbol != 'H']
+        if len(heavy) > 1 and not any(x.index in ligand_atoms for x in residue.atoms()):
+            atoms.extend(heavy)
+    return atoms
+
+
+def receptor_contacts(frames, receptor, ligand_atoms, cutoff=CONTACT_CUTOFF):
+    '''
+    Average number of receptor heavy atoms within cutoff of each ligand atom over a trajectory
+    :param frames: FrameStore of the complex trajectory
+    :param receptor: indices of the receptor heavy atoms
+    :param ligand_atoms: indices of the ligand atoms in the complex
+    :return: array of contacts with shape (num_ligand_atoms,)
+    '''
+    receptor = np.array(receptor, dtype=int)
+    ligand_atoms = np.array(ligand_atoms, dtype=int)
+    contacts = np.zeros(len(ligand_atoms))
+    for frame in range(frames.num_frames):
+        positions, box = frames.frame(frame)
+        positions = np.array(positions, dtype=np.float64)
+        delta = positions[receptor][np.newaxis, :, :] - positions[ligand_atoms][:, np.newaxis, :]
+        if box is not None:
+            delta = minimum_image(delta, np.array(box, dtype=np.float64))
+        contacts += np.sum(np.sum(delta**2, axis=2) < cutoff**2, axis=1)
+    return contacts / frames.num_frames
+
+
+def inactive_atoms(contacts, top=None, min_contacts=None):
+    '''
+    Ligand atoms to lock, those outside the top ranked atoms by contacts or with fewer than min_contacts
+    :return: sorted list of indices into contacts
+    '''
+    rank = np.argsort(-contacts, kind='stable')
+    locked = set()
+    if top is not None:
+        locked.update(int(x) for x in rank[top:])
+    if min_contacts is not None:
+        locked.update(int(x) for x in np.where(contacts < min_contacts)[0])
+    return sorted(locked)
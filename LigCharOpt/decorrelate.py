@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+from simtk import openmm as mm
+from pymbar import timeseries
+from .potential import get_electrostatics, pair_kernel, minimum_image, ONE_4PI_EPS0
+from .sigma import get_lennard_jones
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def interaction_energy(system, frames, ligand_atoms, params=None, epsilons=None):
+    '''
+    Real space Coulomb and Lennard-Jones energy between the ligand and its environment for every frame,
+    the observable whose correlation time sets how many frames are independent
+    :param system: OpenMM system of the phase
+    :param frames: FrameStore of the phase trajectory
+    :param ligand_atoms: indices of the ligand atoms in the system
+    :param params: concatenated [charges, sigmas] of the ligand the trajectory was sampled with,
+                   None for those of the system
+    :param epsilons: ligand epsilons in kcal/mol the trajectory was sampled with, None for those of the system
+    :return: array of energies in kcal/mol with shape (num_frames,)
+    '''
+    ligand_atoms = np.array(ligand_atoms)
+    electrostatics = get_electrostatics(system)
+    lennard_jones = get_lennard_jones(system, ligand_atoms)
+    if params is not None:
+        num_atoms = len(ligand_atoms)
+        electrostatics['charges'][ligand_atoms] = params[:num_atoms]
+        lennard_jones['sigmas'][ligand_atoms] = params[num_atoms:2*num_atoms]
+    if epsilons is not None:
+        lennard_jones['epsilons'][ligand_atoms] = epsilons
+    method = electrostatics['method']
+    periodic = method not in [mm.NonbondedForce.NoCutoff, mm.NonbondedForce.CutoffNonPeriodic]
+    environment = np.ones(len(electrostatics['charges']), dtype=bool)
+    environment[ligand_atoms] = False
+
+    charge_product = electrostatics['charges'][ligand_atoms][:, np.newaxis] * electrostatics['charges'][environment]
+    sigma = 0.5 * (lennard_jones['sigmas'][ligand_atoms][:, np.newaxis] + lennard_jones['sigmas'][environment])
+    epsilon = np.sqrt(lennard_jones['epsilons'][ligand_atoms][:, np.newaxis] * lennard_jones['epsilons'][environment])
+
+    energy = np.zeros(frames.num_frames)
+    for frame in range(frames.num_frames):
+        positions, box = frames.frame(frame)
+        positions = np.array(positions, dtype=np.float64)
+        delta = positions[environment][np.newaxis, :, :] - positions[ligand_atoms][:, np.newaxis, :]
+        if periodic:
+            delta = minimum_image(delta, np.array(box, dtype=np.float64))
+        r = np.linalg.norm(delta, axis=2)
+        if method != mm.NonbondedForce.NoCutoff:
+            mask = r < electrostatics['cutoff']
+        else:
+            mask = np.ones(r.shape, dtype=bool)
+        s6 = (sigma[mask] / r[mask])**6
+        energy[frame] = ONE_4PI_EPS0 * np.sum(charge_product[mask] * pair_kernel(r[mask], electrostatics)) + \
+                        np.sum(4.0 * epsilon[mask] * (s6**2 - s6))
+    return energy
+
+
+def decorrelated_indices(series):
+    '''
+    Statistical inefficiency of a time series and the indices of uncorrelated samples
+    :return: list of indices and the statistical inefficiency
+    '''
+    # pymbar 4 renamed the timeseries functions
+    if hasattr(timeseries, 'statistical_inefficiency'):
+        g = timeseries.statistical_inefficiency(series)
+        indices = timeseries.subsample_correlated_data(series, g=g)
+    else:
+        g = timeseries.statisticalInefficiency(series)
+        indices = timeseries.subsampleCorrelatedData(series, g=g)
+    return list(indices), g
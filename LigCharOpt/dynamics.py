@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+from simtk import openmm as mm
+from simtk.openmm import app
+from simtk import unit
+from .parallel import ligand_force, set_ligand_parameters, pack_params
+from .frames import get_frame_store
+from .schedule import run_legs
+import numpy as np
+import glob
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+#CONSTANTS
+# used where neither FSim nor the system give the setting
+TEMPERATURE = 300.0*unit.kelvin
+TIMESTEP = 2.0*unit.femtoseconds
+FRICTION = 1.0/unit.picosecond
+FRAME_INTERVAL = 5.0*unit.picoseconds
+
+
+class WarmDynamics(object):
+    def __init__(self, simulation, system, ligand_atoms, param_model, output_folder, name, resume=False):
+        '''
+        Dynamics of one phase that continue from the final state of the previous optimisation step.
+        The positions, velocities and box at the end of every run are saved and the next run starts
+        from them with a short re-equilibration, the first run starts from the last frame of the
+        trajectory it replaces. With more than one device the frames are split between independent
+        chains, one per device, each continuing from its own saved state.
+        :param simulation: FSim of the phase, the integrator settings are taken from it
+        :param system: OpenMM system of the phase
+        :param ligand_atoms: indices of the ligand atoms in the system
+        :param param_model: ParameterModel translating parameter vectors to ligand parameters
+        :param output_folder: folder for the trajectory and saved state
+        :param name: phase name, complex or solvent
+        :param resume: continue from states saved by an earlier run, otherwise they are deleted
+        '''
+        self.system = system
+        self.ligand_atoms = list(ligand_atoms)
+        self.param_model = param_model
+        self.temperature, self.friction, self.timestep = integrator_settings(simulation, system)
+        # frames spaced by 5ps
+        self.frame_steps = max(1, int(round(FRAME_INTERVAL / self.timestep)))
+        self.dcd = os.path.join(output_folder, name + '_warm.dcd')
+        self.state_file = os.path.join(output_folder, name + '_state.xml')
+        # set to the number of devices of the leg when run by run_legs
+        self.num_gpu = 1
+        if not resume:
+            WarmDynamics.reset(self)
+
+    def reset(self):
+        '''
+        Delete the saved states so the next run starts from the trajectory it replaces
+        '''
+        for file in glob.glob(self.state_file.replace('.xml', '*.xml')):
+            os.remove(file)
+
+    def seeded(self, trajectory):
+        '''
+        :return: True if there is a saved state or trajectory to continue from
+        '''
+        return os.path.isfile(self.state_file) or all(os.path.isfile(x) for x in trajectory)
+
+    def chain_file(self, path, chain, block=0):
+        '''
+        File of a chain and block of frames, the first chain and block keep the plain name
+        '''
+        root, extension = os.path.splitext(path)
+        if chain > 0:
+            root += '_chain{}'.format(chain)
+        if block > 0:
+            root += '_{}'.format(block)
+        return root + extension
+
+    def run(self, params, trajectory, topology, num_frames, equi, block=0):
+        '''
+        :param params: concatenated [charges, sigmas] to run with
+        :param trajectory: current dcd files of the phase, seed the first run
+        :param topology: pdb file of the phase
+        :param num_frames: number of frames to collect over all chains
+        :param equi: number of re-equilibration steps
+        :param block: index of the block of frames when sampling adaptively, blocks after the first
+                      are written to their own dcd file
+        :return: list of dcd files
+        '''
+        num_chains = max(1, min(self.num_gpu, num_frames))
+        if num_chains == 1:
+            return WarmDynamics.run_chain(self, params, trajectory, topology, num_frames, equi, block, 0)
+        frames = [num_frames // num_chains + (1 if x < num_frames % num_chains else 0) for x in range(num_chains)]
+        legs = [[self, 'run_chain', (params, trajectory, topology, frames[x], equi, block, x), {}]
+                for x in range(num_chains)]
+        chains = run_legs(legs, frames, num_chains)
+        return [dcd for chain in chains for dcd in chain]
+
+    def run_chain(self, params, trajectory, topology, num_frames, equi, block, chain):
+        '''
+        Run one chain on the first visible device
+        :param chain: index of the chain, chains after the first save their trajectory and state to their own files
+        :return: list of dcd files
+        '''
+        dcd_file = WarmDynamics.chain_file(self, self.dcd, chain, block)
+        state_file = WarmDynamics.chain_file(self, self.state_file, chain)
+        system = mm.XmlSerializer.deserialize(mm.XmlSerializer.serialize(self.system))
+        force = [x for x in system.getForces() if isinstance(x, mm.NonbondedForce)][0]
+        exceptions = [list(self.param_model.excep_i), list(self.param_model.excep_j)]
+        ligand = ligand_force(force, self.ligand_atoms, exceptions)
+        set_ligand_parameters(ligand, pack_params(self.param_model, params)[0])
+
+        integrator = mm.LangevinIntegrator(self.temperature, self.friction, self.timestep)
+        context = mm.Context(system, integrator)
+        seed = state_file if os.path.isfile(state_file) else None
+        if seed is None and not all(os.path.isfile(x) for x in trajectory):
+            # chains added since the last run continue from the first chain
+            seed = self.state_file
+        if seed is not None:
+            with open(seed, 'r') as f:
+                context.setState(mm.XmlSerializer.deserialize(f.read()))
+        else:
+            # chains seed from different dcd files where there are several
+            frames = get_frame_store([trajectory[chain % len(trajectory)]], topology)
+            positions, box = frames.frame(frames.num_frames - 1)
+            if box is not None:
+                context.setPeriodicBoxVectors(*[mm.Vec3(*x) for x in np.array(box, dtype=np.float64)])
+            context.setPositions(np.array(positions, dtype=np.float64))
+            # the frame was sampled with other ligand parameters
+            mm.LocalEnergyMinimizer.minimize(context)
+            context.setVelocitiesToTemperature(self.temperature)
+        integrator.step(equi)
+
+        # write under a temporary name so the previous trajectory stays whole if the run stops
+        top = app.PDBFile(topology).topology
+        if system.usesPeriodicBoundaryConditions():
+            # box vectors are only written if the topology has a box
+            top.setPeriodicBoxVectors(context.getState().getPeriodicBoxVectors())
+        with open(dcd_file + '.tmp', 'wb') as f:
+            dcd = app.DCDFile(f, top, self.timestep, 0, self.frame_steps)
+            for frame in range(num_frames):
+                integrator.step(self.frame_steps)
+                state = context.getState(getPositions=True)
+                dcd.writeModel(state.getPositions(), periodicBoxVectors=state.getPeriodicBoxVectors())
+        os.replace(dcd_file + '.tmp', dcd_file)
+
+        state = context.getState(getPositions=True, getVelocities=True)
+        with open(state_file + '.tmp', 'w') as f:
+            f.write(mm.XmlSerializer.serialize(state))
+        os.replace(state_file + '.tmp', state_file)
+        return [dcd_file]
+
+
+def integrator_settings(simulation, system):
+    '''
+    Temperature, friction and timestep of the FSim dynamics. Settings FSim does not hold are taken from the
+    barostat of the system, or the FSim defaults.
+    :return: temperature, friction and timestep with units
+    '''
+    barostats = [x for x in system.getForces() if isinstance(x, mm.MonteCarloBarostat)]
+    temperature = barostats[0].getDefaultTemperature() if len(barostats) > 0 else TEMPERATURE
+    temperature = with_unit(getattr(simulation, 'temperature', temperature), unit.kelvin)
+    friction = with_unit(getattr(simulation, 'friction', FRICTION), unit.picosecond**-1)
+    timestep = with_unit(getattr(simulation, 'timestep', TIMESTEP), unit.picoseconds)
+    return temperature, friction, timestep
+
+
+def with_unit(value, units):
+    if unit.is_quantity(value):
+        return value.in_units_of(units)
+    return value * units
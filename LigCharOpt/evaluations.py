@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
+import numpy as np
+import hashlib
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+#CONSTANTS
+# decimal places parameters are rounded to when building keys
+KEY_DECIMALS = 8
+# length scales of the surrogate kernel tried when fitting, in parameter units
+LENGTH_SCALES = np.logspace(-2, 1, 13)
+# fewest stored points the surrogate is fitted to
+SURROGATE_MIN_POINTS = 10
+# diagonal jitter, relative to the kernel variance, added in turn until the covariance can be factorised
+JITTERS = [1e-6, 1e-4, 1e-2]
+
+
+class EvaluationStore(object):
+    def __init__(self, path):
+        '''
+        Free energy evaluations appended to a json lines file and looked up by a hash of everything that
+        determines them, e.g. the parameters and the trajectories they were reweighted from, so repeated
+        queries across steps and reruns are answered without simulation. ddG points relative to the
+        original parameters of a ligand are kept separately for fitting a surrogate.
+        :param path: json lines file, created if missing
+        '''
+        self.path = path
+        self.records = {}
+        self.points = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # partial line left by a stopped run
+                        continue
+                    if record['kind'] == 'point':
+                        self.points.setdefault(record['origin'], {})[record['key']] = record['value']
+                    else:
+                        self.records[record['key']] = record['value']
+            print('Loaded {} stored evaluations from {}'.format(len(self.records), path))
+
+    def get(self, kind, *args):
+        '''
+        :return: stored value of the evaluation or None
+        '''
+        return self.records.get(evaluation_key(kind, args))
+
+    def add(self, kind, value, *args):
+        key = evaluation_key(kind, args)
+        self.records[key] = value
+        EvaluationStore.append(self, {'key': key, 'kind': kind, 'value': value})
+
+    def add_point(self, origin, params, ddg, error):
+        '''
+        Store the ddG of params relative to the origin parameters with its error
+        '''
+        origin = evaluation_key('origin', [origin])
+        key = evaluation_key('point', [origin, params])
+        value = [[float(x) for x in params], float(ddg), float(error)]
+        self.points.setdefault(origin, {})[key] = value
+        EvaluationStore.append(self, {'key': key, 'kind': 'point', 'origin': origin, 'value': value})
+
+    def get_points(self, origin):
+        '''
+        :return: list of [params, ddG, error] stored relative to the origin parameters
+        '''
+        return list(self.points.get(evaluation_key('origin', [origin]), {}).values())
+
+    def append(self, record):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+class Surrogate(object):
+    def __init__(self, points, values, errors):
+        '''
+        Gaussian process regression of ddG over parameter space with a squared exponential kernel.
+        The length scale is picked from LENGTH_SCALES by marginal likelihood and the noise of each
+        point is its statistical error. If the covariance can not be factorised for any length scale,
+        even with the largest of JITTERS added, fitted is False and the surrogate must not be used.
+        :param points: parameter vectors with shape (num_points, num_params)
+        :param values: ddG of each point in kcal/mol
+        :param errors: error of each point in kcal/mol
+        '''
+        self.points = np.array(points, dtype=np.float64)
+        values = np.array(values, dtype=np.float64)
+        self.offset = np.mean(values)
+        values = values - self.offset
+        self.variance = max(np.var(values), np.mean(np.array(errors)**2), 1e-6)
+        noise = np.array(errors, dtype=np.float64)**2
+        best = -np.inf
+        for length in LENGTH_SCALES:
+            factor = None
+            for jitter in JITTERS:
+                covariance = Surrogate.kernel(self, self.points, self.points, length) + \
+                             np.diag(noise + jitter * self.variance)
+                try:
+                    factor = cho_factor(covariance, lower=True)
+                    break
+                except np.linalg.LinAlgError:
+                    continue
+            if factor is None:
+                continue
+            alpha = cho_solve(factor, values)
+            likelihood = -0.5 * np.dot(values, alpha) - np.sum(np.log(np.diag(factor[0])))
+            if likelihood > best:
+                best = likelihood
+                self.length = length
+                self.factor = factor
+                self.alpha = alpha
+        self.fitted = best > -np.inf
+
+    def kernel(self, a, b, length):
+        distance = np.sum(a**2, axis=1)[:, np.newaxis] + np.sum(b**2, axis=1) - 2.0 * a @ b.T
+        return self.variance * np.exp(-0.5 * np.maximum(distance, 0.0) / length**2)
+
+    def predict(self, points):
+        '''
+        :return: mean and standard deviation of ddG at each point in kcal/mol
+        '''
+        points = np.atleast_2d(np.array(points, dtype=np.float64))
+        k = Surrogate.kernel(self, points, self.points, self.length)
+        mean = self.offset + k @ self.alpha
+        v = solve_triangular(self.factor[0], k.T, lower=True)
+        std = np.sqrt(np.maximum(self.variance - np.sum(v**2, axis=0), 0.0))
+        return mean, std
+
+
+def evaluation_key(kind, args):
+    return hashlib.sha1(json.dumps([kind, rounded(list(args))]).encode()).hexdigest()
+
+
+def rounded(x):
+    '''
+    Json friendly copy of x with floats rounded to KEY_DECIMALS
+    '''
+    if isinstance(x, (list, tuple, np.ndarray)):
+        return [rounded(y) for y in x]
+    if isinstance(x, (bool, np.bool_)):
+        return bool(x)
+    if isinstance(x, (int, np.integer)):
+        return int(x)
+    if isinstance(x, (float, np.floating)):
+        return round(float(x), KEY_DECIMALS)
+    return x
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+import mdtraj as md
+import numpy as np
+import hashlib
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class FrameStore(object):
+    def __init__(self, path, indices=None):
+        '''
+        Trajectory frames held as memory mapped float32 arrays, positions with shape
+        (num_frames, num_atoms, 3) and box vectors with shape (num_frames, 3, 3), both in nm.
+        Frames are sliced straight out of the mapped files without parsing or copying the trajectory.
+        :param path: folder of the frame store
+        :param indices: frames of the trajectory selected by the store, None for all frames
+        '''
+        self.path = path
+        with open(os.path.join(path, 'index.json'), 'r') as f:
+            self.index = json.load(f)
+        self.positions = np.load(os.path.join(path, 'positions.npy'), mmap_mode='r')
+        if self.index['periodic']:
+            self.boxes = np.load(os.path.join(path, 'boxes.npy'), mmap_mode='r')
+        else:
+            self.boxes = None
+        self.num_atoms = self.positions.shape[1]
+        if indices is None:
+            self.indices = None
+            self.key = self.index['key']
+            self.num_frames = self.positions.shape[0]
+        else:
+            self.indices = np.array(indices, dtype=int)
+            self.key = self.index['key'] + '_' + hashlib.sha1(self.indices.tobytes()).hexdigest()
+            self.num_frames = len(self.indices)
+
+    def frame(self, i):
+        '''
+        :return: positions and box vectors (None if not periodic) of frame i
+        '''
+        if self.indices is not None:
+            i = self.indices[i]
+        box = None if self.boxes is None else self.boxes[i]
+        return self.positions[i], box
+
+    def subset(self, indices):
+        '''
+        :param indices: frames of this store to keep
+        :return: FrameStore of the selected frames
+        '''
+        indices = np.array(indices, dtype=int)
+        if self.indices is not None:
+            indices = self.indices[indices]
+        return FrameStore(self.path, indices)
+
+
+def get_frame_store(trajectory, topology, path=None):
+    '''
+    Open the frame store of a trajectory, converting the dcd files on first load
+    or if they have changed since the store was written.
+    :param trajectory: list of dcd files
+    :param topology: pdb file
+    :param path: folder of the store, defaults to the first dcd file name with a _frames suffix
+    :return: FrameStore
+    '''
+    if path is None:
+        path = os.path.splitext(trajectory[0])[0] + '_frames'
+    source = [[os.path.abspath(x), os.path.getsize(x), os.path.getmtime(x)] for x in list(trajectory) + [topology]]
+    index_file = os.path.join(path, 'index.json')
+    if os.path.isfile(index_file):
+        with open(index_file, 'r') as f:
+            if json.load(f)['source'] == source:
+                return FrameStore(path)
+
+    print('Converting trajectory {} to frame store {}...'.format(trajectory, path))
+    os.makedirs(path, exist_ok=True)
+    top = md.load_topology(topology)
+    num_frames = 0
+    for dcd in trajectory:
+        with md.open(dcd) as f:
+            num_frames += len(f)
+
+    # write under temporary names then move in place, stores still mapped by a reader keep their old files
+    positions = np.lib.format.open_memmap(os.path.join(path, 'positions.tmp.npy'), mode='w+', dtype=np.float32,
+                                          shape=(num_frames, top.n_atoms, 3))
+    boxes = np.lib.format.open_memmap(os.path.join(path, 'boxes.tmp.npy'), mode='w+', dtype=np.float32,
+                                      shape=(num_frames, 3, 3))
+    periodic = True
+    frame = 0
+    for dcd in trajectory:
+        for chunk in md.iterload(dcd, top=top, chunk=100):
+            positions[frame:frame+chunk.n_frames] = chunk.xyz
+            if chunk.unitcell_vectors is None:
+                periodic = False
+            else:
+                boxes[frame:frame+chunk.n_frames] = chunk.unitcell_vectors
+            frame += chunk.n_frames
+    positions.flush()
+    boxes.flush()
+    del positions, boxes
+    for name in ['positions', 'boxes']:
+        os.replace(os.path.join(path, name + '.tmp.npy'), os.path.join(path, name + '.npy'))
+
+    index = {'source': source, 'trajectory': list(trajectory), 'topology': topology, 'periodic': periodic,
+             'key': hashlib.sha1(json.dumps(source).encode()).hexdigest()}
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_file + '.tmp', index_file)
+    return FrameStore(path)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+from Fluorify.energy import MutatedLigand
+import multiprocessing as mp
+import tempfile
+import hashlib
+import pickle
+import shutil
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LigandCache(object):
+    def __init__(self, path):
+        '''
+        On disk store of ligand parameters keyed by the content of the mol2 file, the net charge,
+        the GAFF version and the atoms removed by the mutation, so any molecule which has been
+        parametrised before skips antechamber and tleap.
+        :param path: folder of the store, shared between scans
+        '''
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, mol2_file, net_charge, gaff_ver, mute):
+        with open(mol2_file, 'r') as f:
+            lines = f.readlines()
+        # the molecule name follows the file name so is left out of the hash
+        for i, line in enumerate(lines[:-1]):
+            if line.strip() == '@<TRIPOS>MOLECULE':
+                lines[i+1] = '\n'
+        settings = json.dumps([net_charge, gaff_ver, mute], default=str)
+        return hashlib.sha1((''.join(lines) + settings).encode()).hexdigest()
+
+    def load(self, key):
+        file = os.path.join(self.path, key + '.pkl')
+        if not os.path.isfile(file):
+            return None
+        with open(file, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, key, parameters):
+        # write under a temporary name then move in place so concurrent scans never read partial files
+        file = os.path.join(self.path, key + '.pkl')
+        with open(file + '.' + str(os.getpid()), 'wb') as f:
+            pickle.dump(parameters, f)
+        os.replace(file + '.' + str(os.getpid()), file)
+
+
+def parametrize_ligand(task):
+    '''
+    Parameters of one ligand from the cache or from antechamber and tleap.
+    antechamber writes scratch files to the working directory so each ligand is run in its own.
+    :return: ligand parameters and True if they were found in the cache
+    '''
+    cache_path, key, file_path, mol_name, net_charge, gaff_ver, mute = task
+    cache = LigandCache(cache_path)
+    parameters = cache.load(key)
+    if parameters is not None:
+        return parameters, True
+
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix=mol_name + '_', dir=file_path)
+    try:
+        os.chdir(work_dir)
+        ligand = MutatedLigand(file_path=file_path, mol_name=mol_name, net_charge=net_charge, gaff=gaff_ver)
+        if mute is None:
+            parameters = ligand.get_parameters()
+        else:
+            parameters = ligand.get_parameters(mute)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    cache.save(key, parameters)
+    return parameters, False
+
+
+def parametrize_ligands(cache_path, file_path, mol_names, net_charge, gaff_ver, mutes, num_workers):
+    '''
+    Parametrise mol2 files in file_path over a pool of processes, reusing cached parameters.
+    :param mol_names: names of the mol2 files without extension
+    :param mutes: atoms removed by each mutation passed to get_parameters
+    :return: list of ligand parameters in the order of mol_names
+    '''
+    # absolute so workers can change directory, keeping the trailing separator as Fluorify builds file names
+    # by appending the mol name to the folder
+    file_path = os.path.join(os.path.abspath(file_path), '')
+    cache_path = os.path.abspath(cache_path)
+    cache = LigandCache(cache_path)
+    keys = [cache.key(os.path.join(file_path, name + '.mol2'), net_charge, gaff_ver, mute)
+            for name, mute in zip(mol_names, mutes)]
+    # identical mutants are only parametrised once
+    tasks = {}
+    for key, name, mute in zip(keys, mol_names, mutes):
+        if key not in tasks:
+            tasks[key] = [cache_path, key, file_path, name, net_charge, gaff_ver, mute]
+    tasks = list(tasks.values())
+    num_workers = max(1, min(num_workers, len(tasks)))
+    pool = mp.get_context('spawn').Pool(num_workers)
+    try:
+        results = pool.map(parametrize_ligand, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    cached = sum(1 for x in results if x[1])
+    print('Parametrized {} unique ligands, {} found in cache {}'.format(len(results), cached, cache_path))
+    parameters = {task[1]: result[0] for task, result in zip(tasks, results)}
+    return [parameters[key] for key in keys]
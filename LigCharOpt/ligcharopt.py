@@ -5,9 +5,18 @@ from Fluorify.mol2 import *
 from Fluorify.mutants import *
 from Fluorify.fluorify import *
 from .optimize import Optimize
+from .ligands import parametrize_ligands
+from .schedule import run_legs
+from .subsystem import LigandEnergy
+from .potential import exp_average, exp_error, effective_sample_size, bar, strip_unit
+from .sigma import energy_value
+from .parameters import ParameterModel
+from .frames import get_frame_store
+from .decorrelate import interaction_energy, decorrelated_indices
 
 import os
 import time
+import json
 import shutil
 from simtk import unit
 import logging
@@ -16,11 +25,24 @@ logger = logging.getLogger(__name__)
 
 #CONSTANTS
 e = unit.elementary_charges
+ee = e*e
+nm = unit.nanometer
+# smallest effective sample size, as a fraction of the frames, of the forward batch estimate before the mutant
+# end state is sampled
+BATCH_MIN_ESS = 0.1
+# largest BAR error in kcal/mol of a batch estimate before a mutant is run with full FEP
+BATCH_MAX_ERROR = 1.0
 
 class LigCharOpt(object):
     def __init__(self, output_folder, mol_name, ligand_name, net_charge, complex_name, solvent_name, job_type,
                  auto_select, c_atom_list, h_atom_list, o_atom_list, num_frames, param, gaff_ver, opt, num_gpu,
-                 num_fep, equi, central_diff, opt_name, opt_steps, rmsd, exclude_dualtopo, lock_atoms, systems):
+                 num_fep, equi, central_diff, opt_name, opt_steps, rmsd, exclude_dualtopo, lock_atoms, systems,
+                 grad_chunk=None, num_workers=None, analytic_sigma=True, ligand_energy=True,
+                 potential_cache=True, ligand_cache=None, resume=False, re_equi=None, target_error=None, max_frames=None,
+                 decorrelate=False, line_search='fep', min_ess=0.1,
+                 spsa_samples=None, symmetry=False, active_top=None, min_contacts=None, evaluations=None,
+                 surrogate_error=None, prescreen_top=None, prescreen_cutoff=None,
+                 batch_fep=False):
 
         self.output_folder = output_folder
         self.net_charge = net_charge
@@ -28,11 +50,27 @@ class LigCharOpt(object):
         self.num_frames = num_frames
         self.gaff_ver = gaff_ver
         self.num_fep = int(num_fep)
+        self.num_workers = num_workers
+        self.num_gpu = num_gpu
+        # scans estimate every mutant by reweighting the wild type trajectories and only run FEP on the best
+        self.prescreen_top = prescreen_top
+        self.prescreen_cutoff = prescreen_cutoff
+        prescreen = prescreen_top is not None or prescreen_cutoff is not None
+        # scans sample the wild type once and every mutant at its end state instead of a FEP per mutant
+        self.batch_fep = batch_fep
+        self.equi = equi
+        self.reweighted_ddg = {}
+        self.batch_ddg = {}
+        self.fep_ddg = {}
 
         # Prepare directories/files and read in ligand from mol2 file
         mol_file = mol_name + '.mol2'
         input_folder = './input/'
 
+        if ligand_cache is None:
+            ligand_cache = input_folder + 'ligand_cache/'
+        self.ligand_cache = ligand_cache
+
         complex_sim_dir = input_folder + complex_name + '/'
         solvent_sim_dir = input_folder + solvent_name + '/'
 
@@ -84,7 +122,8 @@ class LigCharOpt(object):
             else:
                 run_dynamics = True
         else:
-            run_dynamics = False
+            # wild type trajectories are needed to reweight from when prescreening
+            run_dynamics = prescreen or batch_fep
 
         #COMPLEX
         self.complex_sys = []
@@ -93,6 +132,9 @@ class LigCharOpt(object):
                                      opt=opt, exclude_dualtopo=exclude_dualtopo, system=systems.complex))
         self.complex_sys.append([complex_sim_dir + complex_name + '.dcd'])
         self.complex_sys.append(complex_sim_dir + complex_name + '.pdb')
+        self.complex_sys.append(systems.complex)
+        self.complex_sys.append(self.complex_offset)
+        self.complex_sys.append(None)
         if run_dynamics:
             if not os.path.isfile(self.complex_sys[1][0]):
                 self.complex_sys[1] = [complex_sim_dir + complex_name + '_gpu' + str(x) + '.dcd' for x in range(num_gpu)]
@@ -108,6 +150,9 @@ class LigCharOpt(object):
                                      opt=opt, exclude_dualtopo=exclude_dualtopo, system=systems.solvent))
         self.solvent_sys.append([solvent_sim_dir + solvent_name + '.dcd'])
         self.solvent_sys.append(solvent_sim_dir + solvent_name + '.pdb')
+        self.solvent_sys.append(systems.solvent)
+        self.solvent_sys.append(self.solvent_offset)
+        self.solvent_sys.append(None)
         if run_dynamics:
             if not os.path.isfile(self.solvent_sys[1][0]):
                 self.solvent_sys[1] = [solvent_sim_dir + solvent_name + '_gpu' + str(x) + '.dcd' for x in range(num_gpu)]
@@ -119,7 +164,13 @@ class LigCharOpt(object):
 
         if opt:
             Optimize(wt_ligand, self.complex_sys, self.solvent_sys, output_folder, self.num_frames, equi, opt_name, opt_steps,
-                     param, central_diff, self.num_fep, rmsd, self.mol, lock_atoms)
+                     param, central_diff, self.num_fep, rmsd, self.mol, lock_atoms, grad_chunk=grad_chunk,
+                     num_workers=num_workers, analytic_sigma=analytic_sigma, ligand_energy=ligand_energy,
+                     potential_cache=potential_cache, num_gpu=num_gpu, resume=resume, re_equi=re_equi, target_error=target_error,
+                     max_frames=max_frames, decorrelate=decorrelate, line_search=line_search, min_ess=min_ess,
+                     spsa_samples=spsa_samples, symmetry_file=input_folder + mol_file if symmetry else None,
+                     active_top=active_top, min_contacts=min_contacts, evaluations=evaluations,
+                     surrogate_error=surrogate_error)
         else:
             LigCharOpt.fep(self, wt_ligand, auto_select, c_atom_list, h_atom_list, o_atom_list)
 
@@ -132,34 +183,35 @@ class LigCharOpt(object):
 
         """
         Write Mol2 files with substitutions of selected atoms.
-        Run antechamber and tleap on mol2 files to get prmtop.
+        Run antechamber and tleap on mol2 files to get prmtop, over a pool of processes
+        and skipping any molecule already in the ligand cache.
         Create OpenMM systems of ligands from prmtop files.
         Extract ligand parameters from OpenMM systems.
         """
         print('Parametrize mutant ligands...')
         t0 = time.time()
 
-        mutated_ligands = []
+        mol_names = []
         for index, sys in enumerate(mutated_systems):
             mol_name = 'molecule'+str(index)
             Mol2.write_mol2(sys, self.output_folder, mol_name)
-            mutated_ligands.append(MutatedLigand(file_path=self.output_folder, mol_name=mol_name,
-                                                 net_charge=self.net_charge, gaff=self.gaff_ver))
+            mol_names.append(mol_name)
 
         wt_parameters = wt_ligand.get_parameters()
-        mutant_parameters = []
-        for i, ligand in enumerate(mutated_ligands):
-            mute = mutations[i]['subtract']
-            mutant_parameters.append(ligand.get_parameters(mute))
+        num_workers = self.num_workers if self.num_workers else os.cpu_count()
+        mutes = [x['subtract'] for x in mutations]
+        mutant_parameters = parametrize_ligands(self.ligand_cache, self.output_folder, mol_names, self.net_charge,
+                                                self.gaff_ver, mutes, num_workers)
+        print('Took {} seconds'.format(time.time() - t0))
 
         #last entry of mutant is wildtype
         mutant_parameters.append(wt_parameters)
         mutations.append({'add': [], 'subtract': [], 'replace': [None], 'replace_insitu': [None]})
 
         mutant_params = Mutants(mutant_parameters, mutations, self.complex_sys[0], self.solvent_sys[0])
-        del mutant_parameters
 
-        t0 = time.time()
+        phase_costs = [x[3].getNumParticles() for x in [self.complex_sys, self.solvent_sys]]
+        mutant_names = []
         for i, mut in enumerate(mutant_params.complex_params[:-1]):
             atom_names = []
             replace = mutations[i]['replace']
@@ -167,12 +219,220 @@ class LigCharOpt(object):
             for atom in replace:
                 atom_index = int(atom)-1
                 atom_names.append(self.mol2_ligand_atoms[atom_index])
-            complex_dg, complex_error = self.complex_sys[0].run_parallel_fep(mutant_params, 0, i, 20000, 50, 12)
-            solvent_dg, solvent_error = self.solvent_sys[0].run_parallel_fep(mutant_params, 1, i, 20000, 50, 12)
+            mutant_names.append(atom_names)
+
+        selected = range(len(mutant_names))
+        if self.prescreen_top is not None or self.prescreen_cutoff is not None:
+            selected = LigCharOpt.prescreen(self, mutant_params, mutant_names, phase_costs)
+        if self.batch_fep:
+            selected = LigCharOpt.batch(self, wt_parameters, mutant_parameters, mutant_params, mutant_names, selected,
+                                        phase_costs)
+        del mutant_parameters
+
+        t0 = time.time()
+        for i in selected:
+            atom_names = mutant_names[i]
+            legs = [[self.complex_sys[0], 'run_parallel_fep', (mutant_params, 0, i, 20000, 50, 12), {}],
+                    [self.solvent_sys[0], 'run_parallel_fep', (mutant_params, 1, i, 20000, 50, 12), {}]]
+            (complex_dg, complex_error), (solvent_dg, solvent_error) = run_legs(legs, phase_costs, self.num_gpu)
+            if complex_dg is False or solvent_dg is False:
+                print('Found NaN in FEP of mutant {}'.format(atom_names))
+                continue
             ddg_fep = complex_dg - solvent_dg
             ddg_error = (complex_error**2+solvent_error**2)**0.5
             print('Mutant {}:'.format(atom_names))
             print('ddG FEP = {} +- {}'.format(ddg_fep, ddg_error))
+            self.fep_ddg[i] = [ddg_fep, ddg_error]
+            LigCharOpt.write_scan_results(self, mutant_names)
         t1 = time.time()
         print('Took {} seconds'.format(t1 - t0))
+        LigCharOpt.write_scan_results(self, mutant_names)
+
+    def write_scan_results(self, mutant_names):
+        """
+        Write the ddG of every mutant estimated so far to scan_results.json in the output folder, with the best
+        mutant by FEP or batch FEP, or by the reweighted prescreen if no mutant has been run with either
+        """
+        mutants = []
+        for method, estimates in [['fep', self.fep_ddg], ['batch', self.batch_ddg],
+                                  ['reweight', {i: [x, None] for i, x in self.reweighted_ddg.items()}]]:
+            for i, (ddg, ddg_error) in sorted(estimates.items()):
+                if any(x['index'] == i for x in mutants):
+                    continue
+                mutants.append({'index': i, 'mutant': list(mutant_names[i]), 'method': method,
+                                'ddG': float(strip_unit(ddg, unit.kilocalories_per_mole)),
+                                'error': None if ddg_error is None else
+                                float(strip_unit(ddg_error, unit.kilocalories_per_mole))})
+        ranked = [x for x in mutants if x['method'] != 'reweight'] or mutants
+        summary = {'mutants': mutants, 'best': min(ranked, key=lambda x: x['ddG']) if len(ranked) > 0 else None}
+        with open(os.path.join(self.output_folder, 'scan_results.json'), 'w') as f:
+            json.dump(summary, f, indent=1)
+
+    def prescreen(self, mutant_params, mutant_names, phase_costs):
+        """
+        Estimate the ddG of every mutant by one sided exponential averaging over the wild type trajectories
+        and select the mutants for FEP, the prescreen_top lowest and or those below prescreen_cutoff
+        :return: indices of the selected mutants
+        """
+        print('Prescreening {} mutants by reweighting wild type trajectories...'.format(len(mutant_names)))
+        t0 = time.time()
+        ddg = LigCharOpt.reweight_mutants(self, mutant_params, range(len(mutant_names)), phase_costs)
+        rank = sorted(range(len(mutant_names)), key=lambda i: ddg[i])
+        for i in rank:
+            print('Mutant {}: ddG reweighted = {}'.format(mutant_names[i], ddg[i]))
+        selected = rank
+        if self.prescreen_top is not None:
+            selected = selected[:self.prescreen_top]
+        if self.prescreen_cutoff is not None:
+            selected = [i for i in selected if ddg[i] <= self.prescreen_cutoff]
+        print('Took {} seconds, running FEP on {} of {} mutants'.format(time.time() - t0, len(selected),
+                                                                       len(mutant_names)))
+        return sorted(selected)
+
+    def reweight_mutants(self, mutant_params, indices, phase_costs):
+        """
+        ddG of mutants by one sided exponential averaging over the wild type trajectories, energies of all
+        mutants are evaluated in one pass over each trajectory. Estimates are kept so they are only computed once.
+        :return: dictionary of ddG in kcal/mol by mutant index
+        """
+        indices = [i for i in indices if i not in self.reweighted_ddg]
+        if len(indices) > 0:
+            # the wild type is the last entry of the mutant parameters and is the reference state
+            complex_params = [mutant_params.complex_params[i] for i in indices] + [mutant_params.complex_params[-1]]
+            solvent_params = [mutant_params.solvent_params[i] for i in indices] + [mutant_params.solvent_params[-1]]
+            legs = [[self.complex_sys[0], 'treat_phase', (complex_params, self.complex_sys[1],
+                                                          self.complex_sys[2], self.num_frames), {}],
+                    [self.solvent_sys[0], 'treat_phase', (solvent_params, self.solvent_sys[1],
+                                                          self.solvent_sys[2], self.num_frames), {}]]
+            complex_dg, solvent_dg = run_legs(legs, phase_costs, self.num_gpu)
+            for i, x, y in zip(indices, complex_dg, solvent_dg):
+                self.reweighted_ddg[i] = (x - y) / unit.kilocalories_per_mole
+        return self.reweighted_ddg
+
+    def batch(self, wt_parameters, mutant_parameters, mutant_params, mutant_names, selected, phase_costs):
+        """
+        ddG of mutants from one shared sampling of the wild type. The nonbonded energy change of every mutant is
+        evaluated frame by frame over the wild type trajectories from the terms involving ligand atoms, and the
+        forward exponential average is kept if its effective sample size is at least BATCH_MIN_ESS in both phases
+        and its error at most BATCH_MAX_ERROR. The other mutants are sampled at their own end state and estimated
+        by BAR from the forward and reverse energy changes. Mutants whose BAR error is above BATCH_MAX_ERROR, whose
+        nonbonded parameters do not map onto the wild type atoms or carry no epsilons, are left for full FEP.
+        Changes of bonded terms are not included in the batch energies.
+        :return: indices of the mutants needing full FEP
+        """
+        print('Batch FEP of {} mutants from shared wild type sampling...'.format(len(selected)))
+        t0 = time.time()
+        wt_vector, wt_epsilons = nonbonded_vector(wt_parameters)
+        num_atoms = len(wt_vector) // 2
+        fallback = [i for i in selected if len(nonbonded_vector(mutant_parameters[i])[0]) != 2 * num_atoms]
+        for i in fallback:
+            print('Mutant {} changes the number of ligand atoms, running full FEP'.format(mutant_names[i]))
+        # changes of the LJ well depth can only be evaluated if the parameters carry epsilons
+        no_epsilons = [i for i in selected if i not in fallback and
+                       (wt_epsilons is None or nonbonded_vector(mutant_parameters[i])[1] is None)]
+        for i in no_epsilons:
+            print('Mutant {} parameters carry no epsilons, running full FEP'.format(mutant_names[i]))
+        fallback.extend(no_epsilons)
+        batch = [i for i in selected if i not in fallback]
+        if len(batch) == 0:
+            return sorted(fallback)
+        vectors, epsilons = zip(*[nonbonded_vector(mutant_parameters[i]) for i in batch])
+        for i in batch:
+            if bonded_terms(mutant_parameters[i]) != bonded_terms(wt_parameters):
+                print('Mutant {} changes bonded terms, which the batch estimate ignores'.format(mutant_names[i]))
+
+        # one pass over each wild type trajectory for every mutant
+        exceptions = exception_scales(wt_parameters)
+        phases = [self.complex_sys, self.solvent_sys]
+        forward = []
+        for phase in phases:
+            frames = LigCharOpt.get_frames(self, phase, phase[1], wt_vector, wt_epsilons)
+            engine = LigandEnergy(phase[3], frames, [x + phase[4] for x in range(num_atoms)], wt_vector, exceptions)
+            forward.append((engine.delta_energy(vectors, list(epsilons)) -
+                            engine.delta_energy([wt_vector], [wt_epsilons]), engine.kT))
+
+        poor = []
+        for k, i in enumerate(batch):
+            ddg = [exp_average(w[k], kT) for w, kT in forward]
+            ddg_error = sum(exp_error(w[k], kT)**2 for w, kT in forward)**0.5
+            ess = min(effective_sample_size(w[k], kT) for w, kT in forward)
+            if ess < BATCH_MIN_ESS or ddg_error > BATCH_MAX_ERROR:
+                print('Mutant {}: effective sample size {:.3f} of frames, forward error {:.3f} kcal/mol, '
+                      'sampling end state'.format(mutant_names[i], ess, ddg_error))
+                poor.append(k)
+                continue
+            self.batch_ddg[i] = [ddg[0] - ddg[1], ddg_error]
+            print('Mutant {}:'.format(mutant_names[i]))
+            print('ddG batch = {} +- {} (forward, effective sample size {:.3f})'.format(ddg[0] - ddg[1], ddg_error,
+                                                                                     ess))
+
+        for k in poor:
+            i = batch[k]
+            name = 'mutant{}'.format(i)
+            legs = [[phase[0], 'run_parallel_dynamics', (self.output_folder, phase_name + '_' + name, self.num_frames,
+                                                         self.equi, params[i]), {}]
+                    for phase, phase_name, params in zip(phases, ['complex', 'solvent'],
+                                                         [mutant_params.complex_params, mutant_params.solvent_params])]
+            dcds = run_legs(legs, phase_costs, self.num_gpu)
+            dg = []
+            for phase, dcd, (w, kT) in zip(phases, dcds, forward):
+                frames = LigCharOpt.get_frames(self, phase, dcd, vectors[k], epsilons[k])
+                engine = LigandEnergy(phase[3], frames, [x + phase[4] for x in range(num_atoms)], vectors[k],
+                                      exceptions)
+                reverse = engine.delta_energy([wt_vector], [wt_epsilons])[0] - \
+                          engine.delta_energy([vectors[k]], [epsilons[k]])[0]
+                dg.append(bar(w[k], reverse, kT))
+            ddg = dg[0][0] - dg[1][0]
+            ddg_error = (dg[0][1]**2 + dg[1][1]**2)**0.5
+            print('Mutant {}:'.format(mutant_names[i]))
+            print('ddG batch = {} +- {} (BAR)'.format(ddg, ddg_error))
+            if ddg_error > BATCH_MAX_ERROR:
+                print('BAR error above {} kcal/mol, running full FEP'.format(BATCH_MAX_ERROR))
+                fallback.append(i)
+            else:
+                self.batch_ddg[i] = [ddg, ddg_error]
+        print('Took {} seconds, sampled {} of {} mutant end states'.format(time.time() - t0, len(poor), len(batch)))
+        return sorted(fallback)
+
+    def get_frames(self, phase, trajectory, params, epsilons):
+        """
+        Frames of a trajectory of a phase which are uncorrelated in the ligand interaction energy
+        :param params: concatenated [charges, sigmas] of the ligand the trajectory was sampled with
+        :param epsilons: ligand epsilons the trajectory was sampled with
+        """
+        frames = get_frame_store(trajectory, phase[2])
+        ligand_atoms = [x + phase[4] for x in range(len(self.mol2_ligand_atoms))]
+        indices, g = decorrelated_indices(interaction_energy(phase[3], frames, ligand_atoms, params, epsilons))
+        return frames.subset(indices)
+
+
+def nonbonded_vector(parameters):
+    """
+    :param parameters: ligand parameters in Mutants format
+    :return: concatenated [charges, sigmas] and epsilons in kcal/mol, None if the parameters carry no epsilons
+    """
+    charges = [strip_unit(x['data'][0], e) for x in parameters[0]]
+    sigmas = [strip_unit(x['data'][1], nm) for x in parameters[0]]
+    if any(len(x['data']) < 3 for x in parameters[0]):
+        return charges + sigmas, None
+    return charges + sigmas, [energy_value(x['data'][2]) for x in parameters[0]]
+
+
+def bonded_terms(parameters):
+    """
+    :param parameters: ligand parameters in Mutants format
+    :return: bond, angle and torsion parameters of the ligand for comparison between mutants
+    """
+    return [[[x['id'], str(x['data'])] for x in terms] for terms in parameters[2:5]]
+
 
+def exception_scales(parameters):
+    """
+    Exceptions of a ligand as (i, j, scale) taken by PotentialCache
+    """
+    nonbonded = [[strip_unit(x['data'][0], e), strip_unit(x['data'][1], nm)] for x in parameters[0]]
+    ids = [x['id'] for x in parameters[0]]
+    excep = [{'id': x['id'], 'data': [strip_unit(x['data'][0], ee), strip_unit(x['data'][1], nm)]}
+             for x in parameters[1]]
+    model = ParameterModel(parameters[0:2], nonbonded, ids, excep, parameters[2:5])
+    return list(zip(model.excep_i, model.excep_j, model.charge_scale))
@@ -7,22 +7,55 @@ from Fluorify.mutants import *
 from simtk import unit
 from scipy.optimize import minimize
 import copy
+import os
+import json
+import itertools
 import logging
 import numpy as np
 import math
 
 from Fluorify.fluorify import Fluorify
+from .potential import PotentialCache, exp_average, effective_sample_size, strip_unit
+from .parameters import ParameterModel
+from .parallel import GradientPool
+from .sigma import SigmaDerivative
+from .frames import get_frame_store
+from .subsystem import LigandEnergy, validation_params, validation_error, VALIDATION_TOLERANCE
+from .schedule import run_legs, get_devices, split_devices, share_devices
+from .checkpoint import Checkpoint, file_stamps
+from .dynamics import WarmDynamics
+from .sampling import gradient_error
+from .decorrelate import interaction_energy, decorrelated_indices
+from .symmetry import read_mol2, equivalent_atoms
+from .contacts import receptor_atoms, receptor_contacts, inactive_atoms
+from .evaluations import EvaluationStore, Surrogate, SURROGATE_MIN_POINTS
 
 logger = logging.getLogger(__name__)
 
 #CONSTANTS
+# finite difference step of the gradient
+FD_STEP = 1.5e-04
+# golden ratio of the bracketing line search
+GOLDEN = (1.0 + 5.0 ** 0.5) / 2.0
+# furthest the bracketing line search grows the step, in multiples of the first step
+BRACKET_EXPAND = 4.0
+# interpolation steps after the minimum is bracketed
+LINE_REFINE_STEPS = 2
+# number of steps kept by L-BFGS
+LBFGS_HISTORY = 5
+# shortest fraction of the quasi-Newton step tried before L-BFGS stops
+LBFGS_MIN_SCALE = 1.0 / 64
 e = unit.elementary_charges
 ee = e*e
 nm = unit.nanometer
 
 class Optimize(object):
     def __init__(self, wt_ligand, complex_sys, solvent_sys, output_folder, num_frames, equi, name, steps,
-                 param, central_diff, num_fep, rmsd, mol, lock_atoms):
+                 param, central_diff, num_fep, rmsd, mol, lock_atoms, grad_chunk=None, num_workers=None,
+                 analytic_sigma=True, ligand_energy=True, potential_cache=True, num_gpu=1, resume=False, re_equi=None,
+                 target_error=None, max_frames=None, decorrelate=False, line_search='fep', min_ess=0.1,
+                 spsa_samples=None, symmetry_file=None, active_top=None, min_contacts=None,
+                 evaluations=None, surrogate_error=None):
 
         self.complex_sys = complex_sys
         self.solvent_sys = solvent_sys
@@ -35,14 +68,23 @@ class Optimize(object):
         self.num_fep = num_fep
         self.rmsd = rmsd
         self.mol = mol
+        self.grad_chunk = grad_chunk
+        self.num_gpu = num_gpu
+        self.checkpoint = Checkpoint(os.path.join(output_folder, 'checkpoint.json'))
+        self.resume = resume
+        # legs run concurrently share the GPUs by system size
+        self.phase_costs = [x[3].getNumParticles() for x in [self.complex_sys, self.solvent_sys]]
 
         self.wt_parameters = wt_ligand.get_parameters()
         #Unused contains bond, angle and torsion parameters which are not optimized
         self.unused_params = self.wt_parameters[2:5]
         self.wt_parameters = self.wt_parameters[0:2]
         self.wt_nonbonded, self.wt_nonbonded_ids, self.wt_excep = Optimize.build_params(self)
-        self.excep_scaling = Optimize.get_exception_scaling(self)
+        self.param_model = ParameterModel(self.wt_parameters, self.wt_nonbonded, self.wt_nonbonded_ids,
+                                          self.wt_excep, self.unused_params)
 
+        if active_top is not None or min_contacts is not None:
+            lock_atoms = Optimize.lock_inactive(self, lock_atoms, active_top, min_contacts)
         if len(lock_atoms) > 0:
             self.lock_atoms = Optimize.make_lock_list(self, lock_atoms)
         else:
@@ -55,7 +97,78 @@ class Optimize(object):
         og_sigma = [x[1] for x in self.wt_nonbonded]
         self.og_all_params = og_charges + og_sigma
 
-        Optimize.optimize(self, name)
+        # chemically equivalent atoms found from the mol2 topology share their parameter changes
+        self.atom_groups = [[i] for i in range(self.num_atoms)]
+        if symmetry_file is not None:
+            types, bonds = read_mol2(symmetry_file)
+            if len(types) != self.num_atoms:
+                logger.warning('{} atoms in {} but ligand has {} parameters, '
+                               'not tying equivalent atoms'.format(len(types), symmetry_file, self.num_atoms))
+            else:
+                self.atom_groups = equivalent_atoms(types, bonds)
+                print('Tying {} ligand atoms into {} groups of equivalent atoms'.format(self.num_atoms,
+                                                                                     len(self.atom_groups)))
+
+        # charge only perturbations are reweighted from cached electrostatic potentials
+        self.use_potential_cache = potential_cache and 'sigma' not in self.param
+        self.potential_cache = None
+        self.sampled_params = self.og_all_params
+
+        # sigma components of the gradient are computed analytically from pair distances
+        self.analytic_sigma = analytic_sigma and 'sigma' in self.param
+        self.sigma_derivative = None
+
+        # sigma perturbations are evaluated from the terms involving ligand atoms only
+        self.use_ligand_energy = ligand_energy and 'sigma' in self.param
+        self.ligand_energy = None
+
+        # dynamics continue from the final state of the previous step, None runs the FSim dynamics every step
+        self.re_equi = re_equi
+        if re_equi is not None:
+            print('Warm started dynamics with {} re-equilibration steps replace the FSim dynamics'.format(re_equi))
+        self.warm_dynamics = [WarmDynamics(x[0], x[3], [y + x[4] for y in range(self.num_atoms)], self.param_model,
+                                           self.output_folder, name, resume)
+                              for x, name in zip([self.complex_sys, self.solvent_sys], ['complex', 'solvent'])]
+
+        # reweighting only evaluates uncorrelated frames
+        self.decorrelate = decorrelate
+
+        # adaptive sampling collects blocks of num_frames until the gradient direction is known to target_error
+        self.block_frames = num_frames
+        self.target_error = target_error
+        self.max_frames = max_frames if max_frames is not None else 10 * num_frames
+        if target_error is not None:
+            if re_equi is None:
+                raise ValueError('Adaptive sampling needs warm started dynamics')
+            if not self.use_potential_cache and not self.use_ligand_energy:
+                raise ValueError('Adaptive sampling needs the potential cache or ligand energy evaluation')
+
+        # line searches reweight the current trajectories, running FEP windows only if the overlap is poor
+        if line_search not in ['reweight', 'fep', 'golden']:
+            raise ValueError('Unknown line search {}'.format(line_search))
+        self.line_search = line_search
+        self.min_ess = min_ess
+
+        # estimate the gradient from simultaneous random perturbations of all parameters, None for finite difference
+        self.spsa_samples = spsa_samples
+        self.rng = np.random.default_rng()
+
+        # evaluations are stored by parameters and trajectories so repeated queries are not recomputed,
+        # line searches are predicted by a surrogate fitted to stored ddGs when it is certain to surrogate_error
+        if evaluations is None:
+            evaluations = os.path.join(output_folder, 'evaluations.jsonl')
+        self.evaluations = EvaluationStore(evaluations)
+        self.surrogate_error = surrogate_error
+
+        # shard perturbed energy evaluations over CPU workers, started on the first full system evaluation
+        self.num_workers = num_workers
+        self.gradient_pool = None
+
+        try:
+            Optimize.optimize(self, name)
+        finally:
+            if self.gradient_pool is not None:
+                self.gradient_pool.close()
 
     def make_lock_list(self, user_locked_atoms):
         assert min(user_locked_atoms) > 0
@@ -81,30 +194,39 @@ class Optimize(object):
         lock_atoms = list(set(lock_atoms))  # remove dups
         return sorted(lock_atoms)
 
-    def get_net_charge(self, wt_nonbonded):
-        return sum([x[0] for x in wt_nonbonded])
-
-    def translate_concat_to_atomwise(self, params):
+    def param_groups(self, indices):
         '''
-        Helper to translate concatenated params used by scipy in to atomwise lists of params
-        :return:
+        Split parameter indices into groups of tied parameters, the charges or sigmas of one group of
+        equivalent atoms. Indices missing from indices, e.g. locked parameters, are left out of the groups.
+        :return: list of lists of parameter indices
         '''
-        charge = params[:self.num_atoms]
-        sigma = params[self.num_atoms:self.num_atoms*2]
-        atomwise_params = [[x,y] for x,y in zip(charge, sigma)]
-
-        return atomwise_params
-
-    def translate_atomwise_to_mutant(self, atomwise, exceptions):
-        wt_nonbonded = copy.deepcopy(self.wt_parameters[0])
-        for new_atom, old_atom in zip(atomwise, wt_nonbonded):
-            old_atom['data'] = [new_atom[0], new_atom[1]]
-        wt_excep = copy.deepcopy(self.wt_parameters[1])
-        for new_excep, old_excep in zip(exceptions, wt_excep):
-            assert old_excep['id'] == new_excep['id']
-            old_atom['data'] = new_excep['data']
+        indices = set(indices)
+        groups = []
+        for shift in [0, self.num_atoms]:
+            for group in self.atom_groups:
+                group = [x + shift for x in group if x + shift in indices]
+                if len(group) > 0:
+                    groups.append(group)
+        return groups
+
+    def lock_inactive(self, user_locked_atoms, top, min_contacts):
+        '''
+        Add ligand atoms which make few contacts with the receptor over the complex trajectory to the locked atoms
+        :param user_locked_atoms: atoms locked by the user indexed from 1
+        :param top: number of atoms with the most contacts left unlocked, None for no limit
+        :param min_contacts: fewest receptor heavy atoms within CONTACT_CUTOFF on average for an atom to be unlocked
+        :return: locked atoms indexed from 1
+        '''
+        ligand_atoms = [x + self.complex_sys[4] for x in range(len(self.wt_nonbonded))]
+        frames = get_frame_store(self.complex_sys[1], self.complex_sys[2])
+        contacts = receptor_contacts(frames, receptor_atoms(self.complex_sys[2], ligand_atoms), ligand_atoms)
+        inactive = inactive_atoms(contacts, top, min_contacts)
+        print('Receptor contacts of ligand atoms: {}'.format(np.round(contacts, 2)))
+        print('Locking {} of {} ligand atoms with few receptor contacts'.format(len(inactive), len(ligand_atoms)))
+        return sorted(set(user_locked_atoms) | set([x + 1 for x in inactive]))
 
-        return [wt_nonbonded, wt_excep]
+    def get_net_charge(self, wt_nonbonded):
+        return sum([x[0] for x in wt_nonbonded])
 
     def build_params(self):
         '''
@@ -119,53 +241,6 @@ class Optimize(object):
         wt_excep = [{'id': x['id'], 'data': [x['data'][0]/ee, x['data'][1]/nm]} for x in wt_excep]
         return wt_nonbonded, wt_nonbonded_ids, wt_excep
 
-    def get_exception_scaling(self):
-        exceptions = copy.deepcopy(self.wt_excep)
-        #Charge scaling
-        nonbonded = {x: y[0] for (x, y) in zip(self.wt_nonbonded_ids, self.wt_nonbonded)}
-        for product in exceptions:
-            ids = list(product['id'])
-            id0 = ids[0]
-            id1 = ids[1]
-            param0 = nonbonded[id0]
-            param1 = nonbonded[id1]
-            product['data'][0] = product['data'][0]/(param0*param1)
-        #Sigma scaling
-        nonbonded = {x: y[1] for (x, y) in zip(self.wt_nonbonded_ids, self.wt_nonbonded)}
-        for product in exceptions:
-            ids = list(product['id'])
-            id0 = ids[0]
-            id1 = ids[1]
-            param0 = nonbonded[id0]
-            param1 = nonbonded[id1]
-            product['data'][1] = product['data'][1]/((param0+param1)/2)
-
-        return exceptions
-
-    def get_exception_params(self, params):
-        new_charge_product = copy.deepcopy(self.excep_scaling)
-        # Charge scaling
-        nonbonded = {x: y[0] for (x, y) in zip(self.wt_nonbonded_ids, params)}
-        for product in new_charge_product:
-            ids = list(product['id'])
-            id0 = ids[0]
-            id1 = ids[1]
-            param0 = nonbonded[id0]
-            param1 = nonbonded[id1]
-            product['data'][0] = product['data'][0] * (param0 * param1)
-        # Sigma scaling
-        nonbonded = {x: y[1] for (x, y) in zip(self.wt_nonbonded_ids, params)}
-        for product in new_charge_product:
-            ids = list(product['id'])
-            id0 = ids[0]
-            id1 = ids[1]
-            param0 = nonbonded[id0]
-            param1 = nonbonded[id1]
-            product['data'][1] = product['data'][1] * ((param0 + param1) / 2)
-
-        return new_charge_product
-
-
     def optimize(self, name):
         """
         optimising ligand params
@@ -186,6 +261,13 @@ class Optimize(object):
         elif name == 'scipy':
             opt_params, ddg_opt = Optimize.scipy(self)
 
+        elif name == 'lbfgs':
+            if 'sigma' in self.param:
+                max_step_size = 0.6
+            else:
+                max_step_size = 0.4
+            opt_params, ddg_opt = Optimize.lbfgs(self, max_step_size)
+
         elif name == 'FEP_only':
             with open('./params_opt', 'r') as f:
                 opt_params = []
@@ -194,9 +276,9 @@ class Optimize(object):
         elif name == 'grad_convg':
             for replica in range(1, 4, 1):
                 for sampling in range(100, 1100, 100):
-                    self.num_frames = sampling
                     print('Computing replica {} dynamics with {} steps'.format(replica, sampling))
-                    self.run_dynamics(self.og_all_params)
+                    # every replica is independent so starts from the input structures
+                    self.run_dynamics(self.og_all_params, num_frames=sampling, fresh=True)
                     grad = gradient(copy.deepcopy(self.og_all_params), 1, self)  # 1 here is a dummy variable
                     print(grad)
             print('Finished grad convergence test')
@@ -216,21 +298,22 @@ class Optimize(object):
             Mol2.write_mol2(self.mol, './', 'opt_lig_sigma', charges=param_diff[len(self.wt_nonbonded):])
             Mol2.write_mol2(self.mol, './', 'opt_lig_charge', charges=param_diff[:len(self.wt_nonbonded)])
 
-        for replica in range(self.num_fep):
+        if name == 'FEP_only':
+            windows = 24
+            sampling = 900
+            #long
+            convg = range(100, 1000, 100)
+        else:
+            windows = 12
+            sampling = 350
+            #quick
+            convg = range(50, 400, 50)
+        replicas = Optimize.run_fep_replicas(self, self.og_all_params, opt_params, 2500, sampling, windows,
+                                             self.num_fep, convg=convg)
+        for replica, (ddg_fep, ddg_fep_error) in enumerate(replicas):
             print('Replica {}/{}'.format(replica+1, self.num_fep))
-            if name == 'FEP_only':
-                windows = 24
-                sampling = 900
-                #long
-                convg = range(100, 1000, 100)
-            else:
-                windows = 12
-                sampling = 350
-                #quick
-                convg = range(50, 400, 50)
-            ddg_fep, ddg_fep_error = Optimize.run_fep(self, self.og_all_params, opt_params, 2500,
-                                                      sampling, windows, convg=convg)
             print('Sampling {}: ddG FEP = {} +- {}'.format(sampling, ddg_fep, ddg_fep_error))
+        Optimize.summarize_replicas(self, replicas, list(convg))
 
         if name != 'FEP_only':
             if name == 'grad_decent_fep':
@@ -238,22 +321,27 @@ class Optimize(object):
             else:
                 print('ddG opt = {0}'.format(ddg_opt))
 
-    def run_fep(self, start_params, end_params, n_steps, n_iterations, windows, return_dg_matrix=False, convg=False):
-
-        mutant = [self.process_mutant(end_params),  self.process_mutant(start_params)]
+    def fep_legs(self, start_params, end_params, n_steps, n_iterations, windows, fep_args):
+        '''
+        :return: complex and solvent legs of a FEP calculation from start_params to end_params for run_legs
+        '''
+        mutant = self.process_mutants([end_params, start_params])
         mutation = [gen_mutations_dicts(), gen_mutations_dicts()]
 
         mutant_params = Mutants(mutant, mutation, self.complex_sys[0], self.solvent_sys[0])
 
-        complex_dg, complex_error = self.complex_sys[0].run_parallel_fep(mutant_params, 0, 0, n_steps, n_iterations,
-                                                                         windows, return_dg_matrix=return_dg_matrix, convg=convg)
+        return [[self.complex_sys[0], 'run_parallel_fep', (mutant_params, 0, 0, n_steps, n_iterations, windows), fep_args],
+                [self.solvent_sys[0], 'run_parallel_fep', (mutant_params, 1, 0, n_steps, n_iterations, windows), fep_args]]
+
+    def run_fep(self, start_params, end_params, n_steps, n_iterations, windows, return_dg_matrix=False, convg=False):
+
+        fep_args = {'return_dg_matrix': return_dg_matrix, 'convg': convg}
+        legs = Optimize.fep_legs(self, start_params, end_params, n_steps, n_iterations, windows, fep_args)
+        (complex_dg, complex_error), (solvent_dg, solvent_error) = run_legs(legs, self.phase_costs, self.num_gpu)
         if complex_dg is False:
             print('Found NaN in FEP for complex')
             return False, False, False, False
 
-
-        solvent_dg, solvent_error = self.solvent_sys[0].run_parallel_fep(mutant_params, 1, 0, n_steps, n_iterations,
-                                                                         windows, return_dg_matrix=return_dg_matrix, convg=convg)
         if solvent_dg is False:
             print('Found NaN in FEP for solvent')
             return False, False, False, False
@@ -268,20 +356,519 @@ class Optimize(object):
 
         return ddg_fep, ddg_error
 
-    def run_dynamics(self, all_params):
+    def run_fep_replicas(self, start_params, end_params, n_steps, n_iterations, windows, num_replicas, convg=False):
+        '''
+        Independent FEP replicas all run at the same time, the GPUs are split between the replicas, which
+        share them round robin if there are more replicas than GPUs, then between the complex and solvent
+        leg of each replica. Every leg runs in its own process so each replica draws its own random seeds.
+        :return: list of [ddG, error] of each replica, [None, None] for replicas which found NaN
+        '''
+        fep_args = {'return_dg_matrix': False, 'convg': convg}
+        legs = Optimize.fep_legs(self, start_params, end_params, n_steps, n_iterations, windows, fep_args)
+        devices = get_devices(self.num_gpu)
+        leg_devices = None
+        if len(devices) > 0:
+            leg_devices = [x for replica in share_devices(devices, num_replicas)
+                           for x in split_devices(replica, self.phase_costs)]
+        print('Running {} FEP replicas'.format(num_replicas))
+        results = run_legs(legs * num_replicas, self.phase_costs * num_replicas, self.num_gpu, leg_devices)
+        replicas = []
+        for (complex_dg, complex_error), (solvent_dg, solvent_error) in zip(results[0::2], results[1::2]):
+            if complex_dg is False or solvent_dg is False:
+                print('Found NaN in FEP replica')
+                replicas.append([None, None])
+            else:
+                replicas.append([complex_dg - solvent_dg, (complex_error ** 2 + solvent_error ** 2) ** 0.5])
+        return replicas
 
-        mutant = [self.process_mutant(all_params)]
-        mutation = [gen_mutations_dicts()]
+    def summarize_replicas(self, replicas, convg):
+        '''
+        Print the mean and spread of the FEP replicas and write every replica to fep_replicas.json in the
+        output folder. With a convergence series the statistics are over each point of the series.
+        '''
+        finished = [[np.asarray(strip_unit(x, unit.kilocalories_per_mole)) for x in replica]
+                    for replica in replicas if replica[0] is not None]
+        summary = {'convg': convg, 'replicas': [[x.tolist() for x in replica] for replica in finished]}
+        if len(finished) > 0:
+            ddg = np.array([x[0] for x in finished])
+            summary['mean'] = np.mean(ddg, axis=0).tolist()
+            summary['spread'] = np.std(ddg, axis=0).tolist()
+            summary['error'] = (np.std(ddg, axis=0) / len(ddg) ** 0.5).tolist()
+            print('ddG FEP over {} replicas = {} +- {} spread {}'.format(len(finished), summary['mean'],
+                                                                       summary['error'], summary['spread']))
+        with open(os.path.join(self.output_folder, 'fep_replicas.json'), 'w') as f:
+            json.dump(summary, f, indent=1)
+
+    def run_dynamics(self, all_params, num_frames=None, fresh=False):
+        '''
+        :param num_frames: frames to collect, or per block when sampling adaptively, default num_frames
+                           the optimisation was set up with
+        :param fresh: start from the input structures rather than continuing the last dynamics, e.g. for
+                      independent replicas
+        '''
+        if num_frames is None:
+            num_frames = self.block_frames
+        warm = self.re_equi is not None and not fresh
+        if warm and not all(x.seeded(y[1]) for x, y in zip(self.warm_dynamics, [self.complex_sys, self.solvent_sys])):
+            print('No previous dynamics to continue from, starting from the input structures...')
+            warm = False
+        if warm:
+            #continue from the end of the last dynamics with a short re-equilibration
+            self.complex_sys[1], self.solvent_sys[1] = Optimize.sample_blocks(self, all_params, num_frames)
+        else:
+            mutant = [self.process_mutant(all_params)]
+            mutation = [gen_mutations_dicts()]
+
+            mutant_params = Mutants(mutant, mutation, self.complex_sys[0], self.solvent_sys[0])
+
+            #run dynamics on built system passing arb q and sigma
+            legs = [[self.complex_sys[0], 'run_parallel_dynamics',
+                     (self.output_folder, 'complex', num_frames, self.equi, mutant_params.complex_params[0]), {}],
+                    [self.solvent_sys[0], 'run_parallel_dynamics',
+                     (self.output_folder, 'solvent', num_frames, self.equi, mutant_params.solvent_params[0]), {}]]
+            self.complex_sys[1], self.solvent_sys[1] = run_legs(legs, self.phase_costs, self.num_gpu)
+            self.num_frames = num_frames
+            # warm started dynamics continue from these trajectories rather than older saved states
+            for dynamics in self.warm_dynamics:
+                dynamics.reset()
+        self.complex_sys[5] = None
+        self.solvent_sys[5] = None
+        self.sampled_params = all_params
+        self.potential_cache = None
+        self.sigma_derivative = None
+        self.ligand_energy = None
+
+    def sample_blocks(self, all_params, block_frames):
+        '''
+        Warm started dynamics of both phases in blocks of block_frames frames. Without a target error one
+        block is run, otherwise blocks are added until the block bootstrap error of the gradient direction
+        falls below target_error or max_frames are collected.
+        :return: dcd files of the complex and solvent
+        '''
+        phases = [self.complex_sys, self.solvent_sys]
+        unlocked = [i for i in range(len(all_params)) if i not in self.lock_atoms]
+
+        def project(x):
+            full = np.zeros(len(all_params))
+            full[unlocked] = x
+            return constrain_net_charge(full, self.num_atoms, self.lock_atoms)[unlocked]
+
+        trajectories = [[], []]
+        derivatives = [[], []]
+        block = 0
+        while True:
+            equi = self.re_equi if block == 0 else 0
+            legs = [[dynamics, 'run', (all_params, phase[1], phase[2], block_frames, equi), {'block': block}]
+                    for dynamics, phase in zip(self.warm_dynamics, phases)]
+            dcds = run_legs(legs, self.phase_costs, self.num_gpu)
+            num_frames = block_frames * (block + 1)
+            for i, phase in enumerate(phases):
+                trajectories[i].extend(dcds[i])
+            if self.target_error is None:
+                break
+            for i, phase in enumerate(phases):
+                frames = get_frame_store(dcds[i], phase[2])
+                derivatives[i].append(Optimize.frame_derivatives(self, phase, frames, all_params, unlocked))
+            error = gradient_error(np.concatenate(derivatives[0]), np.concatenate(derivatives[1]), project)
+            print('Gradient direction error {} from {} frames'.format(error, num_frames))
+            if error <= self.target_error:
+                break
+            if num_frames + block_frames > self.max_frames:
+                print('Reached maximum of {} frames'.format(self.max_frames))
+                break
+            block += 1
+        self.num_frames = num_frames
+        return trajectories
 
-        mutant_params = Mutants(mutant, mutation, self.complex_sys[0], self.solvent_sys[0])
+    def frame_derivatives(self, phase, frames, all_params, indices):
+        '''
+        Derivative of the energy with respect to each parameter in indices for every frame
+        :return: array with shape (num_frames, len(indices)) in kcal/mol per parameter unit
+        '''
+        ligand_atoms = [x + phase[4] for x in range(self.num_atoms)]
+        exceptions = list(zip(self.param_model.excep_i, self.param_model.excep_j, self.param_model.charge_scale))
+        perturbed = list(perturbations(all_params, FD_STEP, indices))
+        current = np.array(all_params, dtype=np.float64)
+        if self.use_potential_cache:
+            engine = PotentialCache(phase[3], frames, ligand_atoms, current[:self.num_atoms], exceptions)
+            perturbed = [x[:self.num_atoms] for x in perturbed]
+            current = current[:self.num_atoms]
+        else:
+            engine = LigandEnergy(phase[3], frames, ligand_atoms, current, exceptions)
+        delta = engine.delta_energy(perturbed) - engine.delta_energy([current])
+        return (delta / FD_STEP).T
 
-        #run dynamics on built system passing arb q and sigma
-        self.complex_sys[1] = self.complex_sys[0].run_parallel_dynamics(self.output_folder, 'complex',
-                                                                        self.num_frames, self.equi,
-                                                                        mutant_params.complex_params[0])
-        self.solvent_sys[1] = self.solvent_sys[0].run_parallel_dynamics(self.output_folder, 'solvent',
-                                                                        self.num_frames, self.equi,
-                                                                        mutant_params.solvent_params[0])
+    def get_frames(self, phase):
+        '''
+        Frame store of the current trajectory of a phase, converted from the dcd files on first use.
+        If decorrelating, only frames which are uncorrelated in the ligand interaction energy are kept.
+        '''
+        if phase[5] is None:
+            frames = get_frame_store(phase[1], phase[2])
+            if self.decorrelate:
+                ligand_atoms = [x + phase[4] for x in range(self.num_atoms)]
+                energy = interaction_energy(phase[3], frames, ligand_atoms, self.sampled_params)
+                indices, g = decorrelated_indices(energy)
+                print('Statistical inefficiency {:.2f}, keeping {} of {} frames, effective sample size {:.1f}'.format(
+                    g, len(indices), frames.num_frames, frames.num_frames / g))
+                frames = frames.subset(indices)
+            phase[5] = frames
+        return phase[5]
+
+    def reweight_charges(self, perturbed_params, current_params):
+        '''
+        Free energy change of each set of perturbed charges from the current charges in both phases,
+        reweighted from the electrostatic potentials cached over the current trajectories
+        :return: lists of complex and solvent free energies
+        '''
+        Optimize.cache_potentials(self)
+        perturbed_charges = [x[:self.num_atoms] for x in perturbed_params]
+        current_charges = current_params[:self.num_atoms]
+        free_energy = []
+        for cache in self.potential_cache:
+            phase_free_energy = cache.free_energy(perturbed_charges, current_charges)
+            free_energy.append([x * unit.kilocalories_per_mole for x in phase_free_energy])
+        return free_energy
+
+    def cache_potentials(self):
+        if self.potential_cache is None:
+            print('Caching electrostatic potentials over trajectories...')
+            charges = self.sampled_params[:self.num_atoms]
+            exceptions = list(zip(self.param_model.excep_i, self.param_model.excep_j, self.param_model.charge_scale))
+            self.potential_cache = []
+            for phase in [self.complex_sys, self.solvent_sys]:
+                ligand_atoms = [x + phase[4] for x in range(self.num_atoms)]
+                self.potential_cache.append(PotentialCache(phase[3], self.get_frames(phase), ligand_atoms,
+                                                           charges, exceptions))
+
+    def reweight_line(self, start_params, end_params, windows):
+        '''
+        Score evenly spaced windows on the line from start_params to end_params by reweighting the current
+        trajectories instead of running FEP. The line is only trusted if the effective sample size of every
+        window in both phases is at least min_ess of the frames.
+        :return: free energy and error matrices of the complex and solvent in the layout run_fep returns
+                 with return_dg_matrix, None if the overlap is too poor or only full system energies are available
+        '''
+        start_params = np.array(start_params, dtype=np.float64)
+        end_params = np.array(end_params, dtype=np.float64)
+        line = [start_params + (end_params - start_params) * i / (windows - 1) for i in range(windows)]
+        sampled_params = np.array(self.sampled_params, dtype=np.float64)
+        if self.check_potential_cache():
+            engines = self.potential_cache
+            line = [x[:self.num_atoms] for x in line]
+            sampled_params = sampled_params[:self.num_atoms]
+        elif self.check_ligand_energy():
+            engines = self.ligand_energy
+        else:
+            return None
+
+        matrices = []
+        min_ess = 1.0
+        for engine in engines:
+            # each window is reweighted from the sampled parameters then referenced to the first window
+            delta_u = engine.delta_energy(line) - engine.delta_energy([sampled_params])
+            num_frames = delta_u.shape[1]
+            free_energy = exp_average(delta_u, engine.kT)
+            ess = effective_sample_size(delta_u, engine.kT)
+            # asymptotic error of the exponential average, kT^2 var(w)/(N <w>^2)
+            error = engine.kT * np.sqrt(np.maximum(1.0 / (ess * num_frames) - 1.0 / num_frames, 0.0))
+            if not np.all(np.isfinite(free_energy)):
+                return None
+            matrices.append(np.array([free_energy - free_energy[0]]))
+            matrices.append(np.array([(error**2 + error[0]**2) ** 0.5]))
+            min_ess = min(min_ess, float(np.min(ess)))
+        print('Reweighted line search, smallest effective sample size {:.3f} of frames'.format(min_ess))
+        if min_ess < self.min_ess:
+            print('Effective sample size below {}, running FEP windows'.format(self.min_ess))
+            return None
+        return tuple(matrices)
+
+    def bracket_line(self, all_params, direction, step_size, spacing, line_sampling, budget):
+        '''
+        Adaptive line search along -direction. The minimum is bracketed by growing the step by the golden ratio
+        then refined by parabolic interpolation, falling back to golden section. Each new point is reached by FEP
+        from the nearest point already evaluated and every window of the FEP is kept as a point of the line, so
+        later steps reuse them. The search stops when the next FEP would take the windows run past budget.
+        :param step_size: first trial step length
+        :param spacing: largest change in step length between FEP windows
+        :param budget: most FEP windows the search may run, no more than the fixed grid it replaces
+        :return: step length, ddG and error of the best point, step length 0 if no point lowers ddG
+        '''
+        all_params = np.array(all_params, dtype=np.float64)
+        direction = np.array(direction, dtype=np.float64)
+        points = {0.0: [0.0, 0.0]}
+        used = [0]
+
+        def evaluate(t):
+            '''
+            :return: ddG at step t, that of an evaluated point within half a spacing of t if there is one,
+                     None if the FEP would exceed the budget
+            '''
+            nearest = min(points, key=lambda x: abs(x - t))
+            if abs(nearest - t) < spacing / 2:
+                return points[nearest][0]
+            start = min([x for x in points if np.isfinite(points[x][0])], key=lambda x: abs(x - t))
+            windows = max(2, int(math.ceil(abs(t - start) / spacing)) + 1)
+            if used[0] + windows > budget:
+                print('Line search window budget of {} reached'.format(budget))
+                return None
+            used[0] += windows
+            c_dg, c_err, s_dg, s_err = Optimize.line_fep(self, all_params - start * direction,
+                                                         all_params - t * direction, line_sampling, windows)
+            if c_dg is False:
+                # treat a NaN as being past the end of the line
+                points[t] = [np.inf, 0.0]
+            else:
+                ddg = (c_dg - s_dg)[0]
+                error = ((c_err ** 2 + s_err ** 2) ** 0.5)[0]
+                for i in range(1, windows):
+                    x = t if i == windows - 1 else start + (t - start) * i / (windows - 1)
+                    points[x] = [points[start][0] + ddg[i], (points[start][1] ** 2 + error[i] ** 2) ** 0.5]
+            print('Line search step {} ddG = {} +- {}'.format(t, points[t][0], points[t][1]))
+            return points[t][0]
+
+        def best():
+            finite = sorted(x for x in points if np.isfinite(points[x][0]))
+            b = min(finite, key=lambda x: points[x][0])
+            return finite, finite.index(b)
+
+        # grow the step while the furthest point evaluated is the lowest
+        a, b = 0.0, step_size
+        evaluate(b)
+        while True:
+            finite, k = best()
+            if k != len(finite) - 1 or finite[k] == 0.0:
+                break
+            b = finite[k]
+            if b >= BRACKET_EXPAND * step_size:
+                print('Line search reached maximum step {}'.format(b))
+                break
+            c = min(b + GOLDEN * (b - a), b + (budget - used[0] - 1) * spacing)
+            if c < b + spacing / 2:
+                break
+            a = b
+            if evaluate(c) is None:
+                break
+
+        for i in range(LINE_REFINE_STEPS):
+            finite, k = best()
+            if k == 0 or k == len(finite) - 1:
+                break
+            a, b, c = finite[k-1:k+2]
+            if c - a <= 2 * spacing:
+                # already resolved to the window spacing
+                break
+            t = parabolic_minimum([a, b, c], [points[x][0] for x in [a, b, c]])
+            if t is None or not a < t < c or abs(t - b) < spacing / 2:
+                if c - b > b - a:
+                    t = b + (c - b) / GOLDEN ** 2
+                else:
+                    t = b - (b - a) / GOLDEN ** 2
+            if evaluate(t) is None:
+                break
+
+        finite, k = best()
+        b = finite[k]
+        print('Line search ran {} of {} windows'.format(used[0], budget))
+        if b == 0.0:
+            return 0.0, 0.0, 0.0
+        return b, points[b][0], points[b][1]
+
+    def trajectory_id(self):
+        '''
+        Identity of the current trajectories, reweighted evaluations are only reused from the same trajectories
+        '''
+        return [file_stamps(self.complex_sys[1]), file_stamps(self.solvent_sys[1]), self.decorrelate]
+
+    def line_fep(self, start_params, end_params, n_iterations, windows):
+        '''
+        run_fep along a line returning the free energy matrices, reusing a stored result for the same line
+        '''
+        key = [start_params, end_params, n_iterations, windows]
+        stored = self.evaluations.get('line_fep', *key)
+        if stored is not None:
+            print('Using stored FEP of line')
+            return tuple(np.array(x) for x in stored)
+        result = self.run_fep(start_params, end_params, 2500, n_iterations, windows, True)
+        if result[0] is not False:
+            self.evaluations.add('line_fep', [np.asarray(x).tolist() for x in result], *key)
+        return result
+
+    def store_line(self, start_params, end_params, ddg, ddg_error, line, line_err):
+        '''
+        Store the ddG of every window of a line search relative to the original parameters for the surrogate
+        :param ddg: ddG of start_params relative to the original parameters
+        '''
+        start_params = np.array(start_params, dtype=np.float64)
+        end_params = np.array(end_params, dtype=np.float64)
+        windows = len(line)
+        for i, (dg, err) in enumerate(zip(line, line_err)):
+            params = start_params + (end_params - start_params) * i / (windows - 1)
+            self.evaluations.add_point(self.og_all_params, params, ddg + dg, (ddg_error ** 2 + err ** 2) ** 0.5)
+
+    def surrogate_line(self, start_params, end_params, windows):
+        '''
+        Predict the windows of a line search from a Gaussian process fitted to the stored ddGs of this ligand
+        :return: free energy and error matrices in the layout run_fep returns with return_dg_matrix, with the
+                 binding free energy in the complex entries, None if there are too few stored points, the fit
+                 fails or any window is more uncertain than surrogate_error
+        '''
+        points = self.evaluations.get_points(self.og_all_params)
+        if len(points) < SURROGATE_MIN_POINTS:
+            return None
+        surrogate = Surrogate(*zip(*points))
+        if not surrogate.fitted:
+            print('Surrogate could not be fitted to {} points'.format(len(points)))
+            return None
+        start_params = np.array(start_params, dtype=np.float64)
+        end_params = np.array(end_params, dtype=np.float64)
+        line = [start_params + (end_params - start_params) * i / (windows - 1) for i in range(windows)]
+        mean, std = surrogate.predict(line)
+        print('Surrogate line search from {} points, largest uncertainty {} kcal/mol'.format(len(points), np.max(std)))
+        if np.max(std) > self.surrogate_error:
+            return None
+        zeros = np.zeros((1, windows))
+        return np.array([mean - mean[0]]), np.array([std]), zeros, zeros
+
+    def check_potential_cache(self):
+        '''
+        Cache the electrostatic potentials over the current trajectories and validate the cache against
+        the full system energy on a finite change of every charge, falling back to full system evaluations
+        if they disagree.
+        :return: True if the potential cache is in use
+        '''
+        if self.use_potential_cache and self.potential_cache is None:
+            Optimize.cache_potentials(self)
+            perturbed_params = validation_params(self.sampled_params, sigmas=False)
+            for phase, cache in zip([self.complex_sys, self.solvent_sys], self.potential_cache):
+                ligand_atoms = [x + phase[4] for x in range(self.num_atoms)]
+                error = validation_error(phase[3], self.get_frames(phase), ligand_atoms, self.param_model,
+                                         perturbed_params, self.sampled_params,
+                                         lambda x: cache.delta_energy([y[:self.num_atoms] for y in x]))
+                print('Potential cache deviation from full system: {:.2e} of the energy change'.format(error))
+                if error > VALIDATION_TOLERANCE:
+                    logger.warning('Potential cache deviates from full system by {:.2e} of the energy change, '
+                                   'using full system energies'.format(error))
+                    self.use_potential_cache = False
+                    self.potential_cache = None
+                    break
+        return self.use_potential_cache
+
+    def check_ligand_energy(self):
+        '''
+        Build the ligand energy evaluators for the current trajectories and validate them against the
+        full system energy on a finite change of every charge and sigma, falling back to full system
+        evaluations if they disagree.
+        :return: True if the ligand energy evaluators are in use
+        '''
+        if self.use_ligand_energy and self.ligand_energy is None:
+            exceptions = list(zip(self.param_model.excep_i, self.param_model.excep_j, self.param_model.charge_scale))
+            perturbed_params = validation_params(self.sampled_params)
+            self.ligand_energy = []
+            for phase in [self.complex_sys, self.solvent_sys]:
+                ligand_atoms = [x + phase[4] for x in range(self.num_atoms)]
+                engine = LigandEnergy(phase[3], self.get_frames(phase), ligand_atoms, self.sampled_params, exceptions)
+                error = engine.validate(phase[3], self.param_model, perturbed_params, self.sampled_params)
+                print('Ligand energy deviation from full system: {:.2e} of the energy change'.format(error))
+                if error > VALIDATION_TOLERANCE:
+                    logger.warning('Ligand energy deviates from full system by {:.2e} of the energy change, '
+                                   'using full system energies'.format(error))
+                    self.use_ligand_energy = False
+                    self.ligand_energy = None
+                    break
+                self.ligand_energy.append(engine)
+        return self.use_ligand_energy
+
+    def energy_engine(self):
+        '''
+        Name of the evaluator perturbed free energies are computed with, the ligand energy is only named
+        while it has not failed validation so values stored after a fallback are not read back as its own
+        '''
+        if self.use_potential_cache:
+            return 'potential_cache'
+        elif self.use_ligand_energy:
+            return 'ligand_energy'
+        elif self.num_workers:
+            return 'gradient_pool'
+        return 'fsim'
+
+    def check_gradient_pool(self):
+        '''
+        Start the CPU workers the first time full system energies are needed, so runs reweighted from
+        cached potentials or ligand energies never deserialize the systems in worker processes.
+        :return: True if the gradient workers are in use
+        '''
+        if self.num_workers and self.gradient_pool is None:
+            phases = [[x[3], [y + x[4] for y in range(self.num_atoms)]] for x in [self.complex_sys, self.solvent_sys]]
+            self.gradient_pool = GradientPool(self.num_workers, phases, self.param_model)
+        return self.gradient_pool is not None
+
+    def reweight_ligand(self, perturbed_params, current_params):
+        '''
+        Free energy change of each set of perturbed parameters from the current parameters in both phases
+        from the ligand energy evaluators
+        :return: lists of complex and solvent free energies
+        '''
+        free_energy = []
+        for engine in self.ligand_energy:
+            phase_free_energy = engine.free_energy(perturbed_params, current_params)
+            free_energy.append([x * unit.kilocalories_per_mole for x in phase_free_energy])
+        return free_energy
+
+    def sigma_gradient(self, all_params):
+        '''
+        Gradient of the binding free energy with respect to the ligand sigmas. In the limit of zero
+        perturbation the exponential average in each phase reduces to the ensemble average of dU/dsigma.
+        :return: array of d ddG/d sigma for every ligand atom
+        '''
+        if self.sigma_derivative is None:
+            self.sigma_derivative = []
+            for phase in [self.complex_sys, self.solvent_sys]:
+                ligand_atoms = [x + phase[4] for x in range(self.num_atoms)]
+                self.sigma_derivative.append(SigmaDerivative(phase[3], self.get_frames(phase), ligand_atoms))
+        sigmas = all_params[self.num_atoms:2*self.num_atoms]
+        complex_gradient = self.sigma_derivative[0].gradient(sigmas)
+        solvent_gradient = self.sigma_derivative[1].gradient(sigmas)
+        return complex_gradient - solvent_gradient
+
+    def save_checkpoint(self, name, state):
+        '''
+        Write the loop state of optimiser name with the parameters and trajectories it was sampled from
+        '''
+        state = dict(state, optimizer=name, sampled_params=[float(x) for x in self.sampled_params],
+                     trajectories=[list(self.complex_sys[1]), list(self.solvent_sys[1])],
+                     stamps=[file_stamps(self.complex_sys[1]), file_stamps(self.solvent_sys[1])])
+        self.checkpoint.save(state)
+
+    def load_checkpoint(self, name):
+        '''
+        Restore the loop state of optimiser name if resuming. Trajectories are picked up from where the
+        checkpoint left them, dynamics are rerun if they have changed since, e.g. the run stopped mid dynamics.
+        :return: saved loop state or None to start from the beginning
+        '''
+        if not self.resume:
+            return None
+        state = self.checkpoint.load()
+        if state is None:
+            print('No checkpoint found at {}, starting from the beginning'.format(self.checkpoint.path))
+            return None
+        if state['optimizer'] != name or len(state['all_params']) != len(self.og_all_params):
+            raise ValueError('Checkpoint {} is for a different optimisation'.format(self.checkpoint.path))
+        print('Resuming {} from step {}'.format(name, state['step']))
+        complex_dcd, solvent_dcd = state['trajectories']
+        if [file_stamps(complex_dcd), file_stamps(solvent_dcd)] == state['stamps']:
+            self.complex_sys[1] = complex_dcd
+            self.solvent_sys[1] = solvent_dcd
+            self.complex_sys[5] = None
+            self.solvent_sys[5] = None
+            self.sampled_params = state['sampled_params']
+            self.potential_cache = None
+            self.sigma_derivative = None
+            self.ligand_energy = None
+        else:
+            print('Trajectories changed since checkpoint, computing dynamics...')
+            self.run_dynamics(state['sampled_params'])
+        return state
 
     def get_bounds(self, current_params, periter_change, total_change):
         change = [abs(x-y) for x, y in zip(current_params, self.og_all_params)]
@@ -302,6 +889,11 @@ class Optimize(object):
         cons = [con1, con2]
         step = 0
         ddg = 0.0
+        state = Optimize.load_checkpoint(self, 'scipy')
+        if state is not None:
+            all_params = state['all_params']
+            step = state['step']
+            ddg = state['ddg']
         while step < self.steps:
             write_charges('params_{}'.format(step), all_params)
             bounds = Optimize.get_bounds(self, all_params, 0.01, 0.5)
@@ -319,12 +911,93 @@ class Optimize(object):
 
             all_params = all_params_plus_one
             step += 1
+            Optimize.save_checkpoint(self, 'scipy', {'step': step, 'ddg': float(ddg),
+                                                     'all_params': [float(x) for x in all_params]})
 
         print("Final binding free energy improvement {0}".format(ddg))
         write_charges('params_opt', all_params)
 
         return list(all_params), ddg
 
+    def lbfgs(self, max_step_size):
+        '''
+        Limited memory BFGS. The parameter steps and gradient changes of the last LBFGS_HISTORY steps shape the
+        search direction, which is projected onto the net charge constraint and capped at max_step_size. The end
+        of the step is projected onto the rmsd ball of the original parameters and the step is backtracked until
+        the forward ddG reweighted from the current trajectories is negative, then dynamics are run at the new
+        parameters.
+        '''
+        all_params = np.array(self.og_all_params, dtype=np.float64)
+        step = 0
+        ddg = 0.0
+        history = []
+        previous = None
+        state = Optimize.load_checkpoint(self, 'lbfgs')
+        if state is not None:
+            all_params = np.array(state['all_params'])
+            step = state['step']
+            ddg = state['ddg']
+            history = [[np.array(x), np.array(y)] for x, y in state['history']]
+            previous = None if state['previous'] is None else [np.array(x) for x in state['previous']]
+        while step < self.steps:
+            write_charges('params_{}'.format(step), all_params)
+            grad = np.array(gradient(all_params, 1, self))
+            grad = constrain_net_charge(grad, self.num_atoms, self.lock_atoms)
+            if previous is not None:
+                s = all_params - previous[0]
+                y = grad - previous[1]
+                if np.dot(s, y) > 0.0:
+                    history = (history + [[s, y]])[-LBFGS_HISTORY:]
+                else:
+                    print('Skipping L-BFGS update with negative curvature')
+
+            direction = -constrain_net_charge(lbfgs_direction(grad, history), self.num_atoms, self.lock_atoms)
+            if np.dot(direction, grad) >= 0.0:
+                print('L-BFGS direction is not downhill, clearing history')
+                history = []
+                direction = -grad
+            if len(history) == 0:
+                direction = direction / np.linalg.norm(direction) * max_step_size
+            elif np.linalg.norm(direction) > max_step_size:
+                direction = direction / np.linalg.norm(direction) * max_step_size
+
+            # project the end of the step onto the rmsd ball around the original parameters, every shorter step
+            # along the projected step then stays inside the ball as the current parameters are inside it
+            direction = project_rmsd(all_params + direction, self.og_all_params, self.rmsd) - all_params
+            if np.linalg.norm(direction) < LBFGS_MIN_SCALE * max_step_size or np.dot(direction, grad) >= 0.0:
+                print('Converged for step {}, no downhill step within rmsd {} of the original parameters'.format(
+                    step, self.rmsd))
+                break
+
+            scale = 1.0
+            forward_ddg = objective(all_params + scale * direction, all_params, self)
+            while forward_ddg >= 0.0 and scale / 2 >= LBFGS_MIN_SCALE:
+                scale /= 2
+                forward_ddg = objective(all_params + scale * direction, all_params, self)
+            if forward_ddg >= 0.0:
+                print('Converged for step {}, no downhill step within {} of the L-BFGS step'.format(step,
+                                                                                                  LBFGS_MIN_SCALE))
+                break
+            all_params_plus_one = all_params + scale * direction
+            print('Computing dynamics for step of {} the L-BFGS step...'.format(scale))
+            self.run_dynamics(all_params_plus_one)
+            reverse_ddg = -1 * objective(all_params, all_params_plus_one, self)
+            print('Forward {} and reverse {} steps'.format(forward_ddg, reverse_ddg))
+            ddg += (forward_ddg + reverse_ddg) / 2.0
+            print("Current binding free energy improvement {0} for step {1}/{2}".format(ddg, step+1, self.steps))
+
+            previous = [all_params, grad]
+            all_params = all_params_plus_one
+            step += 1
+            Optimize.save_checkpoint(self, 'lbfgs', {
+                'step': step, 'ddg': float(ddg), 'all_params': [float(x) for x in all_params],
+                'history': [[[float(x) for x in s], [float(x) for x in y]] for s, y in history],
+                'previous': [[float(x) for x in v] for v in previous]})
+
+        print("Final binding free energy improvement {0}".format(ddg))
+        write_charges('params_opt', all_params)
+        return list(all_params), ddg
+
     def grad_decent(self, max_step_size, line_windows, line_sampling=100):
         all_params = copy.deepcopy(self.og_all_params)
         step = 0
@@ -333,7 +1006,22 @@ class Optimize(object):
         converged = False
         extend_line = False
         found_nan = False
+        step_size = max_step_size
+        norm_const_step = None
+        # how each line of this run was scored
+        line_methods = {'surrogate': 0, 'reweight': 0, 'reweight fell back to fep': 0, 'fep': 0}
         write_charges('params_og'.format(step), all_params)
+        state = Optimize.load_checkpoint(self, 'grad_decent')
+        if state is not None:
+            all_params = np.array(state['all_params'])
+            step = state['step']
+            ddg = state['ddg']
+            ddg_error = state['ddg_error']
+            converged = state['converged']
+            extend_line = state['extend_line']
+            found_nan = state['found_nan']
+            step_size = state['step_size']
+            norm_const_step = None if state['direction'] is None else np.array(state['direction'])
         # optimization loop
         while step < self.steps:
             if not found_nan and not extend_line:
@@ -353,54 +1041,83 @@ class Optimize(object):
 
             #2 windows is BAR, less than 2 does is no pertubation
             assert line_windows >= 2
-            all_params_plus_one = all_params - step_size * norm_const_step
-            c_dg, c_err, s_dg, s_err = self.run_fep(all_params, all_params_plus_one, 2500, line_sampling, line_windows, True)
-            #catch nans
-            if c_dg is not False:
-                found_nan = False
-                ddg_fep = c_dg - s_dg
-                ddg_fep_err = (c_err ** 2 + s_err ** 2) ** 0.5
-                line = ddg_fep[0]
-                line_err = ddg_fep_err[0]
-                best_window = list(line).index(min(line))
-                print('Line search found best window {} from line {}'.format(best_window, line))
-
-                #Check if converged because 0th window was the best unless we are currently extending line search
-                if best_window < (line_windows/6) and not extend_line:
-                    # Failed to find down hill must be at minimum within convergance = step_size/x
-                    print('Converged for step {} within tolerance {}'.format(step, (step_size / 6)))
+            if self.line_search == 'golden':
+                # windows only carry the overlap between the points visited rather than being candidate steps
+                # so are spaced twice as far apart as the fixed grid
+                spacing = 2.0 * max_step_size / (line_windows - 1)
+                step_length, line_ddg, line_error = Optimize.bracket_line(self, all_params, norm_const_step, step_size,
+                                                                          spacing, line_sampling, line_windows)
+                print('Line search found best step {}'.format(step_length))
+                if step_length == 0.0:
+                    print('Converged for step {} within tolerance {}'.format(step, (step_size / 10)))
                     converged = True
-
-                ddg += line[best_window]
-                ddg_error = (ddg_error ** 2 + line_err[best_window] ** 2) ** 0.5
-
-                #Check if need to extend line search beacuse last window was the best
-                if best_window == len(line)-1:
-                    print('Last window was best window, extending line search')
-                    extend_line = True
-                else:
-                    extend_line = False
-
-                # Get params corresponding to best window
-                all_params_plus_one = [a + ((b - a) / (line_windows - 1)) * (best_window) for a, b in
-                                    zip(all_params, all_params_plus_one)]
-
+                ddg += line_ddg
+                ddg_error = (ddg_error ** 2 + line_error ** 2) ** 0.5
+                found_nan = False
+                extend_line = False
+                all_params_plus_one = list(all_params - step_length * norm_const_step)
             else:
-                if not extend_line:
-                    #if we caught a nan and we are not extending reduce step size
-                    step_size = step_size/2
-                    print('Reducing step size to {}'.format(step_size))
-                    found_nan = True
-                    # reset step
-                    all_params_plus_one = all_params
+                all_params_plus_one = all_params - step_size * norm_const_step
+                line_dg = None
+                if self.surrogate_error is not None:
+                    line_dg = Optimize.surrogate_line(self, all_params, all_params_plus_one, line_windows)
+                predicted = line_dg is not None
+                method = 'surrogate' if predicted else 'fep'
+                if line_dg is None and self.line_search == 'reweight':
+                    line_dg = Optimize.reweight_line(self, all_params, all_params_plus_one, line_windows)
+                    method = 'reweight' if line_dg is not None else 'reweight fell back to fep'
+                if line_dg is None:
+                    line_dg = Optimize.line_fep(self, all_params, all_params_plus_one, line_sampling, line_windows)
+                line_methods[method] += 1
+                c_dg, c_err, s_dg, s_err = line_dg
+                #catch nans
+                if c_dg is not False:
+                    found_nan = False
+                    ddg_fep = c_dg - s_dg
+                    ddg_fep_err = (c_err ** 2 + s_err ** 2) ** 0.5
+                    line = ddg_fep[0]
+                    line_err = ddg_fep_err[0]
+                    best_window = list(line).index(min(line))
+                    print('Line search found best window {} from line {}'.format(best_window, line))
+
+                    #Check if converged because 0th window was the best unless we are currently extending line search
+                    if best_window < (line_windows/6) and not extend_line:
+                        # Failed to find down hill must be at minimum within convergance = step_size/x
+                        print('Converged for step {} within tolerance {}'.format(step, (step_size / 6)))
+                        converged = True
+
+                    if not predicted:
+                        Optimize.store_line(self, all_params, all_params_plus_one, ddg, ddg_error, line, line_err)
+                    ddg += line[best_window]
+                    ddg_error = (ddg_error ** 2 + line_err[best_window] ** 2) ** 0.5
+
+                    #Check if need to extend line search beacuse last window was the best
+                    if best_window == len(line)-1:
+                        print('Last window was best window, extending line search')
+                        extend_line = True
+                    else:
+                        extend_line = False
+
+                    # Get params corresponding to best window
+                    all_params_plus_one = [a + ((b - a) / (line_windows - 1)) * (best_window) for a, b in
+                                        zip(all_params, all_params_plus_one)]
 
                 else:
-                    # if we where extending a line search assume NaN is coming from being at the end of the line
-                    # set extend line and found nan to False to re calc gradient and change direction
-                    found_nan = False
-                    extend_line = False
-                    # reset step
-                    all_params_plus_one = all_params
+                    if not extend_line:
+                        #if we caught a nan and we are not extending reduce step size
+                        step_size = step_size/2
+                        print('Reducing step size to {}'.format(step_size))
+                        found_nan = True
+                        # reset step
+                        all_params_plus_one = all_params
+
+                    else:
+                        # if we where extending a line search assume NaN is coming from being at the end of the line
+                        # set extend line and found nan to False to re calc gradient and change direction
+                        found_nan = False
+                        extend_line = False
+                        # reset step
+                        all_params_plus_one = all_params
 
             if step_size < max_step_size/10:
                 #this if catches the senario where we are continuously naning and the step size keeps halving
@@ -427,7 +1144,15 @@ class Optimize(object):
                     "Final binding free energy improvement {0} +- {1} kcal/mol".format(ddg, ddg_error))
                 all_params = all_params_plus_one
                 write_charges('params_opt', all_params)
-
+            Optimize.save_checkpoint(self, 'grad_decent', {
+                'step': step, 'step_size': step_size, 'extend_line': extend_line, 'found_nan': found_nan,
+                'converged': converged, 'ddg': float(ddg), 'ddg_error': float(ddg_error),
+                'all_params': [float(x) for x in all_params],
+                'direction': None if norm_const_step is None else [float(x) for x in norm_const_step]})
+
+        if sum(line_methods.values()) > 0:
+            print('Line searches by method: {}'.format(', '.join('{} {}'.format(x, y) for x, y in
+                                                                 line_methods.items() if y > 0)))
         return list(all_params), ddg, ddg_error
 
     def process_mutant(self, parameters):
@@ -435,15 +1160,14 @@ class Optimize(object):
         :param parameters: List of charge, sigma and vs charges
         :return:
         '''
-        #translate to atomwise
-        atomwise_params = Optimize.translate_concat_to_atomwise(self, parameters)
-        #Build exceptions
-        exceptions = Optimize.get_exception_params(self, atomwise_params)
-
-        #translate to mutant format
-        mut = Optimize.translate_atomwise_to_mutant(self, atomwise_params, exceptions)
+        return self.process_mutants([parameters])[0]
 
-        return mut+self.unused_params
+    def process_mutants(self, parameters):
+        '''
+        :param parameters: List of concatenated charge and sigma vectors
+        :return: list of ligand parameters in Mutants format
+        '''
+        return self.param_model.to_mutants(parameters)
 
 
 def gen_mutations_dicts(add=[], subtract=[], replace=[None], replace_insitu=[None]):
@@ -451,24 +1175,65 @@ def gen_mutations_dicts(add=[], subtract=[], replace=[None], replace_insitu=[Non
 
 
 def objective(peturbed_params, current_params, sim):
-    systems = [peturbed_params, current_params]
-    mutants = [sim.process_mutant(x) for x in systems]
-    mutations = [gen_mutations_dicts(), gen_mutations_dicts()]
-
-    mutant_params = Mutants(mutants, mutations, sim.complex_sys[0], sim.solvent_sys[0])
-
-    complex_free_energy = FSim.treat_phase(sim.complex_sys[0], mutant_params.complex_params,
-                                           sim.complex_sys[1], sim.complex_sys[2], sim.num_frames)
-    solvent_free_energy = FSim.treat_phase(sim.solvent_sys[0], mutant_params.solvent_params,
-                                           sim.solvent_sys[1], sim.solvent_sys[2], sim.num_frames)
+    key = [peturbed_params, current_params, sim.trajectory_id(), sim.num_frames, sim.decorrelate, sim.energy_engine()]
+    binding_free_energy = sim.evaluations.get('objective', *key)
+    if binding_free_energy is not None:
+        print('Using stored ddG')
+        return binding_free_energy
+    complex_free_energy, solvent_free_energy = perturbed_free_energy(sim, [peturbed_params], current_params,
+                                                                     sim.num_frames)
     binding_free_energy = complex_free_energy[0] - solvent_free_energy[0]
-
-    return binding_free_energy/unit.kilocalories_per_mole
+    binding_free_energy = float(binding_free_energy/unit.kilocalories_per_mole)
+    sim.evaluations.add('objective', binding_free_energy, *key)
+    return binding_free_energy
 
 
 def gradient(all_params, dummy, sim):
+    """
+    Gradient of the binding free energy reweighted from the current trajectories, reusing a stored gradient
+    of the same parameters and trajectories
+    """
+    key = [all_params, sim.trajectory_id(), sim.num_frames, sim.decorrelate, sim.energy_engine(), sim.param,
+           sim.central, sim.spsa_samples, sim.analytic_sigma, sim.lock_atoms, sim.atom_groups]
+    grad = sim.evaluations.get('gradient', *key)
+    if grad is not None:
+        print('Using stored gradient')
+        return grad
+    grad = compute_gradient(all_params, sim)
+    sim.evaluations.add('gradient', [float(x) for x in grad], *key)
+    return grad
+
+
+def compute_gradient(all_params, sim):
     num_frames = int(sim.num_frames)
-    dh = 1.5e-04
+    dh = FD_STEP
+    grad = np.zeros(len(all_params))
+
+    # Skip systems which correspond to locked atoms, these keep a gradient of zero
+    unlocked = [i for i in range(len(all_params)) if i not in sim.lock_atoms]
+
+    if sim.analytic_sigma:
+        print('Computing sigma gradient analytically...')
+        sigma_index = [i for i in unlocked if i >= sim.num_atoms]
+        grad[sigma_index] = sim.sigma_gradient(all_params)[[i - sim.num_atoms for i in sigma_index]]
+        # the gradient projected onto the tied parameters is the mean derivative of each group
+        for group in sim.param_groups(sigma_index):
+            grad[group] = np.mean(grad[group])
+        unlocked = [i for i in unlocked if i < sim.num_atoms]
+        if len(unlocked) == 0:
+            return list(grad)
+
+    # each group of tied parameters is perturbed together, which gives the derivative with respect to the shared
+    # change of the group, the sum of the derivatives of its members. Dividing by the size of the group gives
+    # the gradient projected onto the tied parameters.
+    groups = sim.param_groups(unlocked)
+
+    if sim.spsa_samples:
+        print('Computing jacobian from {} simultaneous perturbations...'.format(sim.spsa_samples))
+        for group, value in zip(groups, spsa_gradient(sim, all_params, groups, num_frames)):
+            grad[group] = value / len(group)
+        return list(grad)
+
     if sim.central:
         h = [0.5*dh, -0.5*dh]
         print('Computing jacobian with central difference...')
@@ -479,33 +1244,9 @@ def gradient(all_params, dummy, sim):
 
     for diff in h:
         binding_free_energy = []
-        mutant_parameters = []
-        for i in range(len(all_params)):
-            # Skip systems which correspond to locked atoms
-            if i not in sim.lock_atoms:
-                mutant = copy.deepcopy(all_params)
-                mutant[i] = mutant[i] + diff
-                mutant_parameters.append(mutant)
-
-        #make mutant systems
-        mutants = [sim.process_mutant(x) for x in mutant_parameters]
-
-        #make reference system
-        current_sys = sim.process_mutant(all_params)
-
-        # Generate dictionaries to discribe mutations
-        mutations = [gen_mutations_dicts() for x in mutants]
-
-        #Append wt system to end to be used as central reference state
-        mutants.append(current_sys)
-        mutations.append(gen_mutations_dicts())
-
-        mutant_params = Mutants(mutants, mutations, sim.complex_sys[0], sim.solvent_sys[0])
-
-        complex_free_energy = FSim.treat_phase(sim.complex_sys[0], mutant_params.complex_params,
-                                               sim.complex_sys[1], sim.complex_sys[2], num_frames)
-        solvent_free_energy = FSim.treat_phase(sim.solvent_sys[0], mutant_params.solvent_params,
-                                               sim.solvent_sys[1], sim.solvent_sys[2], num_frames)
+        mutant_parameters = perturbations(all_params, diff, groups)
+        complex_free_energy, solvent_free_energy = perturbed_free_energy(sim, mutant_parameters, all_params,
+                                                                         num_frames, sim.grad_chunk)
 
         for sol, com in zip(solvent_free_energy, complex_free_energy):
             free_energy = com - sol
@@ -519,10 +1260,128 @@ def gradient(all_params, dummy, sim):
         for forwards, backwards in zip(ddG[0], ddG[1]):
             binding_free_energy.append((forwards - backwards)/dh)
 
-    #add back in energies for systems corrisponing to locked atoms with energy set to zero
-    for x in sim.lock_atoms:
-        binding_free_energy.insert(x, 0.0)
-    return binding_free_energy
+    for group, value in zip(groups, binding_free_energy):
+        grad[group] = value / len(group)
+    return list(grad)
+
+
+def spsa_gradient(sim, all_params, groups, num_frames):
+    """
+    Simultaneous perturbation estimate of the gradient components of groups of tied parameters. Every sample
+    shifts all of the parameters at once by FD_STEP with random signs, so the cost scales with the number of
+    samples rather than the number of parameters. The estimates of all samples are averaged.
+    :return: array of the derivative of ddG with respect to the shared change of each group
+    """
+    signs = sim.rng.choice([-1.0, 1.0], size=(sim.spsa_samples, len(groups)))
+    if sim.central:
+        h = [0.5*FD_STEP, -0.5*FD_STEP]
+    else:
+        h = [FD_STEP]
+
+    def mutants():
+        for diff in h:
+            for sign in signs:
+                mutant = np.array(all_params, dtype=np.float64)
+                for group, group_sign in zip(groups, sign):
+                    mutant[group] += diff * group_sign
+                yield mutant
+
+    complex_free_energy, solvent_free_energy = perturbed_free_energy(sim, mutants(), all_params, num_frames,
+                                                                     sim.grad_chunk)
+    ddg = np.array([(com - sol)/unit.kilocalories_per_mole for com, sol in
+                    zip(complex_free_energy, solvent_free_energy)]).reshape(len(h), -1)
+    difference = ddg[0] - ddg[1] if sim.central else ddg[0]
+    # dividing by a sign of +-1 is the same as multiplying by it
+    return np.mean(difference[:, np.newaxis] * signs, axis=0) / FD_STEP
+
+
+def perturbations(all_params, diff, indices):
+    """
+    Lazily generate copies of all_params with one parameter, or one list of tied parameters,
+    at a time shifted by diff
+    """
+    for i in indices:
+        mutant = np.array(all_params, dtype=np.float64)
+        mutant[i] += diff
+        yield mutant
+
+
+def perturbed_free_energy(sim, mutant_parameters, current_params, num_frames, chunk_size=None):
+    """
+    Free energy change from current_params to each set of mutant_parameters in the complex and solvent.
+    mutant_parameters is consumed chunk_size systems at a time so only one chunk of ligand
+    parameter sets is held in memory, None evaluates all systems together.
+    :return: lists of complex and solvent free energies
+    """
+    complex_free_energy = []
+    solvent_free_energy = []
+    mutant_parameters = iter(mutant_parameters)
+    while True:
+        chunk = list(itertools.islice(mutant_parameters, chunk_size))
+        if len(chunk) == 0:
+            break
+        if sim.check_potential_cache():
+            complex_chunk, solvent_chunk = sim.reweight_charges(chunk, current_params)
+        elif sim.check_ligand_energy():
+            complex_chunk, solvent_chunk = sim.reweight_ligand(chunk, current_params)
+        elif sim.check_gradient_pool():
+            trajectories = [sim.get_frames(sim.complex_sys), sim.get_frames(sim.solvent_sys)]
+            complex_chunk, solvent_chunk = sim.gradient_pool.free_energy(trajectories, chunk, current_params)
+            complex_chunk = [x * unit.kilocalories_per_mole for x in complex_chunk]
+            solvent_chunk = [x * unit.kilocalories_per_mole for x in solvent_chunk]
+        else:
+            #make mutant systems and append current system to end to be used as central reference state
+            mutants = sim.process_mutants(chunk + [current_params])
+            # Generate dictionaries to discribe mutations
+            mutations = [gen_mutations_dicts() for x in mutants]
+
+            mutant_params = Mutants(mutants, mutations, sim.complex_sys[0], sim.solvent_sys[0])
+            del mutants
+
+            complex_chunk = FSim.treat_phase(sim.complex_sys[0], mutant_params.complex_params,
+                                             sim.complex_sys[1], sim.complex_sys[2], num_frames)
+            solvent_chunk = FSim.treat_phase(sim.solvent_sys[0], mutant_params.solvent_params,
+                                             sim.solvent_sys[1], sim.solvent_sys[2], num_frames)
+            del mutant_params
+        complex_free_energy.extend(complex_chunk)
+        solvent_free_energy.extend(solvent_chunk)
+        if chunk_size is not None:
+            print('Evaluated {} perturbed systems'.format(len(complex_free_energy)))
+    return complex_free_energy, solvent_free_energy
+
+
+def lbfgs_direction(grad, history):
+    '''
+    Two loop recursion for the product of the L-BFGS inverse Hessian estimate and grad
+    :param history: list of [parameter step, gradient change] from oldest to newest
+    '''
+    q = np.array(grad, dtype=np.float64)
+    alphas = []
+    for s, y in reversed(history):
+        rho = 1.0 / np.dot(y, s)
+        alpha = rho * np.dot(s, q)
+        q -= alpha * y
+        alphas.append([rho, alpha])
+    if len(history) > 0:
+        s, y = history[-1]
+        q *= np.dot(s, y) / np.dot(y, y)
+    for (s, y), (rho, alpha) in zip(history, reversed(alphas)):
+        beta = rho * np.dot(y, q)
+        q += (alpha - beta) * s
+    return q
+
+
+def parabolic_minimum(x, f):
+    '''
+    Turning point of the parabola through three points, None if it is undefined
+    '''
+    a, b, c = x
+    fa, fb, fc = f
+    numerator = (b - a) ** 2 * (fb - fc) - (b - c) ** 2 * (fb - fa)
+    denominator = (b - a) * (fb - fc) - (b - c) * (fb - fa)
+    if denominator == 0.0 or not np.isfinite(numerator) or not np.isfinite(denominator):
+        return None
+    return b - 0.5 * numerator / denominator
 
 
 def constrain_net_charge(delta, num_charges, lock_atoms):
@@ -552,6 +1411,19 @@ def rmsd_change_con(current_charge, og_charge, rmsd):
     return maximum_rmsd - rmsd
 
 
+def project_rmsd(params, og_params, rmsd):
+    '''
+    Closest parameters to params within rmsd of og_params. Only the change from og_params is scaled so the
+    net charge, locked and tied parameters of params are kept.
+    '''
+    params = np.array(params, dtype=np.float64)
+    og_params = np.array(og_params, dtype=np.float64)
+    current = np.average((params - og_params) ** 2) ** 0.5
+    if current <= rmsd:
+        return params
+    return og_params + (params - og_params) * rmsd / current
+
+
 def write_charges(name, charges):
     file = open(name, 'w')
     for q in charges:
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+from simtk import openmm as mm
+from simtk import unit
+from .potential import exp_average, kB
+from .frames import FrameStore
+import multiprocessing as mp
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+#CONSTANTS
+NONBONDED_GROUP = 31
+
+# state held by each pool worker between tasks
+worker_state = {}
+
+
+class GradientPool(object):
+    def __init__(self, num_workers, phases, param_model, temperature=300.0):
+        '''
+        Pool of CPU worker processes sharding perturbed energy evaluations of both phases.
+        Each worker keeps a long lived OpenMM CPU context per phase and holds the current trajectory
+        of each phase mapped until it changes.
+        :param num_workers: number of worker processes
+        :param phases: list of [OpenMM system, ligand atom indices] for the complex and solvent
+        :param param_model: ParameterModel translating parameter vectors to ligand parameters
+        '''
+        self.num_workers = num_workers
+        self.param_model = param_model
+        self.kT = kB * temperature
+        serialized = [[mm.XmlSerializer.serialize(system), list(ligand_atoms)] for system, ligand_atoms in phases]
+        exceptions = [list(param_model.excep_i), list(param_model.excep_j)]
+        print('Starting {} gradient workers...'.format(num_workers))
+        self.pool = mp.get_context('spawn').Pool(num_workers, initializer=init_worker,
+                                                 initargs=(serialized, exceptions))
+
+    def pack(self, params):
+        '''
+        Ligand charges, sigmas, exception charge products and exception sigmas as one row per system
+        '''
+        return pack_params(self.param_model, params)
+
+    def free_energy(self, trajectories, perturbed_params, current_params):
+        '''
+        :param trajectories: FrameStore of the complex and solvent trajectories
+        :return: lists of complex and solvent free energies in kcal/mol, in the order of perturbed_params
+        '''
+        perturbed = GradientPool.pack(self, perturbed_params)
+        current = GradientPool.pack(self, current_params)[0]
+        tasks = []
+        for phase, frames in enumerate(trajectories):
+            for shard in np.array_split(np.arange(len(perturbed)), self.num_workers):
+                if len(shard) > 0:
+                    tasks.append([phase, frames.path, frames.indices, frames.key, perturbed[shard], current, self.kT])
+        results = self.pool.map(phase_free_energy, tasks)
+
+        free_energy = [[] for x in trajectories]
+        for task, result in zip(tasks, results):
+            free_energy[task[0]].extend(result)
+        return free_energy
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def pack_params(param_model, params):
+    '''
+    Ligand charges, sigmas, exception charge products and exception sigmas as one row per system
+    '''
+    params = np.atleast_2d(np.array(params, dtype=np.float64))
+    charge_product, sigma_mean = param_model.exception_params(params)
+    return np.hstack([params[:, :2*param_model.num_atoms], charge_product, sigma_mean])
+
+
+def nonbonded_context(xml, ligand_atoms, exceptions, threads=1):
+    '''
+    CPU context of a serialized system evaluating only the nonbonded force
+    :param exceptions: [ligand local i, ligand local j] of every exception in the ParameterModel order
+    '''
+    system = mm.XmlSerializer.deserialize(xml)
+    # only the nonbonded energy changes with the ligand parameters
+    for force in system.getForces():
+        force.setForceGroup(0)
+    force = [x for x in system.getForces() if isinstance(x, mm.NonbondedForce)][0]
+    force.setForceGroup(NONBONDED_GROUP)
+    force.setReciprocalSpaceForceGroup(-1)
+
+    integrator = mm.VerletIntegrator(1.0*unit.femtoseconds)
+    platform = mm.Platform.getPlatformByName('CPU')
+    context = mm.Context(system, integrator, platform, {'Threads': str(threads)})
+    state = ligand_force(force, ligand_atoms, exceptions)
+    state.update({'context': context, 'integrator': integrator})
+    return state
+
+
+def ligand_force(force, ligand_atoms, exceptions):
+    '''
+    Ligand particles and exceptions of a NonbondedForce for set_ligand_parameters
+    :param exceptions: [ligand local i, ligand local j] of every exception in the ParameterModel order
+    '''
+    epsilons = [force.getParticleParameters(x)[2] for x in ligand_atoms]
+    local = {atom: i for i, atom in enumerate(ligand_atoms)}
+    pairs = {}
+    for index in range(force.getNumExceptions()):
+        i, j, charge_product, sigma, epsilon = force.getExceptionParameters(index)
+        if i in local and j in local:
+            pairs[frozenset([local[i], local[j]])] = [index, i, j, epsilon]
+    excep = [pairs[frozenset([i, j])] for i, j in zip(*exceptions)]
+    return {'force': force, 'ligand_atoms': ligand_atoms, 'epsilons': epsilons, 'excep': excep}
+
+
+def set_ligand_parameters(state, params):
+    '''
+    Write one row of pack_params into the NonbondedForce of state
+    '''
+    force = state['force']
+    num_atoms = len(state['ligand_atoms'])
+    num_excep = len(state['excep'])
+    charges = params[:num_atoms]
+    sigmas = params[num_atoms:2*num_atoms]
+    charge_products = params[2*num_atoms:2*num_atoms+num_excep]
+    excep_sigmas = params[2*num_atoms+num_excep:]
+    for atom, q, sigma, epsilon in zip(state['ligand_atoms'], charges, sigmas, state['epsilons']):
+        force.setParticleParameters(atom, q, sigma, epsilon)
+    for (index, i, j, epsilon), q, sigma in zip(state['excep'], charge_products, excep_sigmas):
+        force.setExceptionParameters(index, i, j, q, sigma, epsilon)
+
+
+def init_worker(phases, exceptions):
+    worker_state['phases'] = []
+    worker_state['trajectory'] = {}
+    worker_state['reference'] = {}
+    for xml, ligand_atoms in phases:
+        worker_state['phases'].append(nonbonded_context(xml, ligand_atoms, exceptions))
+
+
+def load_trajectory(phase, path, indices, key):
+    '''
+    FrameStore of the trajectory of a phase, kept mapped until the trajectory changes so frames are
+    only read as they are evaluated
+    '''
+    cached = worker_state['trajectory'].get(phase)
+    if cached is None or cached[0] != key:
+        cached = [key, FrameStore(path, indices)]
+        worker_state['trajectory'][phase] = cached
+        worker_state['reference'].pop(phase, None)
+    return cached[1]
+
+
+def nonbonded_energies(state, params, frames):
+    '''
+    Nonbonded energy of every frame of a FrameStore with the ligand parameters in params, kcal/mol
+    '''
+    context = state['context']
+    set_ligand_parameters(state, params)
+    state['force'].updateParametersInContext(context)
+
+    energies = np.zeros(frames.num_frames)
+    for frame in range(frames.num_frames):
+        positions, box = frames.frame(frame)
+        if box is not None:
+            context.setPeriodicBoxVectors(*[mm.Vec3(*x) for x in np.array(box, dtype=np.float64)])
+        context.setPositions(np.array(positions, dtype=np.float64))
+        energy = context.getState(getEnergy=True, groups={NONBONDED_GROUP}).getPotentialEnergy()
+        energies[frame] = energy.value_in_unit(unit.kilocalories_per_mole)
+    return energies
+
+
+def phase_free_energy(task):
+    phase, path, indices, frames_key, perturbed, current, kT = task
+    frames = load_trajectory(phase, path, indices, frames_key)
+    state = worker_state['phases'][phase]
+    key = current.tobytes()
+    reference = worker_state['reference'].get(phase)
+    if reference is None or reference[0] != key:
+        reference = [key, nonbonded_energies(state, current, frames)]
+        worker_state['reference'][phase] = reference
+    delta_u = [nonbonded_energies(state, x, frames) - reference[1] for x in perturbed]
+    return [float(x) for x in exp_average(delta_u, kT)]
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ParameterModel(object):
+    def __init__(self, wt_parameters, wt_nonbonded, wt_nonbonded_ids, wt_excep, unused_params):
+        '''
+        Array backed transform from concatenated [charges, sigmas] vectors to the ligand parameters
+        consumed by Mutants. Exceptions are held as index pairs and scale factors so charge products
+        and sigma means are computed for a whole batch of vectors at once.
+        :param wt_parameters: [nonbonded, exceptions] of the wild type ligand in Mutants format
+        :param wt_nonbonded: atomwise [charge, sigma] of the wild type
+        :param wt_nonbonded_ids: atom ids in the order of wt_nonbonded
+        :param wt_excep: exceptions of the wild type as {'id': pair, 'data': [charge product, sigma]}
+        :param unused_params: bond, angle and torsion parameters appended to every mutant
+        '''
+        self.wt_parameters = wt_parameters
+        self.unused_params = unused_params
+        self.num_atoms = len(wt_nonbonded)
+
+        index = {x: i for i, x in enumerate(wt_nonbonded_ids)}
+        pairs = [list(x['id']) for x in wt_excep]
+        self.excep_i = np.array([index[x[0]] for x in pairs], dtype=int)
+        self.excep_j = np.array([index[x[1]] for x in pairs], dtype=int)
+
+        # scale exceptions relative to the combined atom parameters so they follow any change of the atoms
+        wt = np.array(wt_nonbonded, dtype=np.float64)
+        charge_product = wt[self.excep_i, 0] * wt[self.excep_j, 0]
+        sigma_mean = 0.5 * (wt[self.excep_i, 1] + wt[self.excep_j, 1])
+        excep = np.array([x['data'] for x in wt_excep], dtype=np.float64).reshape(-1, 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.charge_scale = np.where(charge_product != 0.0, excep[:, 0] / charge_product, 0.0)
+            self.sigma_scale = np.where(sigma_mean != 0.0, excep[:, 1] / sigma_mean, 0.0)
+
+    def exception_params(self, params):
+        '''
+        :param params: concatenated [charges, sigmas] with shape (num_systems, 2*num_atoms)
+        :return: charge products and sigmas of every exception, each with shape (num_systems, num_exceptions)
+        '''
+        params = np.atleast_2d(np.array(params, dtype=np.float64))
+        charge = params[:, :self.num_atoms]
+        sigma = params[:, self.num_atoms:2*self.num_atoms]
+        charge_product = self.charge_scale * charge[:, self.excep_i] * charge[:, self.excep_j]
+        sigma_mean = self.sigma_scale * 0.5 * (sigma[:, self.excep_i] + sigma[:, self.excep_j])
+        return charge_product, sigma_mean
+
+    def to_mutants(self, params):
+        '''
+        :param params: concatenated [charges, sigmas] with shape (num_systems, 2*num_atoms)
+        :return: list of ligand parameters in Mutants format, one per system
+        '''
+        params = np.atleast_2d(np.array(params, dtype=np.float64))
+        charge_product, sigma_mean = ParameterModel.exception_params(self, params)
+        mutants = []
+        for atoms, products, sigmas in zip(params.tolist(), charge_product.tolist(), sigma_mean.tolist()):
+            nonbonded = [dict(x, data=[q, s]) for x, q, s in
+                         zip(self.wt_parameters[0], atoms[:self.num_atoms], atoms[self.num_atoms:])]
+            exceptions = [dict(x, data=[q, s]) for x, q, s in zip(self.wt_parameters[1], products, sigmas)]
+            mutants.append([nonbonded, exceptions] + self.unused_params)
+        return mutants
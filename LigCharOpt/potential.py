@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+
+from simtk import openmm as mm
+from simtk import unit
+from scipy.special import erf, erfc
+from scipy.optimize import brentq
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+#CONSTANTS
+# Coulomb constant in kcal/mol nm e^-2
+ONE_4PI_EPS0 = 138.935456 / 4.184
+# Boltzmann constant in kcal/mol/K
+kB = 0.0019872041
+PME_ORDER = 5
+
+
+class PotentialCache(object):
+    def __init__(self, system, frames, ligand_atoms, charges, exceptions, temperature=300.0):
+        '''
+        Electrostatic potential at every ligand atom for every frame of a trajectory.
+        The electrostatic energy is quadratic in the ligand charges so for any candidate charges q'
+            dU = (q' - q).phi + 1/2 (q' - q).A.(q' - q)
+        where q are the charges the trajectory was sampled with, phi is the potential at the ligand atoms
+        and A is the intra-ligand pair term. Once built, reweighting any set of charges is one
+        matrix-vector product per frame.
+        :param system: OpenMM system of the phase
+        :param frames: FrameStore of the phase trajectory
+        :param ligand_atoms: indices of the ligand atoms in the system
+        :param charges: ligand charges the trajectory was sampled with
+        :param exceptions: list of (i, j, scale), i and j index ligand atoms and scale is the ratio
+                           of the exception charge product to q_i*q_j
+        '''
+        self.kT = kB * temperature
+        self.charges = np.array(charges, dtype=np.float64)
+        self.ligand_atoms = np.array(ligand_atoms)
+        self.settings = get_electrostatics(system)
+
+        num_ligand_atoms = len(self.ligand_atoms)
+        self.exception_scale = np.ones((num_ligand_atoms, num_ligand_atoms))
+        self.is_exception = np.zeros((num_ligand_atoms, num_ligand_atoms), dtype=bool)
+        for i, j, scale in exceptions:
+            self.exception_scale[i, j] = self.exception_scale[j, i] = scale
+            self.is_exception[i, j] = self.is_exception[j, i] = True
+        np.fill_diagonal(self.is_exception, True)
+
+        # environment charges with the sampled ligand charges in place
+        self.all_charges = self.settings['charges'].copy()
+        self.all_charges[self.ligand_atoms] = self.charges
+
+        self.num_frames = frames.num_frames
+        self.potential = np.zeros((self.num_frames, num_ligand_atoms))
+        self.pair = np.zeros((self.num_frames, num_ligand_atoms, num_ligand_atoms))
+        for frame in range(self.num_frames):
+            positions, box = frames.frame(frame)
+            box = None if box is None else np.array(box, dtype=np.float64)
+            positions = np.array(positions, dtype=np.float64)
+            self.potential[frame], self.pair[frame] = PotentialCache.frame_terms(self, positions, box)
+
+    def frame_terms(self, positions, box):
+        settings = self.settings
+        periodic = settings['method'] not in [mm.NonbondedForce.NoCutoff, mm.NonbondedForce.CutoffNonPeriodic]
+        ewald = settings['method'] in [mm.NonbondedForce.Ewald, mm.NonbondedForce.PME, mm.NonbondedForce.LJPME]
+
+        # ligand-everything real space potential
+        ligand_positions = positions[self.ligand_atoms]
+        delta = positions[np.newaxis, :, :] - ligand_positions[:, np.newaxis, :]
+        if periodic:
+            delta = minimum_image(delta, box)
+        r = np.linalg.norm(delta, axis=2)
+        # exceptions and self interactions are not part of the pairwise kernel
+        mask = np.ones(r.shape, dtype=bool)
+        mask[:, self.ligand_atoms] = ~self.is_exception
+        if settings['method'] != mm.NonbondedForce.NoCutoff:
+            mask &= r < settings['cutoff']
+        kernel = np.zeros(r.shape)
+        kernel[mask] = pair_kernel(r[mask], settings)
+        potential = kernel @ self.all_charges
+
+        # intra-ligand terms
+        r_lig = r[:, self.ligand_atoms]
+        np.fill_diagonal(r_lig, 1.0)
+        exception_kernel = np.where(self.is_exception, self.exception_scale / r_lig, 0.0)
+        np.fill_diagonal(exception_kernel, 0.0)
+        potential += exception_kernel @ self.charges
+        if ewald:
+            # remove the excluded pairs and self interaction counted by the reciprocal sum
+            exclusion = np.where(self.is_exception, erf(settings['alpha'] * r_lig) / r_lig, 0.0)
+            np.fill_diagonal(exclusion, 2.0 * settings['alpha'] / np.sqrt(np.pi))
+            potential -= exclusion @ self.charges
+            potential += reciprocal_potential(positions, self.all_charges, box, settings, self.ligand_atoms)
+            # neutralising background of a system with net charge Q, -pi Q^2 / (2 alpha^2 V)
+            background = np.pi / (settings['alpha']**2 * np.linalg.det(box))
+            potential -= background * np.sum(self.all_charges)
+
+        # The reciprocal sum of the second order term is approximated by its short range limit
+        # (erfc + erf = 1/r) plus the leading periodic image terms, the constant is the potential of
+        # the images of a charge at its own position which only counts when the net charge changes.
+        if ewald:
+            pair = np.where(self.is_exception, 0.0, 1.0 / r_lig)
+            r_lig[np.diag_indices_from(r_lig)] = 0.0
+            pair += 2.0 * np.pi * r_lig**2 / (3.0 * np.linalg.det(box))
+            pair += self_image_potential(box, settings['alpha'])
+        else:
+            pair = np.where(self.is_exception, 0.0, pair_kernel(r_lig, settings))
+            if settings['method'] != mm.NonbondedForce.NoCutoff:
+                pair[r_lig >= settings['cutoff']] = 0.0
+        pair += exception_kernel
+
+        return ONE_4PI_EPS0 * potential, ONE_4PI_EPS0 * pair
+
+    def delta_energy(self, charges):
+        '''
+        :param charges: array of ligand charges with shape (num_systems, num_ligand_atoms)
+        :return: electrostatic energy change from the sampled charges in kcal/mol,
+                 shape (num_systems, num_frames)
+        '''
+        dq = np.atleast_2d(np.array(charges, dtype=np.float64)) - self.charges
+        linear = dq @ self.potential.T
+        quadratic = np.einsum('mi,fij,mj->mf', dq, self.pair, dq, optimize=True)
+        return linear + 0.5 * quadratic
+
+    def free_energy(self, charges, reference):
+        '''
+        Exponential averaging of the energy change from the reference charges to each set of charges.
+        :return: list of free energies in kcal/mol
+        '''
+        delta_u = self.delta_energy(charges) - self.delta_energy(reference)
+        return list(exp_average(delta_u, self.kT))
+
+
+def get_electrostatics(system):
+    '''
+    Pull charges and electrostatic treatment out of the NonbondedForce of an OpenMM system
+    '''
+    forces = [x for x in system.getForces() if isinstance(x, mm.NonbondedForce)]
+    if len(forces) != 1:
+        raise ValueError('Expected one NonbondedForce in system found {}'.format(len(forces)))
+    force = forces[0]
+    settings = {'method': force.getNonbondedMethod(),
+                'cutoff': strip_unit(force.getCutoffDistance(), unit.nanometer),
+                'dielectric': force.getReactionFieldDielectric()}
+    settings['charges'] = np.array([strip_unit(force.getParticleParameters(i)[0], unit.elementary_charge)
+                                    for i in range(force.getNumParticles())])
+    settings['tolerance'] = force.getEwaldErrorTolerance()
+    alpha, nx, ny, nz = force.getPMEParameters()
+    alpha = strip_unit(alpha, unit.nanometer**-1)
+    if alpha == 0.0:
+        # same default OpenMM picks from the error tolerance
+        alpha = np.sqrt(-np.log(2.0 * settings['tolerance'])) / settings['cutoff']
+    settings['alpha'] = alpha
+    settings['grid'] = None if nx == 0 else [nx, ny, nz]
+    return settings
+
+
+def self_image_potential(box, alpha, precision=1e-12):
+    '''
+    Potential of the periodic images of a unit charge, with the neutralising background, at the position
+    of the charge by Ewald summation in e/nm
+    '''
+    volume = np.linalg.det(box)
+    recip = 2.0 * np.pi * np.linalg.inv(box).T
+    # reciprocal vectors up to where exp(-k^2/4alpha^2) falls below precision
+    k_max = 2.0 * alpha * np.sqrt(-np.log(precision))
+    n_max = int(np.ceil(k_max / np.min(np.linalg.norm(recip, axis=1))))
+    n = np.stack(np.meshgrid(*[np.arange(-n_max, n_max + 1)] * 3, indexing='ij'), -1).reshape(-1, 3)
+    n = n[np.any(n != 0, axis=1)]
+    k2 = np.sum((n @ recip) ** 2, axis=1)
+    reciprocal = 4.0 * np.pi / volume * np.sum(np.exp(-k2 / (4.0 * alpha ** 2)) / k2)
+    m = np.stack(np.meshgrid(*[np.arange(-1, 2)] * 3, indexing='ij'), -1).reshape(-1, 3)
+    r = np.linalg.norm(m[np.any(m != 0, axis=1)] @ box, axis=1)
+    real = np.sum(erfc(alpha * r) / r)
+    return reciprocal + real - 2.0 * alpha / np.sqrt(np.pi) - np.pi / (alpha ** 2 * volume)
+
+
+def strip_unit(quantity, units):
+    if unit.is_quantity(quantity):
+        return quantity.value_in_unit(units)
+    return quantity
+
+
+def pair_kernel(r, settings):
+    '''
+    Coulomb kernel for non excluded pairs, 1/r modified by the electrostatic treatment of the system
+    '''
+    method = settings['method']
+    if method == mm.NonbondedForce.NoCutoff:
+        return 1.0 / r
+    elif method in [mm.NonbondedForce.CutoffNonPeriodic, mm.NonbondedForce.CutoffPeriodic]:
+        cutoff = settings['cutoff']
+        dielectric = settings['dielectric']
+        k_rf = (dielectric - 1.0) / ((2.0 * dielectric + 1.0) * cutoff**3)
+        c_rf = 3.0 * dielectric / ((2.0 * dielectric + 1.0) * cutoff)
+        return 1.0 / r + k_rf * r**2 - c_rf
+    else:
+        return erfc(settings['alpha'] * r) / r
+
+
+def minimum_image(delta, box):
+    '''
+    Minimum image convention for OpenMM reduced triclinic box vectors (rows of box)
+    '''
+    delta = delta - np.round(delta[..., 2:3] / box[2, 2]) * box[2]
+    delta = delta - np.round(delta[..., 1:2] / box[1, 1]) * box[1]
+    delta = delta - np.round(delta[..., 0:1] / box[0, 0]) * box[0]
+    return delta
+
+
+def bspline(dr, order):
+    '''
+    Cardinal B-spline weights of the PME charge spreading, shape dr.shape + (order,)
+    '''
+    data = np.zeros(dr.shape + (order,))
+    data[..., 1] = dr
+    data[..., 0] = 1.0 - dr
+    for k in range(3, order + 1):
+        div = 1.0 / (k - 1)
+        data[..., k - 1] = div * dr * data[..., k - 2]
+        for l in range(1, k - 1):
+            data[..., k - l - 1] = div * ((dr + l) * data[..., k - l - 2] + (k - l - dr) * data[..., k - l - 1])
+        data[..., 0] = div * (1.0 - dr) * data[..., 0]
+    return data
+
+
+def bspline_moduli(size, order):
+    weights = np.zeros(size)
+    weights[:order] = bspline(np.zeros(1), order)[0]
+    moduli = np.abs(np.fft.fft(weights))**2
+    # odd order splines vanish at the Nyquist frequency, interpolate as OpenMM does
+    for i in np.where(moduli < 1e-7)[0]:
+        moduli[i] = 0.5 * (moduli[i - 1] + moduli[(i + 1) % size])
+    return moduli
+
+
+def pme_grid(box, settings):
+    if settings['grid'] is not None:
+        return settings['grid']
+    lengths = np.linalg.norm(box, axis=1)
+    size = np.ceil(2.0 * settings['alpha'] * lengths / (3.0 * settings['tolerance']**0.2))
+    return [max(int(x), 6) for x in size]
+
+
+def reciprocal_potential(positions, charges, box, settings, targets):
+    '''
+    Smooth PME reciprocal space potential at positions[targets] in units of e/nm.
+    '''
+    grid = np.array(pme_grid(box, settings))
+    alpha = settings['alpha']
+    recip = np.linalg.inv(box).T
+    frac = positions @ recip.T
+    frac = frac - np.floor(frac)
+    u = frac * grid
+    base = np.floor(u).astype(int)
+    theta = bspline(u - base, PME_ORDER)
+
+    # flat grid index and weight of every point each atom is spread onto
+    offsets = np.arange(PME_ORDER)
+    ix = (base[:, 0, np.newaxis] + offsets) % grid[0]
+    iy = (base[:, 1, np.newaxis] + offsets) % grid[1]
+    iz = (base[:, 2, np.newaxis] + offsets) % grid[2]
+    index = (ix[:, :, None, None] * grid[1] + iy[:, None, :, None]) * grid[2] + iz[:, None, None, :]
+    weight = theta[:, 0, :, None, None] * theta[:, 1, None, :, None] * theta[:, 2, None, None, :]
+
+    q_grid = np.bincount(index.ravel(), weights=(charges[:, None, None, None] * weight).ravel(),
+                         minlength=np.prod(grid)).reshape(grid)
+
+    m = [np.fft.fftfreq(n, 1.0 / n) for n in grid]
+    m_vec = (m[0][:, None, None, None] * recip[0] + m[1][None, :, None, None] * recip[1] +
+             m[2][None, None, :, None] * recip[2])
+    m2 = np.sum(m_vec**2, axis=-1)
+    m2[0, 0, 0] = 1.0
+    volume = np.linalg.det(box)
+    moduli = (bspline_moduli(grid[0], PME_ORDER)[:, None, None] * bspline_moduli(grid[1], PME_ORDER)[None, :, None] *
+              bspline_moduli(grid[2], PME_ORDER)[None, None, :])
+    eterm = np.exp(-np.pi**2 * m2 / alpha**2) / (np.pi * volume * m2 * moduli)
+    eterm[0, 0, 0] = 0.0
+
+    convolution = np.real(np.fft.ifftn(eterm * np.fft.fftn(q_grid))) * np.prod(grid)
+    return np.sum(convolution.ravel()[index[targets]] * weight[targets], axis=(1, 2, 3))
+
+
+def exp_average(delta_u, kT):
+    '''
+    Zwanzig exponential average over the last axis of delta_u
+    '''
+    x = -np.asarray(delta_u) / kT
+    x_max = np.max(x, axis=-1, keepdims=True)
+    return -kT * (np.log(np.mean(np.exp(x - x_max), axis=-1)) + x_max[..., 0])
+
+
+def exp_error(delta_u, kT):
+    '''
+    Asymptotic error of the exponential average over the last axis of delta_u, from the variance of the
+    Boltzmann factors of uncorrelated frames
+    '''
+    x = -np.asarray(delta_u) / kT
+    weights = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    variance = np.var(weights, axis=-1) / np.mean(weights, axis=-1)**2 / x.shape[-1]
+    return kT * np.sqrt(variance)
+
+
+def effective_sample_size(delta_u, kT):
+    '''
+    Kish effective sample size of the exponential average over the last axis of delta_u as a fraction
+    of the number of frames, 1 when every frame has the same weight
+    '''
+    x = -np.asarray(delta_u) / kT
+    weights = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return np.sum(weights, axis=-1)**2 / np.sum(weights**2, axis=-1) / x.shape[-1]
+
+
+def bar(w_forward, w_reverse, kT):
+    '''
+    Bennett acceptance ratio free energy between two states with its asymptotic error
+    :param w_forward: energy change from state 0 to state 1 on frames sampled at state 0
+    :param w_reverse: energy change from state 1 to state 0 on frames sampled at state 1
+    :return: free energy of state 1 relative to state 0 and its error
+    '''
+    w_forward = np.asarray(w_forward, dtype=np.float64) / kT
+    w_reverse = np.asarray(w_reverse, dtype=np.float64) / kT
+    m = np.log(len(w_forward) / len(w_reverse))
+
+    def fermi(x):
+        # 1/(1 + e^x) without overflow
+        return 0.5 * (1.0 - np.tanh(0.5 * x))
+
+    def imbalance(f):
+        return np.sum(fermi(m + w_forward - f)) - np.sum(fermi(-m + w_reverse + f))
+
+    # the imbalance grows with f so the root is bracketed by stepping out from the forward estimate
+    f = exp_average(w_forward, 1.0)
+    step = 1.0
+    low, high = f - step, f + step
+    while imbalance(low) > 0.0:
+        step *= 2.0
+        low -= step
+    while imbalance(high) < 0.0:
+        step *= 2.0
+        high += step
+    f = brentq(imbalance, low, high, xtol=1e-10)
+
+    forward = fermi(m + w_forward - f)
+    reverse = fermi(-m + w_reverse + f)
+    variance = (np.mean(forward**2) / np.mean(forward)**2 - 1.0) / len(w_forward) + \
+               (np.mean(reverse**2) / np.mean(reverse)**2 - 1.0) / len(w_reverse)
+    return f * kT, np.sqrt(max(variance, 0.0)) * kT
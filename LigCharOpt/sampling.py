@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+#CONSTANTS
+NUM_BOOTSTRAP = 200
+
+
+def block_size(num_frames):
+    '''
+    Length of the blocks of consecutive frames resampled together, long enough to carry the
+    correlation between neighbouring frames
+    '''
+    return max(1, int(round(num_frames ** (1.0 / 3.0))))
+
+
+def block_bootstrap(samples, size=None, num_bootstrap=NUM_BOOTSTRAP, rng=None):
+    '''
+    Bootstrap the mean over frames, resampling blocks of consecutive frames.
+    :param samples: array with frames along the first axis
+    :param size: block length, defaults to block_size
+    :return: array of bootstrapped means with shape (num_bootstrap,) + samples.shape[1:]
+    '''
+    samples = np.asarray(samples)
+    num_frames = len(samples)
+    if size is None:
+        size = block_size(num_frames)
+    num_blocks = int(np.ceil(num_frames / size))
+    if rng is None:
+        rng = np.random.default_rng()
+    starts = rng.integers(0, num_frames - size + 1, size=(num_bootstrap, num_blocks))
+    index = (starts[:, :, np.newaxis] + np.arange(size)).reshape(num_bootstrap, -1)[:, :num_frames]
+    return np.mean(samples[index], axis=1)
+
+
+def gradient_error(complex_derivatives, solvent_derivatives, project=None, seed=None):
+    '''
+    Relative statistical error of the gradient direction from per frame derivatives of each phase.
+    :param complex_derivatives: dU/dparam of every frame of the complex, shape (num_frames, num_params)
+    :param solvent_derivatives: the same for the solvent
+    :param project: function applied to every gradient before comparing, e.g. the net charge projection
+    :return: root mean square deviation of the bootstrapped gradients over the norm of the gradient
+    '''
+    if project is None:
+        project = lambda x: x
+    grad = project(np.mean(complex_derivatives, axis=0) - np.mean(solvent_derivatives, axis=0))
+    rng = np.random.default_rng(seed)
+    samples = block_bootstrap(complex_derivatives, rng=rng) - block_bootstrap(solvent_derivatives, rng=rng)
+    deviation = np.array([project(x) for x in samples]) - grad
+    norm = np.linalg.norm(grad)
+    if norm == 0.0:
+        return np.inf
+    return float(np.sqrt(np.mean(np.sum(deviation**2, axis=1))) / norm)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing as mp
+import numpy as np
+import pickle
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def split_devices(devices, costs):
+    '''
+    Share devices between legs in proportion to their expected cost, every leg gets at least one.
+    With fewer devices than legs all legs share all devices.
+    :param devices: list of device ids
+    :param costs: expected cost of each leg, e.g. number of particles
+    :return: list of device ids for each leg
+    '''
+    if len(devices) < len(costs):
+        return [list(devices) for x in costs]
+    share = np.array(costs, dtype=np.float64) / np.sum(costs) * len(devices)
+    counts = np.maximum(np.floor(share).astype(int), 1)
+    # hand out the remainder by largest fractional part, take back from the largest legs if over
+    while np.sum(counts) < len(devices):
+        counts[np.argmax(share - counts)] += 1
+    while np.sum(counts) > len(devices):
+        counts[np.argmax(np.where(counts > 1, counts - share, -np.inf))] -= 1
+    split = []
+    start = 0
+    for count in counts:
+        split.append(list(devices[start:start+count]))
+        start += count
+    return split
+
+
+def share_devices(devices, num_groups):
+    '''
+    Split devices evenly between groups, with fewer devices than groups every group gets one device
+    and the devices are shared round robin
+    :return: list of device ids for each group
+    '''
+    if len(devices) < num_groups:
+        return [[devices[x % len(devices)]] for x in range(num_groups)]
+    return split_devices(devices, [1] * num_groups)
+
+
+def get_devices(num_gpu):
+    '''
+    Device ids visible to this process, honouring CUDA_VISIBLE_DEVICES
+    '''
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible:
+        return [x.strip() for x in visible.split(',') if x.strip()][:num_gpu]
+    return [str(x) for x in range(num_gpu)]
+
+
+def run_leg(leg, connection):
+    '''
+    Run one leg in a process which only sees its share of the devices and send back its result
+    '''
+    fsim, method, args, kwargs, devices = leg
+    os.environ['CUDA_VISIBLE_DEVICES'] = ','.join(devices)
+    fsim.num_gpu = len(devices)
+    try:
+        connection.send([getattr(fsim, method)(*args, **kwargs), None])
+    except Exception as err:
+        connection.send([None, err])
+    finally:
+        connection.close()
+
+
+def run_legs(legs, costs, num_gpu, devices=None):
+    '''
+    Run the complex and solvent legs at the same time and wait for both.
+    Each leg runs in its own process with its share of the GPUs, if a leg can not be sent to
+    another process the legs run in threads of this process sharing all GPUs.
+    :param legs: list of [FSim, method name, args, kwargs] for each leg
+    :param costs: expected cost of each leg
+    :param num_gpu: number of GPUs of the node
+    :param devices: device ids of each leg, None to split the GPUs between the legs by cost
+    :return: list of the return value of each leg
+    '''
+    split = split_devices(get_devices(num_gpu), costs) if devices is None else devices
+    tasks = [list(leg) + [devices] for leg, devices in zip(legs, split)]
+    try:
+        for task in tasks:
+            pickle.dumps(task)
+    except Exception as err:
+        logger.warning('Could not send legs to worker processes ({}), running them in threads'.format(err))
+        with ThreadPoolExecutor(len(legs)) as executor:
+            futures = [executor.submit(getattr(fsim, method), *args, **kwargs) for fsim, method, args, kwargs in legs]
+            return [x.result() for x in futures]
+
+    print('Running {} legs concurrently on devices {}'.format(len(tasks), split))
+    # legs start their own worker pools so are run in plain, non daemonic, processes
+    context = mp.get_context('spawn')
+    connections = []
+    processes = []
+    for task in tasks:
+        receive, send = context.Pipe(duplex=False)
+        process = context.Process(target=run_leg, args=(task, send))
+        process.start()
+        send.close()
+        connections.append(receive)
+        processes.append(process)
+    results = []
+    errors = []
+    for connection, process in zip(connections, processes):
+        try:
+            result, err = connection.recv()
+        except EOFError:
+            result, err = None, RuntimeError('Leg process exited with code {}'.format(process.exitcode))
+        process.join()
+        results.append(result)
+        errors.append(err)
+    for err in errors:
+        if err is not None:
+            raise err
+    return results
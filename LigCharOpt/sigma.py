@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+from simtk import openmm as mm
+from simtk import unit
+from .potential import minimum_image, strip_unit
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SigmaDerivative(object):
+    def __init__(self, system, frames, ligand_atoms):
+        '''
+        Analytic derivative of the Lennard-Jones energy with respect to the sigma of every ligand atom
+        for every frame of a trajectory. Exceptions are scaled with the mean sigma of their atoms, as
+        in ParameterModel, and the scale and epsilon of each exception are read from the system.
+        :param system: OpenMM system of the phase
+        :param frames: FrameStore of the phase trajectory
+        :param ligand_atoms: indices of the ligand atoms in the system
+        '''
+        self.ligand_atoms = np.array(ligand_atoms)
+        self.settings = get_lennard_jones(system, self.ligand_atoms)
+
+        self.frames = frames
+        self.num_frames = frames.num_frames
+        self.cached = None
+
+    def derivative(self, sigmas):
+        '''
+        :param sigmas: ligand sigmas in nm
+        :return: dU/dsigma in kcal/mol/nm with shape (num_frames, num_ligand_atoms)
+        '''
+        sigmas = np.array(sigmas, dtype=np.float64)
+        key = sigmas.tobytes()
+        if self.cached is not None and self.cached[0] == key:
+            return self.cached[1]
+        derivative = np.zeros((self.num_frames, len(self.ligand_atoms)))
+        for frame in range(self.num_frames):
+            positions, box = self.frames.frame(frame)
+            box = None if box is None else np.array(box, dtype=np.float64)
+            positions = np.array(positions, dtype=np.float64)
+            derivative[frame] = SigmaDerivative.frame_derivative(self, positions, box, sigmas)
+        self.cached = [key, derivative]
+        return derivative
+
+    def gradient(self, sigmas):
+        '''
+        Derivative of the exponential average at zero perturbation is the ensemble average of dU/dsigma
+        '''
+        return np.mean(SigmaDerivative.derivative(self, sigmas), axis=0)
+
+    def frame_derivative(self, positions, box, sigmas):
+        settings = self.settings
+        periodic = settings['method'] not in [mm.NonbondedForce.NoCutoff, mm.NonbondedForce.CutoffNonPeriodic]
+
+        all_sigmas = settings['sigmas'].copy()
+        all_sigmas[self.ligand_atoms] = sigmas
+        ligand_epsilons = settings['epsilons'][self.ligand_atoms]
+
+        delta = positions[np.newaxis, :, :] - positions[self.ligand_atoms][:, np.newaxis, :]
+        if periodic:
+            delta = minimum_image(delta, box)
+        r = np.linalg.norm(delta, axis=2)
+        mask = np.ones(r.shape, dtype=bool)
+        mask[:, self.ligand_atoms] = ~settings['is_exception']
+        if settings['method'] != mm.NonbondedForce.NoCutoff:
+            mask &= r < settings['cutoff']
+        i, j = np.nonzero(mask)
+        r = r[i, j]
+        sigma = 0.5 * (sigmas[i] + all_sigmas[j])
+        epsilon = np.sqrt(ligand_epsilons[i] * settings['epsilons'][j])
+        s6 = (sigma / r)**6
+        # d/dsigma_i of 4eps(s^12 - s^6) with dsigma_ij/dsigma_i = 1/2
+        term = epsilon / sigma * (24.0 * s6**2 - 12.0 * s6)
+        if settings['switch'] is not None:
+            x = np.clip((r - settings['switch']) / (settings['cutoff'] - settings['switch']), 0.0, 1.0)
+            term *= 1.0 - 10.0 * x**3 + 15.0 * x**4 - 6.0 * x**5
+        derivative = np.bincount(i, weights=term, minlength=len(sigmas))
+
+        # intra-ligand exceptions, sigma = scale * mean sigma
+        r_lig = np.linalg.norm(delta[:, self.ligand_atoms], axis=2)
+        np.fill_diagonal(r_lig, 1.0)
+        excep_sigma = settings['excep_scale'] * 0.5 * (sigmas[:, np.newaxis] + sigmas[np.newaxis, :])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s6 = (excep_sigma / r_lig)**6
+            term = np.where(settings['excep_epsilon'] > 0.0, settings['excep_epsilon'] / excep_sigma *
+                            settings['excep_scale'] * (24.0 * s6**2 - 12.0 * s6), 0.0)
+        derivative += np.sum(term, axis=1)
+
+        if settings['dispersion_correction'] and periodic:
+            derivative += dispersion_derivative(settings, all_sigmas, self.ligand_atoms) / np.linalg.det(box)
+
+        return derivative
+
+
+def get_lennard_jones(system, ligand_atoms):
+    '''
+    Pull Lennard-Jones parameters and treatment out of the NonbondedForce of an OpenMM system
+    '''
+    forces = [x for x in system.getForces() if isinstance(x, mm.NonbondedForce)]
+    if len(forces) != 1:
+        raise ValueError('Expected one NonbondedForce in system found {}'.format(len(forces)))
+    force = forces[0]
+    settings = {'method': force.getNonbondedMethod(),
+                'cutoff': strip_unit(force.getCutoffDistance(), unit.nanometer),
+                'dispersion_correction': force.getUseDispersionCorrection()}
+    if force.getUseSwitchingFunction():
+        settings['switch'] = strip_unit(force.getSwitchingDistance(), unit.nanometer)
+    else:
+        settings['switch'] = None
+    params = [force.getParticleParameters(i) for i in range(force.getNumParticles())]
+    settings['sigmas'] = np.array([strip_unit(x[1], unit.nanometer) for x in params])
+    settings['epsilons'] = np.array([energy_value(x[2]) for x in params])
+
+    num_ligand_atoms = len(ligand_atoms)
+    local = {atom: i for i, atom in enumerate(ligand_atoms)}
+    settings['is_exception'] = np.eye(num_ligand_atoms, dtype=bool)
+    settings['excep_scale'] = np.zeros((num_ligand_atoms, num_ligand_atoms))
+    settings['excep_epsilon'] = np.zeros((num_ligand_atoms, num_ligand_atoms))
+    wt_sigmas = settings['sigmas'][ligand_atoms]
+    for index in range(force.getNumExceptions()):
+        i, j, charge_product, sigma, epsilon = force.getExceptionParameters(index)
+        if i not in local or j not in local:
+            continue
+        i, j = local[i], local[j]
+        epsilon = energy_value(epsilon)
+        sigma_mean = 0.5 * (wt_sigmas[i] + wt_sigmas[j])
+        scale = strip_unit(sigma, unit.nanometer) / sigma_mean if sigma_mean != 0.0 else 0.0
+        settings['is_exception'][i, j] = settings['is_exception'][j, i] = True
+        settings['excep_scale'][i, j] = settings['excep_scale'][j, i] = scale
+        settings['excep_epsilon'][i, j] = settings['excep_epsilon'][j, i] = epsilon
+    return settings
+
+
+def energy_value(energy):
+    '''
+    Energy in kcal/mol, bare OpenMM values are kJ/mol
+    '''
+    if unit.is_quantity(energy):
+        return energy.value_in_unit(unit.kilocalories_per_mole)
+    return energy / 4.184
+
+
+def dispersion_coefficients(settings):
+    '''
+    Coefficients c12, c6 of the long range dispersion correction of one pair, eps (c12 sigma^12 - c6 sigma^6),
+    from the cutoff onwards plus the energy removed by the switching function between the switch and the cutoff
+    '''
+    cutoff = settings['cutoff']
+    c12 = 1.0 / (9.0 * cutoff**9)
+    c6 = 1.0 / (3.0 * cutoff**3)
+    if settings['switch'] is not None:
+        # integrate (1 - S(r)) r^2 / r^n over the switching region
+        nodes, weights = np.polynomial.legendre.leggauss(32)
+        half = 0.5 * (cutoff - settings['switch'])
+        r = settings['switch'] + half * (nodes + 1.0)
+        x = (r - settings['switch']) / (cutoff - settings['switch'])
+        switch = 1.0 - 10.0 * x**3 + 15.0 * x**4 - 6.0 * x**5
+        c12 += half * np.sum(weights * (1.0 - switch) * r**-10)
+        c6 += half * np.sum(weights * (1.0 - switch) * r**-4)
+    return c12, c6
+
+
+def dispersion_derivative(settings, all_sigmas, ligand_atoms):
+    '''
+    Derivative of the OpenMM long range dispersion correction times the box volume,
+        E = 8 pi N^2 / V <eps (c12 sigma^12 - c6 sigma^6)>
+    averaged over all N(N+1)/2 pairs including self pairs
+    '''
+    c12, c6 = dispersion_coefficients(settings)
+    num_particles = len(all_sigmas)
+    prefactor = 8.0 * np.pi * num_particles**2 / (num_particles * (num_particles + 1) / 2.0)
+    derivative = np.zeros(len(ligand_atoms))
+    for n, atom in enumerate(ligand_atoms):
+        sigma = 0.5 * (all_sigmas[atom] + all_sigmas)
+        epsilon = np.sqrt(settings['epsilons'][atom] * settings['epsilons'])
+        # pairs with every other particle see half of the change, the self pair all of it
+        d_pair = epsilon * (12.0 * c12 * sigma**11 - 6.0 * c6 * sigma**5)
+        derivative[n] = 0.5 * (np.sum(d_pair) - d_pair[atom]) + d_pair[atom]
+    return prefactor * derivative
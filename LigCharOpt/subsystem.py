@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+from simtk import openmm as mm
+from .potential import PotentialCache, minimum_image, exp_average, kB
+from .sigma import get_lennard_jones, dispersion_coefficients
+from .parallel import nonbonded_context, nonbonded_energies, pack_params
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+#CONSTANTS
+# frames compared against the full system energy
+VALIDATION_FRAMES = 5
+# perturbation validated against the full system, a line search sized change of every charge in e
+# and of every sigma as a fraction of the sigma
+VALIDATION_CHARGE_STEP = 0.05
+VALIDATION_SIGMA_STEP = 0.05
+# largest deviation from the full system energy change relative to the largest energy change
+VALIDATION_TOLERANCE = 1e-03
+# energy change in kcal/mol below which deviations are taken relative to this value instead
+VALIDATION_FLOOR = 1.0
+
+
+class LigandEnergy(object):
+    def __init__(self, system, frames, ligand_atoms, sampled_params, exceptions, temperature=300.0):
+        '''
+        Energy change of ligand parameter perturbations from only the terms involving ligand atoms.
+        Electrostatics come from the potentials cached by PotentialCache and Lennard-Jones from a
+        neighbour list of the ligand built once per frame with the cutoff of the system, so no
+        solvent-solvent pair is ever evaluated.
+        :param system: OpenMM system of the phase
+        :param frames: FrameStore of the phase trajectory
+        :param ligand_atoms: indices of the ligand atoms in the system
+        :param sampled_params: concatenated [charges, sigmas] the trajectory was sampled with
+        :param exceptions: list of (i, j, scale) as taken by PotentialCache
+        '''
+        self.kT = kB * temperature
+        self.frames = frames
+        self.ligand_atoms = np.array(ligand_atoms)
+        self.num_atoms = len(self.ligand_atoms)
+        self.num_frames = frames.num_frames
+        sampled_params = np.array(sampled_params, dtype=np.float64)
+        self.electrostatics = PotentialCache(system, frames, self.ligand_atoms, sampled_params[:self.num_atoms],
+                                             exceptions, temperature)
+        self.settings = get_lennard_jones(system, self.ligand_atoms)
+
+        settings = self.settings
+        self.periodic = settings['method'] not in [mm.NonbondedForce.NoCutoff, mm.NonbondedForce.CutoffNonPeriodic]
+        environment = np.ones(len(settings['sigmas']), dtype=bool)
+        environment[self.ligand_atoms] = False
+        self.environment = np.where(environment)[0]
+
+        # ligand pairs are held once with i < j, exceptions only where they carry an epsilon
+        upper = np.triu(np.ones((self.num_atoms, self.num_atoms), dtype=bool), 1)
+        self.pair_i, self.pair_j = np.nonzero(upper & ~settings['is_exception'])
+        self.excep_i, self.excep_j = np.nonzero(upper & (settings['excep_epsilon'] > 0.0))
+
+        print('Building ligand neighbour lists over {} frames...'.format(self.num_frames))
+        self.neighbours = []
+        self.excep_r = np.zeros((self.num_frames, len(self.excep_i)))
+        self.volume = np.ones(self.num_frames)
+        for frame in range(self.num_frames):
+            positions, box = frames.frame(frame)
+            box = None if box is None else np.array(box, dtype=np.float64)
+            positions = np.array(positions, dtype=np.float64)
+            self.neighbours.append(LigandEnergy.neighbour_list(self, positions, box))
+            ligand_positions = positions[self.ligand_atoms]
+            delta = ligand_positions[self.excep_j] - ligand_positions[self.excep_i]
+            if self.periodic:
+                delta = minimum_image(delta, box)
+                self.volume[frame] = np.linalg.det(box)
+            self.excep_r[frame] = np.linalg.norm(delta, axis=1)
+
+    def neighbour_list(self, positions, box):
+        '''
+        Lennard-Jones pairs of the ligand within the cutoff of one frame
+        :return: [ligand atom, environment atom, 1/r^6, switch] of ligand-environment pairs and
+                 [1/r^6, switch] of the ligand-ligand pairs in pair_i, pair_j
+        '''
+        settings = self.settings
+        ligand_positions = positions[self.ligand_atoms]
+        delta = positions[self.environment][np.newaxis, :, :] - ligand_positions[:, np.newaxis, :]
+        if self.periodic:
+            delta = minimum_image(delta, box)
+        r = np.linalg.norm(delta, axis=2)
+        if settings['method'] != mm.NonbondedForce.NoCutoff:
+            i, j = np.nonzero(r < settings['cutoff'])
+        else:
+            i, j = np.nonzero(np.ones(r.shape, dtype=bool))
+        r = r[i, j]
+
+        delta = ligand_positions[self.pair_j] - ligand_positions[self.pair_i]
+        if self.periodic:
+            delta = minimum_image(delta, box)
+        r_lig = np.linalg.norm(delta, axis=1)
+        # pairs beyond the cutoff are kept with a switch of zero so pair_i, pair_j stay aligned
+        switch_lig = LigandEnergy.switch(self, r_lig)
+        return [i, self.environment[j], r**-6, LigandEnergy.switch(self, r), r_lig**-6, switch_lig]
+
+    def switch(self, r):
+        settings = self.settings
+        if settings['method'] == mm.NonbondedForce.NoCutoff:
+            return np.ones(r.shape)
+        switch = (r < settings['cutoff']).astype(np.float64)
+        if settings['switch'] is not None:
+            x = np.clip((r - settings['switch']) / (settings['cutoff'] - settings['switch']), 0.0, 1.0)
+            switch *= 1.0 - 10.0 * x**3 + 15.0 * x**4 - 6.0 * x**5
+        return switch
+
+    def lennard_jones(self, sigmas, epsilons=None):
+        '''
+        Lennard-Jones energy of every term involving a ligand atom
+        :param sigmas: ligand sigmas with shape (num_systems, num_ligand_atoms)
+        :param epsilons: ligand epsilons in kcal/mol with the shape of sigmas, None for those of the system
+        :return: energies in kcal/mol with shape (num_systems, num_frames)
+        '''
+        settings = self.settings
+        sigmas = np.atleast_2d(np.array(sigmas, dtype=np.float64))
+        if epsilons is None:
+            ligand_epsilons = np.tile(settings['epsilons'][self.ligand_atoms], (len(sigmas), 1))
+        else:
+            ligand_epsilons = np.atleast_2d(np.array(epsilons, dtype=np.float64))
+        pair_epsilon = np.sqrt(ligand_epsilons[:, self.pair_i] * ligand_epsilons[:, self.pair_j])
+        pair_sigma = 0.5 * (sigmas[:, self.pair_i] + sigmas[:, self.pair_j])
+
+        energy = np.zeros((len(sigmas), self.num_frames))
+        for frame, (i, j, inv_r6, switch, inv_r6_lig, switch_lig) in enumerate(self.neighbours):
+            sigma = 0.5 * (sigmas[:, i] + settings['sigmas'][j])
+            epsilon = np.sqrt(ligand_epsilons[:, i] * settings['epsilons'][j])
+            energy[:, frame] = lj_energy(sigma, epsilon * switch, inv_r6) + \
+                               lj_energy(pair_sigma, pair_epsilon * switch_lig, inv_r6_lig)
+
+        # intra-ligand exceptions, sigma = scale * mean sigma
+        excep_sigma = settings['excep_scale'][self.excep_i, self.excep_j] * \
+                      0.5 * (sigmas[:, self.excep_i] + sigmas[:, self.excep_j])
+        excep_epsilon = settings['excep_epsilon'][self.excep_i, self.excep_j]
+        s6 = (excep_sigma[:, np.newaxis, :]**2 / self.excep_r[np.newaxis, :, :]**2)**3
+        energy += np.sum(4.0 * excep_epsilon * (s6**2 - s6), axis=2)
+
+        if settings['dispersion_correction'] and self.periodic:
+            energy += dispersion_energy(settings, sigmas, ligand_epsilons, self.environment)[:, np.newaxis] / \
+                      self.volume[np.newaxis, :]
+        return energy
+
+    def delta_energy(self, params, epsilons=None):
+        '''
+        :param params: concatenated [charges, sigmas] with shape (num_systems, 2*num_ligand_atoms)
+        :param epsilons: ligand epsilons of each system in kcal/mol, None for those of the system
+        :return: energy of each system relative to a fixed offset in kcal/mol, shape (num_systems, num_frames),
+                 only differences between systems are meaningful
+        '''
+        params = np.atleast_2d(np.array(params, dtype=np.float64))
+        charges = params[:, :self.num_atoms]
+        sigmas = params[:, self.num_atoms:2*self.num_atoms]
+        return self.electrostatics.delta_energy(charges) + LigandEnergy.lennard_jones(self, sigmas, epsilons)
+
+    def free_energy(self, params, reference):
+        '''
+        Exponential averaging of the energy change from the reference parameters to each set of parameters.
+        :return: list of free energies in kcal/mol
+        '''
+        delta_u = LigandEnergy.delta_energy(self, params) - LigandEnergy.delta_energy(self, reference)
+        return list(exp_average(delta_u, self.kT))
+
+    def validate(self, system, param_model, params, reference, num_frames=VALIDATION_FRAMES):
+        '''
+        Compare energy changes against the nonbonded energy of the full system on a few frames.
+        :param param_model: ParameterModel giving the exceptions of params
+        :return: largest absolute error relative to the largest energy change of the full system,
+                 or to VALIDATION_FLOOR if that is smaller
+        '''
+        return validation_error(system, self.frames, self.ligand_atoms, param_model, params, reference,
+                                lambda x: LigandEnergy.delta_energy(self, x), num_frames)
+
+
+def validation_error(system, frames, ligand_atoms, param_model, params, reference, delta_energy,
+                     num_frames=VALIDATION_FRAMES):
+    '''
+    Compare the energy change from reference to params of an evaluator against the nonbonded energy of the
+    full system on a few frames.
+    :param frames: FrameStore the evaluator was built over
+    :param delta_energy: function of a list of concatenated [charges, sigmas] giving the energy change of
+                         each on every frame in kcal/mol, relative to any fixed offset
+    :return: largest absolute error relative to the largest energy change of the full system,
+             or to VALIDATION_FLOOR if that is smaller
+    '''
+    indices = np.unique(np.linspace(0, frames.num_frames - 1, num_frames).astype(int))
+    exceptions = [list(param_model.excep_i), list(param_model.excep_j)]
+    state = nonbonded_context(mm.XmlSerializer.serialize(system), list(ligand_atoms), exceptions)
+    rows = pack_params(param_model, [params, reference])
+    full = nonbonded_energies(state, rows[0], frames.subset(indices)) - \
+           nonbonded_energies(state, rows[1], frames.subset(indices))
+    engine = np.array(delta_energy([params, reference]))
+    engine = engine[0, indices] - engine[1, indices]
+    return float(np.max(np.abs(full - engine)) / max(np.max(np.abs(full)), VALIDATION_FLOOR))
+
+
+def validation_params(params, sigmas=True):
+    '''
+    Finite perturbation of every charge and sigma of the concatenated [charges, sigmas] params with
+    alternating signs, so both the electrostatic and Lennard-Jones terms are validated on a realistic step.
+    The net charge is kept, as it is by every optimisation step.
+    :param sigmas: perturb the sigmas as well as the charges
+    '''
+    params = np.array(params, dtype=np.float64)
+    num_atoms = len(params) // 2
+    signs = np.where(np.arange(num_atoms) % 2 == 0, 1.0, -1.0)
+    params[:num_atoms] += VALIDATION_CHARGE_STEP * (signs - np.mean(signs))
+    if sigmas:
+        params[num_atoms:2*num_atoms] *= 1.0 + VALIDATION_SIGMA_STEP * signs
+    return params
+
+
+def lj_energy(sigma, epsilon, inv_r6):
+    '''
+    Sum of 4eps(s^12 - s^6) over the last axis
+    '''
+    s6 = sigma**6 * inv_r6
+    return np.sum(4.0 * epsilon * (s6**2 - s6), axis=-1)
+
+
+def dispersion_energy(settings, sigmas, ligand_epsilons, environment):
+    '''
+    Ligand dependent part of the OpenMM long range dispersion correction times the box volume,
+        E = 8 pi N^2 / V <eps (c12 sigma^12 - c6 sigma^6)>
+    averaged over all N(N+1)/2 pairs including self pairs. Environment atoms are grouped by type.
+    :param sigmas: ligand sigmas with shape (num_systems, num_ligand_atoms)
+    :param ligand_epsilons: ligand epsilons with the shape of sigmas
+    :return: array with shape (num_systems,)
+    '''
+    c12, c6 = dispersion_coefficients(settings)
+    num_particles = len(settings['sigmas'])
+    prefactor = 8.0 * np.pi * num_particles**2 / (num_particles * (num_particles + 1) / 2.0)
+
+    def pair_term(sigma, epsilon):
+        return epsilon * (c12 * sigma**12 - c6 * sigma**6)
+
+    types, counts = np.unique(np.stack([settings['sigmas'][environment], settings['epsilons'][environment]], axis=1),
+                              axis=0, return_counts=True)
+    # ligand-environment pairs
+    total = np.sum(counts * pair_term(0.5 * (sigmas[:, :, np.newaxis] + types[:, 0]),
+                                      np.sqrt(ligand_epsilons[:, :, np.newaxis] * types[:, 1])), axis=(1, 2))
+    # ligand-ligand pairs including self pairs
+    i, j = np.triu_indices(sigmas.shape[1])
+    total += np.sum(pair_term(0.5 * (sigmas[:, i] + sigmas[:, j]),
+                              np.sqrt(ligand_epsilons[:, i] * ligand_epsilons[:, j])), axis=1)
+    return prefactor * total
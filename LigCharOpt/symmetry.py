@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def read_mol2(path):
+    '''
+    Atom types and bonds of the first molecule in a mol2 file
+    :return: list of atom types and list of (i, j, bond type) indexed from 0
+    '''
+    types = []
+    bonds = []
+    section = None
+    with open(path, 'r') as f:
+        for line in f:
+            if line.startswith('@<TRIPOS>'):
+                if section is not None and line.strip() == '@<TRIPOS>MOLECULE':
+                    break
+                section = line.strip()[9:]
+                continue
+            data = line.split()
+            if len(data) == 0:
+                continue
+            if section == 'ATOM':
+                types.append(data[5])
+            elif section == 'BOND':
+                bonds.append((int(data[1]) - 1, int(data[2]) - 1, data[3]))
+    return types, bonds
+
+
+def equivalent_atoms(types, bonds):
+    '''
+    Group topologically equivalent atoms. Every atom starts labelled by its atom type and labels are
+    refined by the sorted labels and bond types of the neighbours until the number of classes stops
+    growing, as in Morgan ranking.
+    :return: list of groups of atom indices, each sorted and in order of their first atom
+    '''
+    neighbours = [[] for x in types]
+    for i, j, bond in bonds:
+        neighbours[i].append((j, bond))
+        neighbours[j].append((i, bond))
+    labels = relabel(types)
+    while True:
+        keys = [(labels[i], tuple(sorted((labels[j], bond) for j, bond in neighbours[i]))) for i in range(len(types))]
+        new_labels = relabel(keys)
+        if len(set(new_labels)) == len(set(labels)):
+            break
+        labels = new_labels
+    groups = {}
+    for i, label in enumerate(labels):
+        groups.setdefault(label, []).append(i)
+    return sorted(groups.values())
+
+
+def relabel(keys):
+    '''
+    Replace keys by the rank of their value
+    '''
+    ranks = {key: rank for rank, key in enumerate(sorted(set(keys)))}
+    return [ranks[key] for key in keys]
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+from simtk import openmm as mm
+from simtk.openmm import app
+from simtk import unit
+from LigCharOpt.frames import get_frame_store
+import mdtraj as md
+import numpy as np
+import pytest
+
+#CONSTANTS
+BOX = 2.4
+CUTOFF = 1.0
+NUM_FRAMES = 4
+NUM_LIGAND_ATOMS = 5
+# 1-2 and 1-3 pairs of the ligand chain are excluded, 1-4 pairs are scaled
+CHARGE_SCALE_14 = 0.8333
+SIGMA_SCALE_14 = 1.0
+EPSILON_SCALE_14 = 0.5
+
+
+class PeriodicSystem(object):
+    def __init__(self, method, path):
+        '''
+        Small periodic Lennard-Jones and Coulomb system, a five atom ligand chain in a box of charged
+        particles, with a few frames written to a dcd file and read back as a FrameStore.
+        The full system energy of any ligand parameters is computed with an OpenMM Reference context.
+        :param method: NonbondedForce method
+        :param path: folder the trajectory is written to
+        '''
+        rng = np.random.RandomState(7)
+        self.ligand_atoms = list(range(NUM_LIGAND_ATOMS))
+        ligand = 1.2 + np.array([[0.15 * k, 0.03 * k**2, 0.0] for k in range(NUM_LIGAND_ATOMS)])
+        grid = np.stack(np.meshgrid(*[np.arange(6)] * 3, indexing='ij'), -1).reshape(-1, 3) * BOX / 6 + 0.2
+        distance = np.min(np.linalg.norm(grid[:, np.newaxis] - ligand[np.newaxis], axis=2), axis=1)
+        environment = grid[distance > 0.35]
+        positions = np.concatenate([ligand, environment])
+        num_atoms = len(positions)
+
+        self.charges = rng.normal(size=num_atoms) * 0.3
+        self.charges[NUM_LIGAND_ATOMS:] -= np.mean(self.charges[NUM_LIGAND_ATOMS:])
+        self.charges[:NUM_LIGAND_ATOMS] -= np.mean(self.charges[:NUM_LIGAND_ATOMS])
+        self.sigmas = 0.25 + 0.1 * rng.rand(num_atoms)
+        self.epsilons = 0.3 + 0.5 * rng.rand(num_atoms)
+
+        self.system = mm.System()
+        self.force = mm.NonbondedForce()
+        self.force.setNonbondedMethod(method)
+        self.force.setCutoffDistance(CUTOFF)
+        self.force.setUseDispersionCorrection(True)
+        self.system.setDefaultPeriodicBoxVectors(mm.Vec3(BOX, 0, 0), mm.Vec3(0, BOX, 0), mm.Vec3(0, 0, BOX))
+        for i in range(num_atoms):
+            self.system.addParticle(12.0)
+            # bare OpenMM values are kJ/mol
+            self.force.addParticle(self.charges[i], self.sigmas[i], self.epsilons[i] * 4.184)
+        # ligand exceptions as (i, j, charge scale, sigma scale, epsilon scale)
+        self.exceptions = []
+        for i in range(NUM_LIGAND_ATOMS):
+            for j in range(i + 1, NUM_LIGAND_ATOMS):
+                if j - i <= 2:
+                    self.exceptions.append((i, j, 0.0, 0.0, 0.0))
+                elif j - i == 3:
+                    self.exceptions.append((i, j, CHARGE_SCALE_14, SIGMA_SCALE_14, EPSILON_SCALE_14))
+        for i, j, charge_scale, sigma_scale, epsilon_scale in self.exceptions:
+            epsilon = epsilon_scale * np.sqrt(self.epsilons[i] * self.epsilons[j]) * 4.184
+            self.force.addException(i, j, charge_scale * self.charges[i] * self.charges[j],
+                                    sigma_scale * 0.5 * (self.sigmas[i] + self.sigmas[j]), epsilon)
+        self.system.addForce(self.force)
+
+        topology = app.Topology()
+        chain = topology.addChain()
+        for i in range(num_atoms):
+            residue = topology.addResidue('LIG' if i < NUM_LIGAND_ATOMS else 'ENV', chain)
+            topology.addAtom('C', app.element.carbon, residue)
+        frames = np.array([positions + 0.02 * rng.normal(size=positions.shape) for x in range(NUM_FRAMES)])
+        trajectory = md.Trajectory(frames, md.Topology.from_openmm(topology))
+        trajectory.unitcell_vectors = np.repeat(np.eye(3)[np.newaxis] * BOX, NUM_FRAMES, axis=0)
+        trajectory.save_dcd(str(path.join('traj.dcd')))
+        trajectory[0].save_pdb(str(path.join('traj.pdb')))
+        self.frames = get_frame_store([str(path.join('traj.dcd'))], str(path.join('traj.pdb')))
+
+        self.context = mm.Context(self.system, mm.VerletIntegrator(0.001), mm.Platform.getPlatformByName('Reference'))
+
+    def sampled_params(self):
+        '''
+        :return: concatenated [charges, sigmas] of the ligand
+        '''
+        return np.concatenate([self.charges[self.ligand_atoms], self.sigmas[self.ligand_atoms]])
+
+    def charge_exceptions(self):
+        '''
+        :return: list of (i, j, scale) of the ligand exceptions as taken by PotentialCache
+        '''
+        return [(i, j, charge_scale) for i, j, charge_scale, sigma_scale, epsilon_scale in self.exceptions]
+
+    def energies(self, params):
+        '''
+        Full system nonbonded energy with the concatenated [charges, sigmas] params on the ligand,
+        exceptions follow the ligand charges and mean sigmas
+        :return: energy of every frame in kcal/mol
+        '''
+        charges = params[:NUM_LIGAND_ATOMS]
+        sigmas = params[NUM_LIGAND_ATOMS:2*NUM_LIGAND_ATOMS]
+        for i in self.ligand_atoms:
+            self.force.setParticleParameters(i, charges[i], sigmas[i], self.epsilons[i] * 4.184)
+        for index, (i, j, charge_scale, sigma_scale, epsilon_scale) in enumerate(self.exceptions):
+            epsilon = epsilon_scale * np.sqrt(self.epsilons[i] * self.epsilons[j]) * 4.184
+            self.force.setExceptionParameters(index, i, j, charge_scale * charges[i] * charges[j],
+                                              sigma_scale * 0.5 * (sigmas[i] + sigmas[j]), epsilon)
+        self.force.updateParametersInContext(self.context)
+        energies = []
+        for frame in range(self.frames.num_frames):
+            positions, box = self.frames.frame(frame)
+            self.context.setPeriodicBoxVectors(*[mm.Vec3(*x) for x in np.array(box, dtype=np.float64)])
+            self.context.setPositions(np.array(positions, dtype=np.float64))
+            energy = self.context.getState(getEnergy=True).getPotentialEnergy()
+            energies.append(energy.value_in_unit(unit.kilocalories_per_mole))
+        return np.array(energies)
+
+
+@pytest.fixture(scope='module')
+def pme_system(tmpdir_factory):
+    return PeriodicSystem(mm.NonbondedForce.PME, tmpdir_factory.mktemp('pme'))
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+from LigCharOpt import evaluations
+from LigCharOpt.evaluations import EvaluationStore, Surrogate
+import numpy as np
+
+
+def test_evaluation_store_reload(tmpdir):
+    path = str(tmpdir.join('evaluations.jsonl'))
+    store = EvaluationStore(path)
+    store.add('gradient', [1.0, 2.0], [0.1, 0.2], 'traj')
+    store.add_point([0.1, 0.2], [0.15, 0.2], -0.5, 0.1)
+    # partial line left by a stopped run
+    with open(path, 'a') as f:
+        f.write('{"key": ')
+    store = EvaluationStore(path)
+    assert store.get('gradient', [0.1, 0.2], 'traj') == [1.0, 2.0]
+    assert store.get('gradient', [0.1, 0.3], 'traj') is None
+    assert store.get_points([0.1, 0.2]) == [[[0.15, 0.2], -0.5, 0.1]]
+
+
+def test_surrogate_interpolates():
+    rng = np.random.RandomState(0)
+    points = rng.rand(12, 3)
+    values = np.sin(np.sum(points, axis=1))
+    surrogate = Surrogate(points, values, np.full(12, 0.01))
+    assert surrogate.fitted
+    mean, std = surrogate.predict(points[:3])
+    assert np.allclose(mean, values[:3], atol=0.05)
+    assert np.all(std < 0.1)
+
+
+def test_surrogate_duplicate_points():
+    # repeated points without noise give a singular covariance, fitted with jitter
+    points = np.zeros((10, 2))
+    surrogate = Surrogate(points, np.linspace(-1.0, 1.0, 10), np.zeros(10))
+    assert surrogate.fitted
+    mean, std = surrogate.predict(points[:1])
+    assert abs(mean[0]) < 0.1
+
+
+def test_surrogate_unfit(monkeypatch):
+    def cho_factor(*args, **kwargs):
+        raise np.linalg.LinAlgError('not positive definite')
+    monkeypatch.setattr(evaluations, 'cho_factor', cho_factor)
+    surrogate = Surrogate(np.eye(10), np.arange(10.0), np.zeros(10))
+    assert not surrogate.fitted
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+from LigCharOpt.potential import PotentialCache, exp_average, exp_error, effective_sample_size, bar
+import numpy as np
+
+#CONSTANTS
+# same tolerance the engines are validated against the full system with
+TOLERANCE = 1e-03
+
+
+def relative_error(engine, full):
+    return np.max(np.abs(engine - full)) / np.max(np.abs(full))
+
+
+def test_potential_cache_matches_nonbonded_force(pme_system):
+    sampled = pme_system.sampled_params()
+    num_atoms = len(pme_system.ligand_atoms)
+    cache = PotentialCache(pme_system.system, pme_system.frames, pme_system.ligand_atoms, sampled[:num_atoms],
+                           pme_system.charge_exceptions())
+    reference = pme_system.energies(sampled)
+    params = sampled.copy()
+    params[:num_atoms] += 0.05 * np.array([1.0, -1.0, 1.0, -1.0, 0.0])
+    engine = cache.delta_energy([params[:num_atoms]])[0]
+    assert relative_error(engine, pme_system.energies(params) - reference) < TOLERANCE
+
+
+def test_potential_cache_net_charge_change(pme_system):
+    sampled = pme_system.sampled_params()
+    num_atoms = len(pme_system.ligand_atoms)
+    cache = PotentialCache(pme_system.system, pme_system.frames, pme_system.ligand_atoms, sampled[:num_atoms],
+                           pme_system.charge_exceptions())
+    reference = pme_system.energies(sampled)
+    params = sampled.copy()
+    params[0] += 0.1
+    engine = cache.delta_energy([params[:num_atoms]])[0]
+    assert relative_error(engine, pme_system.energies(params) - reference) < TOLERANCE
+
+
+def test_exp_average_gaussian():
+    # work drawn from N(mu, sigma^2) gives a free energy of mu - sigma^2 / 2kT
+    rng = np.random.RandomState(0)
+    kT, mu, sigma = 0.6, 1.0, 0.4
+    delta_u = rng.normal(mu, sigma, size=200000)
+    assert abs(exp_average(delta_u, kT) - (mu - sigma**2 / (2.0 * kT))) < 0.01
+
+
+def test_exp_average_constant():
+    delta_u = np.full((2, 50), [[3.0], [-1.0]])
+    assert np.allclose(exp_average(delta_u, 0.6), [3.0, -1.0])
+    assert np.allclose(effective_sample_size(delta_u, 0.6), 1.0)
+
+
+def test_exp_error_gaussian():
+    # spread of repeated exponential averages agrees with the asymptotic error
+    rng = np.random.RandomState(1)
+    kT, mu, sigma = 0.6, 1.0, 0.4
+    delta_u = rng.normal(mu, sigma, size=(400, 1000))
+    error = np.mean(exp_error(delta_u, kT))
+    assert abs(np.std(exp_average(delta_u, kT)) - error) < 0.1 * error
+
+
+def test_bar_gaussian():
+    # forward work N(mu, sigma^2) and reverse work N(-mu + sigma^2/kT, sigma^2) satisfy the Crooks relation
+    # with a free energy of mu - sigma^2 / 2kT
+    rng = np.random.RandomState(2)
+    kT, mu, sigma = 0.6, 2.0, 0.8
+    w_forward = rng.normal(mu, sigma, size=20000)
+    w_reverse = rng.normal(-mu + sigma**2 / kT, sigma, size=10000)
+    ddg, error = bar(w_forward, w_reverse, kT)
+    assert abs(ddg - (mu - sigma**2 / (2.0 * kT))) < 4.0 * error
+    assert 0.0 < error < 0.02
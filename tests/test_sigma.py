@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+from LigCharOpt.sigma import SigmaDerivative
+import numpy as np
+
+#CONSTANTS
+# central difference step of the sigmas in nm
+SIGMA_STEP = 1e-04
+TOLERANCE = 1e-03
+
+
+def test_sigma_derivative_matches_finite_difference(pme_system):
+    sampled = pme_system.sampled_params()
+    num_atoms = len(pme_system.ligand_atoms)
+    derivative = SigmaDerivative(pme_system.system, pme_system.frames, pme_system.ligand_atoms)
+    analytic = derivative.derivative(sampled[num_atoms:])
+    numeric = np.zeros(analytic.shape)
+    for i in range(num_atoms):
+        plus = sampled.copy()
+        minus = sampled.copy()
+        plus[num_atoms + i] += SIGMA_STEP
+        minus[num_atoms + i] -= SIGMA_STEP
+        numeric[:, i] = (pme_system.energies(plus) - pme_system.energies(minus)) / (2.0 * SIGMA_STEP)
+    assert np.max(np.abs(analytic - numeric)) / np.max(np.abs(numeric)) < TOLERANCE
+    assert np.allclose(derivative.gradient(sampled[num_atoms:]), np.mean(numeric, axis=0),
+                       atol=TOLERANCE * np.max(np.abs(numeric)))
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+from LigCharOpt.subsystem import LigandEnergy, validation_params
+from LigCharOpt.parameters import ParameterModel
+import numpy as np
+
+#CONSTANTS
+TOLERANCE = 1e-03
+
+
+def parameter_model(system):
+    '''
+    ParameterModel of the ligand of the test system with exceptions following the ligand parameters
+    '''
+    sampled = system.sampled_params()
+    num_atoms = len(system.ligand_atoms)
+    nonbonded = [[sampled[i], sampled[num_atoms + i]] for i in range(num_atoms)]
+    exceptions = [{'id': (i, j), 'data': [charge_scale * sampled[i] * sampled[j],
+                                          sigma_scale * 0.5 * (sampled[num_atoms + i] + sampled[num_atoms + j])]}
+                  for i, j, charge_scale, sigma_scale, epsilon_scale in system.exceptions]
+    parameters = [[{'id': i, 'data': x} for i, x in enumerate(nonbonded)], exceptions]
+    return ParameterModel(parameters, nonbonded, list(range(num_atoms)), exceptions, [])
+
+
+def test_ligand_energy_matches_nonbonded_force(pme_system):
+    sampled = pme_system.sampled_params()
+    energy = LigandEnergy(pme_system.system, pme_system.frames, pme_system.ligand_atoms, sampled,
+                          pme_system.charge_exceptions())
+    params = validation_params(sampled)
+    engine = energy.delta_energy([params, sampled])
+    full = pme_system.energies(params) - pme_system.energies(sampled)
+    assert np.max(np.abs(engine[0] - engine[1] - full)) / np.max(np.abs(full)) < TOLERANCE
+
+
+def test_ligand_energy_validation(pme_system):
+    sampled = pme_system.sampled_params()
+    energy = LigandEnergy(pme_system.system, pme_system.frames, pme_system.ligand_atoms, sampled,
+                          pme_system.charge_exceptions())
+    model = parameter_model(pme_system)
+    assert energy.validate(pme_system.system, model, validation_params(sampled), sampled) < TOLERANCE
+    # a wrong evaluator fails validation
+    energy.electrostatics.potential *= 2.0
+    assert energy.validate(pme_system.system, model, validation_params(sampled), sampled) > TOLERANCE
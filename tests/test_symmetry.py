@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+from LigCharOpt.symmetry import read_mol2, equivalent_atoms
+
+#CONSTANTS
+# toluene with GAFF atom types, ring carbons 1-6 with the methyl carbon 7 on atom 1
+TOLUENE = '''@<TRIPOS>MOLECULE
+TOL
+   15    15     1     0     0
+SMALL
+bcc
+
+
+@<TRIPOS>ATOM
+      1 C1          -0.0000     1.3970     0.0000 ca         1 TOL      -0.1000
+      2 C2           1.2098     0.6985     0.0000 ca         1 TOL      -0.1000
+      3 C3           1.2098    -0.6985     0.0000 ca         1 TOL      -0.1000
+      4 C4           0.0000    -1.3970     0.0000 ca         1 TOL      -0.1000
+      5 C5          -1.2098    -0.6985     0.0000 ca         1 TOL      -0.1000
+      6 C6          -1.2098     0.6985     0.0000 ca         1 TOL      -0.1000
+      7 C7          -0.0000     2.9070     0.0000 c3         1 TOL      -0.1000
+      8 H2           2.1500     1.2400     0.0000 ha         1 TOL       0.1000
+      9 H3           2.1500    -1.2400     0.0000 ha         1 TOL       0.1000
+     10 H4           0.0000    -2.4800     0.0000 ha         1 TOL       0.1000
+     11 H5          -2.1500    -1.2400     0.0000 ha         1 TOL       0.1000
+     12 H6          -2.1500     1.2400     0.0000 ha         1 TOL       0.1000
+     13 H71          1.0200     3.2700     0.0000 hc         1 TOL       0.1000
+     14 H72         -0.5100     3.2700     0.8800 hc         1 TOL       0.1000
+     15 H73         -0.5100     3.2700    -0.8800 hc         1 TOL       0.1000
+@<TRIPOS>BOND
+     1     1     2 ar
+     2     2     3 ar
+     3     3     4 ar
+     4     4     5 ar
+     5     5     6 ar
+     6     6     1 ar
+     7     1     7 1
+     8     2     8 1
+     9     3     9 1
+    10     4    10 1
+    11     5    11 1
+    12     6    12 1
+    13     7    13 1
+    14     7    14 1
+    15     7    15 1
+@<TRIPOS>SUBSTRUCTURE
+     1 TOL         1 TEMP              0 ****  ****    0 ROOT
+'''
+
+
+def test_read_mol2(tmpdir):
+    path = tmpdir.join('toluene.mol2')
+    path.write(TOLUENE)
+    types, bonds = read_mol2(str(path))
+    assert types == ['ca'] * 6 + ['c3'] + ['ha'] * 5 + ['hc'] * 3
+    assert len(bonds) == 15
+    assert bonds[0] == (0, 1, 'ar')
+    assert bonds[-1] == (6, 14, '1')
+
+
+def test_equivalent_atoms_toluene(tmpdir):
+    path = tmpdir.join('toluene.mol2')
+    path.write(TOLUENE)
+    groups = equivalent_atoms(*read_mol2(str(path)))
+    assert groups == [[0], [1, 5], [2, 4], [3], [6], [7, 11], [8, 10], [9], [12, 13, 14]]
+
+
+def test_equivalent_atoms_bond_types():
+    # same atom types joined by different bond types are not equivalent
+    types = ['c', 'o', 'o']
+    assert equivalent_atoms(types, [(0, 1, '2'), (0, 2, '1')]) == [[0], [1], [2]]
+    assert equivalent_atoms(types, [(0, 1, 'ar'), (0, 2, 'ar')]) == [[0], [1, 2]]